@@ -1,7 +1,11 @@
+import asyncio
 import time
 import logging
 import httpx
-from app.models import ChatMessage
+from app.models import Message
+from app.context_packer import estimate_tokens
+from app.retrieval import RetrievalPlanner
+from app.category_router import CategoryRouter
 
 logger = logging.getLogger("app.agent")
 
@@ -9,13 +13,26 @@ OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 
 
 class WhatsAppAgent:
-    def __init__(self, api_key: str, config: dict):
+    def __init__(self, api_key: str, config: dict, ledger=None, tenant: str = ""):
         self.api_key = api_key
+        # UsageLedger: budget check + usage record around every OpenRouter call
+        self.ledger = ledger
+        self.tenant = tenant
         self.agent_config = config["agent"]
         self.system_prompt = self.agent_config["system_prompt"]
         self.model = self.agent_config.get("model", "deepseek/deepseek-chat")
         self.temperature = self.agent_config.get("temperature", 0.7)
         self.max_tokens = self.agent_config.get("max_tokens", 500)
+        # search_with_debug arguments: top 5, or MMR packing up to knowledge.context.token_budget,
+        # scored with knowledge.scoring weights (the replay runner overrides them to compare configs)
+        knowledge_config = config.get("knowledge", {})
+        self.rag_params = {
+            "n_results": 5, **knowledge_config.get("context", {}), **knowledge_config.get("scoring", {}),
+        }
+        # Skips / reuses retrieval per session (only when chat() gets a session_id) and
+        # narrows searches to the question's categories
+        self.planner = RetrievalPlanner(**knowledge_config.get("retrieval", {}))
+        self.planner.router = CategoryRouter(**knowledge_config.get("router", {}))
 
     def update_params(self, model: str, temperature: float, max_tokens: int) -> None:
         self.model = model
@@ -24,12 +41,16 @@ class WhatsAppAgent:
 
     async def chat(
         self,
-        history: list[ChatMessage],
+        history: list[Message],
         user_message: str,
         knowledge_base=None,
         prompt_context: str = "",
         system_prompt_override: str | None = None,
+        session_id: str = "",
+        caller: str = "chat",
+        model_override: str | None = None,
     ) -> dict:
+        model = model_override or self.model
         system_content = system_prompt_override if system_prompt_override is not None else self.system_prompt
         if (prompt_context or "").strip():
             system_content = system_content.rstrip() + "\n\n--- CONTEXTO ADICIONAL ---\n" + prompt_context.strip()
@@ -38,10 +59,13 @@ class WhatsAppAgent:
 
         rag_chunks = []
         rag_debug = []
+        rag_plan = None
 
         # RAG: inject relevant knowledge chunks
         if knowledge_base:
-            result = knowledge_base.search_with_debug(user_message, n_results=5)
+            result, rag_plan = self.planner.retrieve(
+                knowledge_base, session_id, history, user_message, **self.rag_params,
+            )
             rag_chunks = result["chunks"]
             rag_debug = result.get("debug", [])
             if rag_chunks:
@@ -57,27 +81,17 @@ class WhatsAppAgent:
         messages.append({"role": "user", "content": user_message})
 
         request_body = {
-            "model": self.model,
+            "model": model,
             "messages": messages,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
         }
         logger.debug("OpenRouter request: model=%s messages=%d temp=%.1f max_tokens=%d",
-                      self.model, len(messages), self.temperature, self.max_tokens)
+                      model, len(messages), self.temperature, self.max_tokens)
         logger.debug("OpenRouter request body: %s", request_body)
 
         t_start = time.monotonic()
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                OPENROUTER_URL,
-                headers={
-                    "Authorization": f"Bearer {self.api_key}",
-                    "Content-Type": "application/json",
-                },
-                json=request_body,
-            )
-            response.raise_for_status()
-            data = response.json()
+        data = await self.complete(request_body, caller=caller, session_id=session_id)
         t_end = time.monotonic()
         elapsed_ms = round((t_end - t_start) * 1000)
 
@@ -89,22 +103,66 @@ class WhatsAppAgent:
         return {
             "reply": reply_text,
             "debug": {
-                "model": self.model,
+                "model": data.get("model_used", model),
                 "temperature": self.temperature,
                 "max_tokens": self.max_tokens,
                 "response_time_ms": elapsed_ms,
                 "history_message_count": len(history),
                 "rag": {
                     "chunk_count": len(rag_chunks),
+                    "context_tokens": sum(estimate_tokens(c) for c in rag_chunks),
                     "sources": list({d["source"] for d in rag_debug}),
                     "chunks": rag_debug,
+                    "plan": rag_plan,
                 },
                 "token_usage": {
                     "prompt_tokens": usage.get("prompt_tokens"),
                     "completion_tokens": usage.get("completion_tokens"),
                     "total_tokens": usage.get("total_tokens"),
+                    "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
                 },
                 "system_prompt": messages[0]["content"],
                 "messages_sent": messages,
             },
         }
+
+    async def complete(self, request_body: dict, caller: str = "chat", session_id: str = "") -> dict:
+        """Chat completion through the usage ledger (chat, evaluator judge, introspector).
+
+        The ledger may swap the model for a cheaper one or raise BudgetExceeded
+        (non-critical callers) when a budget is used up. Adds "model_used" to the response.
+        """
+        model = request_body["model"]
+        if self.ledger is not None:
+            if self.ledger.needs_prime(caller, session_id):
+                await asyncio.to_thread(self.ledger.prime_session, session_id)
+            request_body = {**request_body, "model": self.ledger.check(caller, model, session_id)}
+        data = {}
+        ok = False
+        t_start = time.monotonic()
+        try:
+            data = await self._post(request_body)
+            ok = True
+        finally:
+            if self.ledger is not None:
+                self.ledger.record(
+                    caller, request_body["model"], data.get("usage"), (time.monotonic() - t_start) * 1000,
+                    tenant=self.tenant, session_id=session_id, ok=ok, downgraded=request_body["model"] != model,
+                )
+        data["model_used"] = request_body["model"]
+        return data
+
+    async def _post(self, request_body: dict) -> dict:
+        """POST the chat completion to OpenRouter and return the response JSON."""
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            response = await client.post(
+                OPENROUTER_URL,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                # usage.include: OpenRouter reports the call's cost (and cached tokens)
+                json={**request_body, "usage": {"include": True}},
+            )
+            response.raise_for_status()
+            return response.json()
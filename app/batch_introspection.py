@@ -0,0 +1,251 @@
+"""Batch introspection: run the Introspector over many conversations or failed eval cases.
+
+Inputs become debug snapshots like the ones the simulator sends to /api/introspect:
+- stored sessions: each bot reply (or only the last one per session) with the
+  history before it, the tenant's current system prompt + the session's prompt
+  context, and the RAG chunks retrieved again for that message;
+- eval results: the failed cases' replies, with the failed checks in the question.
+
+Identical inputs (same message, reply and chunks) are analyzed once. Analyses run
+concurrently (`concurrency`) under a token bucket (`rate_per_minute`); a budget
+stop from the usage ledger ends the job early. Root causes and ACTION: suggestions
+are merged across analyses when their content words mostly overlap, and ranked by
+how many conversations they came from.
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime
+
+from app.outbound import RateLimiter
+from app.retrieval import content_terms
+from app.usage import BudgetExceeded
+
+BATCH_QUESTION = (
+    "Analizá esta respuesta en modo auditoría. Primera línea, exactamente: "
+    "CAUSA: <la causa raíz en una oración, general (sin nombres de clientes)>. "
+    "Después una explicación corta y las ACTION que lo corregirían para todas las conversaciones parecidas."
+)
+SIMILAR_TERMS = 0.6  # Jaccard over content words to merge two causes / prompt edits
+MAX_EXAMPLES = 20
+MAX_JOBS = 20
+
+
+def _similar(a: set[str], b: set[str]) -> bool:
+    if not a or not b:
+        return a == b
+    return len(a & b) / len(a | b) >= SIMILAR_TERMS
+
+
+# --- Snapshots ---
+
+def _snapshot(agent, kb, system_prompt: str, turns: list[dict], reply: str, user_message: str) -> dict:
+    rag = kb.search_with_debug(user_message, **agent.rag_params) if kb else {"debug": []}
+    return {
+        "model": agent.model,
+        "temperature": agent.temperature,
+        "system_prompt": system_prompt,
+        "rag": {"chunks": rag["debug"]},
+        "token_usage": {},
+        "messages_sent": turns + [{"role": "assistant", "content": reply}],
+        "user_message": user_message,
+        "agent_reply": reply,
+    }
+
+
+def _system_prompt(agent, prompt_context: str) -> str:
+    if (prompt_context or "").strip():
+        return agent.system_prompt.rstrip() + "\n\n--- CONTEXTO ADICIONAL ---\n" + prompt_context.strip()
+    return agent.system_prompt
+
+
+def session_items(session, agent, kb, per_session: str = "last") -> list[dict]:
+    """Snapshots for a session's bot replies ("last" one or "all"). Blocking (RAG search)."""
+    system_prompt = _system_prompt(agent, session.prompt_context)
+    turns, candidates = [], []
+    for m in session.messages:
+        if m.role == "assistant" and m.source == "bot" and turns and turns[-1]["role"] == "user":
+            candidates.append((list(turns), m.content))
+        if m.source != "system":
+            turns.append({"role": m.role, "content": m.content})
+    if per_session == "last":
+        candidates = candidates[-1:]
+    return [
+        {
+            "id": f"{session.id}#{len(history)}",
+            "source": "session",
+            "snapshot": _snapshot(agent, kb, system_prompt, history, reply, history[-1]["content"]),
+            "question": BATCH_QUESTION,
+        }
+        for history, reply in candidates
+    ]
+
+
+def eval_items(results: list[dict], test_cases: list[dict], agent, kb) -> list[dict]:
+    """Snapshots for the failed cases of an evaluation run. Blocking (RAG search)."""
+    cases = {tc["id"]: tc for tc in test_cases}
+    items = []
+    for r in results:
+        tc = cases.get(r.get("test_id"))
+        if tc is None or r.get("passed", True):
+            continue
+        failed = [c["rule"] for c in r.get("checks", []) if not c.get("passed")]
+        judge = r.get("llm_judge") or {}
+        if judge.get("reason"):
+            failed.append(f"juez LLM ({judge.get('score')}/5): {judge['reason']}")
+        question = BATCH_QUESTION + "\nEl caso de evaluación falló en: " + "; ".join(failed or ["(sin detalle)"])
+        user_message = tc["user_message"]
+        items.append({
+            "id": tc["id"],
+            "source": "eval",
+            "snapshot": _snapshot(agent, kb, agent.system_prompt, [{"role": "user", "content": user_message}],
+                                  r.get("reply", ""), user_message),
+            "question": question,
+        })
+    return items
+
+
+# --- Merging ---
+
+def merge_causes(analyses: list[dict]) -> list[dict]:
+    """[{"cause", "count", "items"}] most frequent first; similar wordings are one cause."""
+    groups = []
+    for a in analyses:
+        terms = content_terms(a["cause"])
+        group = next((g for g in groups if _similar(g["terms"], terms)), None)
+        if group is None:
+            group = {"cause": a["cause"], "terms": terms, "items": []}
+            groups.append(group)
+        group["items"] += a["items"]
+    return [
+        {"cause": g["cause"], "count": len(g["items"]), "items": g["items"][:MAX_EXAMPLES]}
+        for g in sorted(groups, key=lambda g: len(g["items"]), reverse=True)
+    ]
+
+
+def merge_actions(analyses: list[dict]) -> list[dict]:
+    """ACTION items of all analyses as ranked proposals: {"type", "label", "params", "count", "items"}.
+
+    Prompt edits merge when their text is similar; doc actions when they target the
+    same doc (and priority). count = conversations that led to it.
+    """
+    groups = []
+    for a in analyses:
+        for action in a["actions"]:
+            params = action["params"]
+            if action["type"] == "edit_prompt":
+                key = content_terms(params.get("append", ""))
+                group = next((g for g in groups if g["type"] == "edit_prompt" and _similar(g["key"], key)), None)
+            else:
+                key = json.dumps(params, sort_keys=True)
+                group = next((g for g in groups if g["type"] == action["type"] and g["key"] == key), None)
+            if group is None:
+                group = {"type": action["type"], "key": key, "label": action["label"], "params": params,
+                         "items": [], "labels": {}}
+                groups.append(group)
+            group["labels"][action["label"]] = group["labels"].get(action["label"], 0) + len(a["items"])
+            group["items"] += [i for i in a["items"] if i not in group["items"]]
+
+    proposals = []
+    for g in sorted(groups, key=lambda g: len(g["items"]), reverse=True):
+        proposals.append({
+            "type": g["type"],
+            "label": max(g["labels"], key=g["labels"].get),
+            "params": g["params"],
+            "count": len(g["items"]),
+            "items": g["items"][:MAX_EXAMPLES],
+        })
+    return proposals
+
+
+# --- Jobs ---
+
+class IntrospectionJob:
+    def __init__(self, items: list[dict], tenant: str = "default"):
+        self.id = uuid.uuid4().hex[:12]
+        self.tenant = tenant
+        self.created_at = datetime.now().isoformat()
+        self.finished_at = ""
+        self.state = "running"  # running | done | budget_exceeded | error
+        self.items = items
+        self.analyses: list[dict] = []  # one per distinct input, "items" = ids that share it
+        self.failed: list[dict] = []
+        self.done = 0
+        self.llm_calls = 0
+        self.error = ""
+        self.elapsed_ms = 0
+
+    def to_dict(self, include_analyses: bool = True) -> dict:
+        out = {
+            "id": self.id,
+            "state": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total": len(self.items),
+            "done": self.done,
+            "llm_calls": self.llm_calls,
+            "failed": len(self.failed),
+            "elapsed_ms": self.elapsed_ms,
+            "error": self.error,
+        }
+        if include_analyses:
+            out["causes"] = merge_causes(self.analyses)
+            out["proposals"] = merge_actions(self.analyses)
+            out["analyses"] = self.analyses
+            out["errors"] = self.failed
+        return out
+
+
+class BatchIntrospector:
+    def __init__(self, introspector, concurrency: int = 4, rate_per_minute: float = 60):
+        self.introspector = introspector
+        self.concurrency = max(1, concurrency)
+        self.limiter = RateLimiter(rate_per_minute / 60, burst=self.concurrency)
+
+    @staticmethod
+    def _input_key(item: dict) -> str:
+        snap = item["snapshot"]
+        chunks = [c.get("text", "") for c in snap["rag"]["chunks"]]
+        raw = json.dumps([snap["user_message"], snap["agent_reply"], chunks, item["question"]], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def run(self, job: IntrospectionJob) -> None:
+        t_start = time.perf_counter()
+        distinct: dict[str, list[dict]] = {}
+        for item in job.items:
+            distinct.setdefault(self._input_key(item), []).append(item)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stop = asyncio.Event()
+
+        async def analyze(group: list[dict]) -> None:
+            ids = [i["id"] for i in group]
+            async with semaphore:
+                if stop.is_set():
+                    return
+                await self.limiter.acquire()
+                job.llm_calls += 1
+                try:
+                    result = await self.introspector.diagnose(group[0]["snapshot"], group[0]["question"])
+                except BudgetExceeded as e:
+                    stop.set()
+                    job.state, job.error = "budget_exceeded", str(e)
+                    return
+                except Exception as e:
+                    job.failed.append({"items": ids, "error": str(e)})
+                    job.done += len(group)
+                    return
+            job.analyses.append({"items": ids, "source": group[0]["source"], **result})
+            job.done += len(group)
+
+        try:
+            await asyncio.gather(*(analyze(group) for group in distinct.values()))
+            if job.state == "running":
+                job.state = "done"
+        except Exception as e:
+            job.state, job.error = "error", str(e)
+        job.elapsed_ms = round((time.perf_counter() - t_start) * 1000)
+        job.finished_at = datetime.now().isoformat()
@@ -0,0 +1,63 @@
+"""Category router: maps a question to the knowledge categories worth searching.
+
+Each category (the chunks' `category` metadata, see scripts/import-catalogo-rag.sh)
+has a list of keywords from config.yaml knowledge.router.categories; a keyword
+matches at the start of a word, so stems work ("inyectab" matches "inyectables")
+and so do phrases ("bajar de peso"). The question goes to the categories with hits,
+unless more than max_categories match (too ambiguous to narrow down).
+
+mode "filter" pushes the categories into the Chroma query as a `where` filter
+(falling back to the whole collection when the filtered results are weak, see
+KnowledgeBase.search_with_debug); mode "boost" searches everything and adds
+knowledge.scoring.category_weight to chunks of the routed categories.
+"""
+
+from app.retrieval import _tokens
+
+MODES = ("filter", "boost")
+
+
+class CategoryRouter:
+    def __init__(
+        self,
+        enabled: bool = False,
+        mode: str = "filter",
+        categories: dict[str, list[str]] | None = None,
+        max_categories: int = 2,
+        fallback_similarity: float = 0.3,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"router mode must be one of {MODES}, got {mode!r}")
+        self.enabled = enabled
+        self.mode = mode
+        self.max_categories = max_categories
+        self.fallback_similarity = fallback_similarity
+        self.keywords = {
+            category: [" ".join(_tokens(k)) for k in keywords if _tokens(k)]
+            for category, keywords in (categories or {}).items()
+        }
+
+    def route(self, query: str) -> list[str]:
+        """Matching categories, most keyword hits first ([] = search everything)."""
+        if not self.enabled or not self.keywords:
+            return []
+        text = " " + " ".join(_tokens(query))
+        hits = {}
+        for category, keywords in self.keywords.items():
+            n = sum(1 for k in keywords if f" {k}" in text)
+            if n:
+                hits[category] = n
+        if len(hits) > self.max_categories:
+            return []
+        return sorted(hits, key=hits.get, reverse=True)
+
+    def search_params(self, query: str) -> dict:
+        """search_with_debug arguments for this query."""
+        categories = self.route(query)
+        if not categories:
+            return {}
+        return {
+            "categories": categories,
+            "category_filter": self.mode == "filter",
+            "fallback_similarity": self.fallback_similarity,
+        }
@@ -3,8 +3,8 @@ import yaml
 from pathlib import Path
 
 
-def load_client_config() -> dict:
-    config_path = os.getenv("CLIENT_CONFIG_PATH", "config/config.yaml")
+def load_client_config(config_path: str | None = None) -> dict:
+    config_path = config_path or os.getenv("CLIENT_CONFIG_PATH", "config/config.yaml")
     with open(config_path, "r", encoding="utf-8") as f:
         config = yaml.safe_load(f)
 
@@ -22,3 +22,11 @@ def load_client_config() -> dict:
 
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
+
+# WhatsApp Cloud API — sin token/phone id se usa un sender fake (solo registra)
+WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN", "")
+WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "")
+WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "")
+WHATSAPP_APP_SECRET = os.getenv("WHATSAPP_APP_SECRET", "")
+# Base pública para armar URLs absolutas de imágenes (ej. https://bot.midominio.com)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "")
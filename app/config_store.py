@@ -1,78 +1,244 @@
 import os
 import copy
+import atexit
+import difflib
+import hashlib
+import json
+import logging
+import tempfile
+import threading
 from datetime import datetime
 from pathlib import Path
 
 import yaml
 
 
+logger = logging.getLogger("app.config_store")
+
 MAX_PROMPT_VERSIONS = 20
+WRITE_DEBOUNCE_SECONDS = 0.5
+
+
+def _atomic_write(path: Path, text: str) -> None:
+    """Write via temp file + fsync + rename, so a crash never leaves a half-written file."""
+    os.makedirs(path.parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class PromptVersionStore:
+    """Prompt history under data/prompt_versions/: one content-addressed blob per distinct
+    prompt text (objects/<sha256>.txt) plus index.json with timestamps and diff stats.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects_dir = root / "objects"
+        self.index_path = root / "index.json"
+        self._index: list[dict] | None = None
+        self._texts: dict[str, str] = {}
+
+    def entries(self) -> list[dict]:
+        """Index entries, oldest first: {timestamp, hash, added, removed}."""
+        if self._index is None:
+            if self.index_path.exists():
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            else:
+                self._index = []
+        return self._index
+
+    def text(self, digest: str) -> str:
+        if digest not in self._texts:
+            self._texts[digest] = (self.objects_dir / f"{digest}.txt").read_text(encoding="utf-8")
+        return self._texts[digest]
+
+    def add(self, text: str, timestamp: str | None = None) -> None:
+        entries = self.entries()
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        blob = self.objects_dir / f"{digest}.txt"
+        if not blob.exists():
+            _atomic_write(blob, text)
+        self._texts[digest] = text
+
+        previous = self.text(entries[-1]["hash"]) if entries else ""
+        added, removed = self._diff_stat(previous, text)
+        entries.append({
+            "timestamp": timestamp or datetime.now().isoformat(timespec="seconds"),
+            "hash": digest,
+            "added": added,
+            "removed": removed,
+        })
+        if len(entries) > MAX_PROMPT_VERSIONS:
+            del entries[:-MAX_PROMPT_VERSIONS]
+        _atomic_write(self.index_path, json.dumps(entries, ensure_ascii=False, indent=2))
+        self._prune()
+
+    def diff(self, older: str, newer: str) -> str:
+        return "".join(difflib.unified_diff(
+            older.splitlines(keepends=True), newer.splitlines(keepends=True),
+            fromfile="anterior", tofile="version",
+        ))
+
+    @staticmethod
+    def _diff_stat(older: str, newer: str) -> tuple[int, int]:
+        matcher = difflib.SequenceMatcher(None, older.splitlines(), newer.splitlines(), autojunk=False)
+        added = removed = 0
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag in ("replace", "delete"):
+                removed += i2 - i1
+            if tag in ("replace", "insert"):
+                added += j2 - j1
+        return added, removed
+
+    def _prune(self) -> None:
+        """Delete blobs no longer referenced by the index."""
+        referenced = {e["hash"] for e in self.entries()}
+        for blob in self.objects_dir.glob("*.txt"):
+            if blob.stem not in referenced:
+                blob.unlink(missing_ok=True)
+                self._texts.pop(blob.stem, None)
 
 
 class ConfigStore:
     """Reads/writes data/runtime_config.yaml — the user's working copy.
     If the file doesn't exist, bootstraps from the factory default (config/config.yaml).
+
+    Reads are served from memory. Saves update memory immediately and are written to
+    disk atomically by a background timer (debounced), off the event loop; call
+    flush() on shutdown. Prompt versions live in a separate PromptVersionStore.
     """
 
-    def __init__(self, runtime_path: str, defaults: dict):
+    def __init__(self, runtime_path: str, defaults: dict, versions_dir: str | None = None):
         self.runtime_path = Path(runtime_path)
         self.defaults = defaults
+        self.versions = PromptVersionStore(
+            Path(versions_dir) if versions_dir else self.runtime_path.parent / "prompt_versions"
+        )
         self._data: dict = {}
+        self._mtime: float | None = None
+        self._lock = threading.RLock()
+        self._timer: threading.Timer | None = None
         self._ensure_runtime_file()
+        atexit.register(self.flush)
 
     # --- public API ---
 
     def load(self) -> dict:
-        """Return current runtime config dict."""
-        with open(self.runtime_path, "r", encoding="utf-8") as f:
-            self._data = yaml.safe_load(f) or {}
-        return self._data
+        """Return current runtime config dict (re-parsed only if the file changed on disk)."""
+        with self._lock:
+            if self._timer is not None:
+                return self._data  # unsaved edits are newer than the file
+            mtime = self.runtime_path.stat().st_mtime
+            if self._data and mtime == self._mtime:
+                return self._data
+            with open(self.runtime_path, "r", encoding="utf-8") as f:
+                self._data = yaml.safe_load(f) or {}
+            self._mtime = mtime
+            self._migrate_inline_versions()
+            return self._data
 
     def save_prompt(self, text: str) -> None:
-        self._ensure_loaded()
-        old = self._data.get("system_prompt", "")
-        self._data["system_prompt"] = text
-        if text != old:
-            self._add_prompt_version(text)
-        self._write()
+        with self._lock:
+            self._ensure_loaded()
+            old = self._data.get("system_prompt", "")
+            self._data["system_prompt"] = text
+            if text != old:
+                self._add_prompt_version(text)
+            self._write()
 
     def save_model_params(self, model: str, temperature: float, max_tokens: int) -> None:
-        self._ensure_loaded()
-        self._data["model"] = model
-        self._data["temperature"] = temperature
-        self._data["max_tokens"] = max_tokens
-        self._write()
+        with self._lock:
+            self._ensure_loaded()
+            self._data["model"] = model
+            self._data["temperature"] = temperature
+            self._data["max_tokens"] = max_tokens
+            self._write()
 
     def save_default_context(self, text: str) -> None:
-        self._ensure_loaded()
-        self._data["prompt_context_default"] = text
-        self._write()
+        with self._lock:
+            self._ensure_loaded()
+            self._data["prompt_context_default"] = text
+            self._write()
 
     def save_session_timeout(self, minutes: int) -> None:
-        self._ensure_loaded()
-        self._data["session_timeout_minutes"] = minutes
-        self._write()
+        with self._lock:
+            self._ensure_loaded()
+            self._data["session_timeout_minutes"] = minutes
+            self._write()
 
     def save_greeting(self, enabled: bool, text: str, patterns: list[str]) -> None:
-        self._ensure_loaded()
-        self._data["greeting_enabled"] = enabled
-        self._data["greeting_text"] = text
-        self._data["greeting_patterns"] = patterns
-        self._write()
+        with self._lock:
+            self._ensure_loaded()
+            self._data["greeting_enabled"] = enabled
+            self._data["greeting_text"] = text
+            self._data["greeting_patterns"] = patterns
+            self._write()
+
+    def save_experiment(self, experiment: dict | None) -> None:
+        """Active A/B experiment definition (None = no experiment)."""
+        with self._lock:
+            self._ensure_loaded()
+            if experiment is None:
+                self._data.pop("experiment", None)
+            else:
+                self._data["experiment"] = experiment
+            self._write()
 
     def get_prompt_versions(self) -> list[dict]:
-        self._ensure_loaded()
-        return list(reversed(self._data.get("prompt_versions", [])))
+        with self._lock:
+            return [
+                {
+                    "timestamp": e["timestamp"],
+                    "prompt_text": self.versions.text(e["hash"]),
+                    "hash": e["hash"],
+                    "added": e.get("added", 0),
+                    "removed": e.get("removed", 0),
+                }
+                for e in reversed(self.versions.entries())
+            ]
+
+    def get_version_diff(self, index: int) -> str:
+        """Unified diff of a version (reversed index, 0 = most recent) against the one before it."""
+        with self._lock:
+            entries = list(reversed(self.versions.entries()))
+            if index < 0 or index >= len(entries):
+                raise IndexError(f"Version index {index} out of range (0-{len(entries)-1})")
+            newer = self.versions.text(entries[index]["hash"])
+            older = self.versions.text(entries[index + 1]["hash"]) if index + 1 < len(entries) else ""
+            return self.versions.diff(older, newer)
 
     def restore_version(self, index: int) -> str:
         """Restore a prompt version by its index in the reversed list (0 = most recent)."""
-        versions = self.get_prompt_versions()
-        if index < 0 or index >= len(versions):
-            raise IndexError(f"Version index {index} out of range (0-{len(versions)-1})")
-        text = versions[index]["prompt_text"]
-        self._data["system_prompt"] = text
-        self._write()
-        return text
+        with self._lock:
+            entries = list(reversed(self.versions.entries()))
+            if index < 0 or index >= len(entries):
+                raise IndexError(f"Version index {index} out of range (0-{len(entries)-1})")
+            text = self.versions.text(entries[index]["hash"])
+            self._ensure_loaded()
+            self._data["system_prompt"] = text
+            self._write()
+            return text
+
+    def flush(self) -> None:
+        """Write pending changes now (blocking)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            else:
+                return
+            snapshot = copy.deepcopy(self._data)
+            self._write_now(snapshot)
 
     # --- helpers ---
 
@@ -81,7 +247,6 @@ class ConfigStore:
             self.load()
             return
 
-        os.makedirs(self.runtime_path.parent, exist_ok=True)
         agent = self.defaults.get("agent", {})
         self._data = {
             "system_prompt": agent.get("system_prompt", ""),
@@ -89,27 +254,40 @@ class ConfigStore:
             "model": agent.get("model", "deepseek/deepseek-chat"),
             "temperature": agent.get("temperature", 0.7),
             "max_tokens": agent.get("max_tokens", 500),
-            "prompt_versions": [],
             "session_timeout_minutes": 120,
             "greeting_enabled": True,
             "greeting_text": "",
             "greeting_patterns": [],
         }
-        self._write()
+        self._write_now(self._data)
 
     def _ensure_loaded(self) -> None:
         if not self._data:
             self.load()
 
+    def _migrate_inline_versions(self) -> None:
+        """Older runtime_config.yaml files kept prompt_versions inline; move them out."""
+        inline = self._data.pop("prompt_versions", None)
+        if inline is None:
+            return
+        if not self.versions.entries():
+            for v in inline:
+                self.versions.add(v["prompt_text"], timestamp=v.get("timestamp"))
+        logger.info("moved %d prompt versions to %s", len(inline), self.versions.root)
+        self._write_now(self._data)
+
     def _add_prompt_version(self, text: str) -> None:
-        versions = self._data.setdefault("prompt_versions", [])
-        versions.append({
-            "timestamp": datetime.now().isoformat(timespec="seconds"),
-            "prompt_text": text,
-        })
-        if len(versions) > MAX_PROMPT_VERSIONS:
-            self._data["prompt_versions"] = versions[-MAX_PROMPT_VERSIONS:]
+        self.versions.add(text)
 
     def _write(self) -> None:
-        with open(self.runtime_path, "w", encoding="utf-8") as f:
-            yaml.dump(self._data, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        """Schedule a debounced write; bursts of admin saves become one disk write."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(WRITE_DEBOUNCE_SECONDS, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _write_now(self, data: dict) -> None:
+        text = yaml.dump(data, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        _atomic_write(self.runtime_path, text)
+        self._mtime = self.runtime_path.stat().st_mtime
@@ -0,0 +1,98 @@
+"""RAG context packing: pick diverse chunks up to a token budget instead of a fixed top-k.
+
+1. Maximal marginal relevance over the fetched candidates: each step takes the chunk
+   with the best  lambda * relevance - (1 - lambda) * max similarity to what's already
+   picked, so five near-identical chunks from one catalog file don't fill the prompt.
+   Near-duplicates (cosine >= DUPLICATE_SIMILARITY) are dropped outright.
+2. Chunks are added while they fit in the token budget (smaller ones can still fit
+   after a big one didn't). The first pick (the most relevant chunk) is always kept,
+   truncated to the budget if it's bigger, so packing never gives less than top-1.
+3. Picked chunks that are consecutive in the same document are merged back into one
+   block, in document order.
+"""
+
+import numpy as np
+
+DUPLICATE_SIMILARITY = 0.95
+
+
+def estimate_tokens(text: str) -> int:
+    """~4 characters per token (Spanish text, BPE tokenizers); good enough for budgeting."""
+    return max(1, len(text) // 4)
+
+
+def truncate_to_tokens(text: str, token_budget: int) -> str:
+    """Cut text to ~token_budget tokens (estimate_tokens), at a word boundary if possible."""
+    limit = max(1, token_budget) * 4
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > limit // 2 else cut).rstrip() + " …"
+
+
+def mmr_select(
+    relevance: list[float],
+    embeddings: np.ndarray,
+    tokens: list[int],
+    token_budget: int,
+    mmr_lambda: float = 0.7,
+) -> list[int]:
+    """Indices of the chosen candidates, in the order they were picked.
+
+    The first index may exceed token_budget on its own (see truncate_to_tokens).
+    """
+    n = len(relevance)
+    if n == 0:
+        return []
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+    similarity = vectors @ vectors.T
+    rel = np.asarray(relevance, dtype=np.float32)
+
+    chosen: list[int] = []
+    available = np.ones(n, dtype=bool)
+    max_sim = np.zeros(n, dtype=np.float32)  # to the chosen set
+    used = 0
+    while available.any():
+        scores = np.where(available, mmr_lambda * rel - (1 - mmr_lambda) * max_sim, -np.inf)
+        best = int(np.argmax(scores))
+        available[best] = False
+        if chosen and used + tokens[best] > token_budget:
+            continue
+        chosen.append(best)
+        used += tokens[best]
+        max_sim = np.maximum(max_sim, similarity[best])
+        available &= max_sim < DUPLICATE_SIMILARITY
+    return chosen
+
+
+def merge_adjacent(entries: list[dict]) -> list[dict]:
+    """Merge entries that are consecutive chunks of the same document.
+
+    Entries need "doc_id", "chunk_index", "text", "score". The merged entry keeps the
+    best score and lists the chunk indices in "merged"; groups are ordered by score.
+    """
+    by_doc: dict[str, list[dict]] = {}
+    for e in entries:
+        by_doc.setdefault(e["doc_id"], []).append(e)
+
+    blocks = []
+    for doc_entries in by_doc.values():
+        doc_entries.sort(key=lambda e: e["chunk_index"])
+        current = None
+        for e in doc_entries:
+            if current is not None and e["chunk_index"] == current["merged"][-1] + 1:
+                current["text"] += "\n\n" + e["text"]
+                current["merged"].append(e["chunk_index"])
+                current["score"] = max(current["score"], e["score"])
+                current["similarity"] = max(current["similarity"], e["similarity"])
+            else:
+                current = {**e, "merged": [e["chunk_index"]]}
+                blocks.append(current)
+
+    for block in blocks:
+        block["tokens"] = estimate_tokens(block["text"])
+    blocks.sort(key=lambda b: b["score"], reverse=True)
+    return blocks
@@ -0,0 +1,119 @@
+"""Local embedding provider for the knowledge base (ONNX, batched, optional quantization)."""
+
+import logging
+import os
+import time
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+logger = logging.getLogger("app.embeddings")
+
+DEFAULT_MODEL = "all-MiniLM-L6-v2"
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class LocalEmbedder(ONNXMiniLM_L6_V2):
+    """Chroma-compatible embedding function backed by a local ONNX sentence model.
+
+    - model_dir: folder with model.onnx + tokenizer.json (any sentence-transformers
+      ONNX export). Empty = Chroma's all-MiniLM-L6-v2 (downloaded on first use).
+    - batch_size: texts per ONNX forward pass on ingestion.
+    - precision: "float32" (default), "float16" (vectors rounded to half precision,
+      halves snapshot/export size) or "int8" (dynamically quantized model weights,
+      ~4x smaller resident model and faster CPU inference; needs `pip install onnx`).
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, model_dir: str = "",
+                 batch_size: int = 32, precision: str = "float32"):
+        super().__init__()
+        if precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+        self.model_name = model or DEFAULT_MODEL
+        self.batch_size = max(1, int(batch_size))
+        self.precision = precision
+        self._custom_dir = bool(model_dir)
+        if model_dir:
+            # ONNXMiniLM_L6_V2 loads files from DOWNLOAD_PATH / EXTRACTED_FOLDER_NAME
+            self.DOWNLOAD_PATH = Path(model_dir).parent
+            self.EXTRACTED_FOLDER_NAME = Path(model_dir).name
+
+    def describe(self) -> dict:
+        return {
+            "model": self.model_name,
+            "model_dir": str(Path(self.DOWNLOAD_PATH) / self.EXTRACTED_FOLDER_NAME),
+            "batch_size": self.batch_size,
+            "precision": self.precision,
+        }
+
+    # --- embedding ---
+
+    def __call__(self, input):
+        return self.embed(list(input))
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Embed texts in batches of `batch_size`."""
+        if not texts:
+            return []
+        if not self._custom_dir:
+            self._download_model_if_not_exists()
+        vectors = self._forward(texts, batch_size=self.batch_size)
+        if self.precision == "float16":
+            vectors = vectors.astype(np.float16).astype(np.float32)
+        return vectors.tolist()
+
+    def warmup(self) -> float:
+        """Load tokenizer + ONNX session and run one forward pass. Returns elapsed ms."""
+        t_start = time.monotonic()
+        self.embed(["hola, cuanto sale la creatina?"])
+        elapsed_ms = round((time.monotonic() - t_start) * 1000)
+        logger.info("embedding model warm: %s precision=%s (%dms)", self.model_name, self.precision, elapsed_ms)
+        return elapsed_ms
+
+    # --- model loading ---
+
+    @cached_property
+    def model(self):
+        if self.precision != "int8":
+            return super().model
+        quantized = self._quantized_model_path()
+        if quantized is None:
+            return super().model
+        so = self.ort.SessionOptions()
+        so.log_severity_level = 3
+        return self.ort.InferenceSession(
+            str(quantized),
+            providers=self._preferred_providers or self.ort.get_available_providers(),
+            sess_options=so,
+        )
+
+    def _quantized_model_path(self) -> Path | None:
+        """Quantize model.onnx to int8 once and cache it next to the original."""
+        folder = Path(self.DOWNLOAD_PATH) / self.EXTRACTED_FOLDER_NAME
+        source = folder / "model.onnx"
+        target = folder / "model.int8.onnx"
+        if target.exists() and target.stat().st_mtime >= source.stat().st_mtime:
+            return target
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except ImportError:
+            logger.warning("int8 precision requires the 'onnx' package; falling back to float32 model")
+            return None
+        tmp = target.with_suffix(".tmp")
+        quantize_dynamic(str(source), str(tmp), weight_type=QuantType.QInt8)
+        os.replace(tmp, target)
+        logger.info("quantized embedding model written to %s", target)
+        return target
+
+
+def build_embedder(config: dict | None) -> LocalEmbedder:
+    """Build the embedder from the `knowledge.embedding` section of config.yaml."""
+    config = config or {}
+    return LocalEmbedder(
+        model=config.get("model", DEFAULT_MODEL),
+        model_dir=config.get("model_dir", ""),
+        batch_size=config.get("batch_size", 32),
+        precision=config.get("precision", "float32"),
+    )
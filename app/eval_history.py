@@ -0,0 +1,179 @@
+"""Evaluation run history in SQLite: every run_all report, per case, to diff runs.
+
+Each case result carries its inputs (prompt version = sha256 of the system prompt,
+as in PromptVersionStore; model; the RAG chunk ids it got) and input_hash over all
+of them plus the chunk texts and the case itself. Incremental runs
+(Evaluator.run_all(incremental=True)) reuse the previous result of every case whose
+input_hash is unchanged. A/B experiment variants (Experiment.overrides key) run in
+their own scope: runs are looked up by tenant, while "previous run" and retention
+(the last max_runs runs) are per tenant and scope ('' for the tenant's own prompt).
+"""
+
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS eval_runs (
+    id TEXT PRIMARY KEY,
+    tenant TEXT NOT NULL,
+    scope TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS eval_results (
+    run_id TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    input_hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (run_id, test_id)
+);
+"""
+
+
+def diff_runs(older: list[dict], newer: list[dict]) -> dict:
+    """Per-case changes between two runs' results.
+
+    status: fixed | regressed | passing | failing | new | removed. Only cases whose
+    status, reply, judge score or inputs changed are listed in "cases".
+    """
+    before = {r["test_id"]: r for r in older}
+    after = {r["test_id"]: r for r in newer}
+    counts = {s: 0 for s in ("fixed", "regressed", "passing", "failing", "new", "removed")}
+    cases = []
+    for test_id in list(after) + [t for t in before if t not in after]:
+        old, new = before.get(test_id), after.get(test_id)
+        if old is None:
+            status = "new"
+        elif new is None:
+            status = "removed"
+        elif old["passed"] != new["passed"]:
+            status = "fixed" if new["passed"] else "regressed"
+        else:
+            status = "passing" if new["passed"] else "failing"
+        counts[status] += 1
+        if old is None or new is None:
+            cases.append({"test_id": test_id, "status": status})
+            continue
+
+        old_inputs, new_inputs = old.get("inputs") or {}, new.get("inputs") or {}
+        inputs_changed = [k for k in ("prompt_version", "model") if old_inputs.get(k) != new_inputs.get(k)]
+        old_chunks, new_chunks = old_inputs.get("chunks", []), new_inputs.get("chunks", [])
+        if old_chunks != new_chunks:
+            inputs_changed.append("chunks")
+        judge_before = (old.get("llm_judge") or {}).get("score")
+        judge_after = (new.get("llm_judge") or {}).get("score")
+        reply_changed = old.get("reply") != new.get("reply")
+        if status in ("passing", "failing") and not (reply_changed or inputs_changed or judge_before != judge_after):
+            continue
+        entry = {
+            "test_id": test_id,
+            "status": status,
+            "reply_changed": reply_changed,
+            "inputs_changed": inputs_changed,
+            "judge": [judge_before, judge_after],
+            "checks_failed": [
+                [c["rule"] for c in r.get("checks", []) if not c.get("passed")] for r in (old, new)
+            ],
+        }
+        if "chunks" in inputs_changed:
+            entry["chunks_added"] = [c for c in new_chunks if c not in old_chunks]
+            entry["chunks_removed"] = [c for c in old_chunks if c not in new_chunks]
+        cases.append(entry)
+    return {"counts": counts, "cases": cases}
+
+
+class EvalHistory:
+    def __init__(self, db_path: str = "data/eval_history.db", max_runs: int = 50):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_runs = max_runs
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(eval_runs)")}
+        if "scope" not in columns:  # variant runs used to be stored under tenant "<tenant>:<key>"
+            self._conn.execute("ALTER TABLE eval_runs ADD COLUMN scope TEXT NOT NULL DEFAULT ''")
+            self._conn.execute(
+                "UPDATE eval_runs SET scope = substr(tenant, instr(tenant, ':') + 1), "
+                "tenant = substr(tenant, 1, instr(tenant, ':') - 1) WHERE instr(tenant, ':') > 0"
+            )
+            self._conn.execute("DROP INDEX IF EXISTS idx_eval_runs_tenant")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_eval_runs_scope ON eval_runs (tenant, scope)")
+        self._lock = threading.Lock()
+
+    def save(self, tenant: str, report: dict, scope: str = "") -> str:
+        """Store a run_all report; returns its run id."""
+        run_id = uuid.uuid4().hex[:12]
+        summary = {k: v for k, v in report.items() if k != "results"}
+        rows = [
+            (run_id, r["test_id"], int(r["passed"]), r.get("input_hash", ""), json.dumps(r, ensure_ascii=False))
+            for r in report["results"]
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT INTO eval_runs (id, tenant, scope, created_at, summary) VALUES (?, ?, ?, ?, ?)",
+                (run_id, tenant, scope, datetime.now().isoformat(timespec="seconds"),
+                 json.dumps(summary, ensure_ascii=False)),
+            )
+            self._conn.executemany(
+                "INSERT INTO eval_results (run_id, test_id, passed, input_hash, result) VALUES (?, ?, ?, ?, ?)", rows,
+            )
+            stale = [row[0] for row in self._conn.execute(
+                "SELECT id FROM eval_runs WHERE tenant = ? AND scope = ? ORDER BY rowid DESC LIMIT -1 OFFSET ?",
+                (tenant, scope, self.max_runs),
+            )]
+            for old_id in stale:
+                self._conn.execute("DELETE FROM eval_results WHERE run_id = ?", (old_id,))
+                self._conn.execute("DELETE FROM eval_runs WHERE id = ?", (old_id,))
+            self._conn.execute("COMMIT")
+        return run_id
+
+    def list_runs(self, tenant: str, limit: int = 20, scope: str | None = None) -> list[dict]:
+        """Run summaries, newest first (every scope unless one is given)."""
+        where, params = "tenant = ?", [tenant]
+        if scope is not None:
+            where += " AND scope = ?"
+            params.append(scope)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, scope, created_at, summary FROM eval_runs WHERE {where} ORDER BY rowid DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        return [
+            {"id": run_id, "scope": run_scope, "created_at": created_at, **json.loads(summary)}
+            for run_id, run_scope, created_at, summary in rows
+        ]
+
+    def get_run(self, tenant: str, run_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT scope, created_at, summary FROM eval_runs WHERE id = ? AND tenant = ?", (run_id, tenant),
+            ).fetchone()
+            if row is None:
+                return None
+            results = [json.loads(r[0]) for r in self._conn.execute(
+                "SELECT result FROM eval_results WHERE run_id = ? ORDER BY rowid", (run_id,),
+            )]
+        return {"id": run_id, "scope": row[0], "created_at": row[1], **json.loads(row[2]), "results": results}
+
+    def previous(self, tenant: str, run_id: str | None = None, scope: str = "") -> dict | None:
+        """The run before run_id in its scope (or the latest run in `scope`), with results."""
+        with self._lock:
+            if run_id is None:
+                row = self._conn.execute(
+                    "SELECT id FROM eval_runs WHERE tenant = ? AND scope = ? ORDER BY rowid DESC LIMIT 1",
+                    (tenant, scope),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT prev.id FROM eval_runs AS run JOIN eval_runs AS prev "
+                    "ON prev.tenant = run.tenant AND prev.scope = run.scope AND prev.rowid < run.rowid "
+                    "WHERE run.id = ? AND run.tenant = ? ORDER BY prev.rowid DESC LIMIT 1",
+                    (run_id, tenant),
+                ).fetchone()
+        return self.get_run(tenant, row[0]) if row else None
@@ -1,30 +1,62 @@
+import asyncio
+import hashlib
+import json
 import os
+import statistics
+import time
 from pathlib import Path
 
 import yaml
 
+from app.context_packer import estimate_tokens
+from app.eval_history import diff_runs
+from app.judge_cache import judge_key
+from app.usage import BudgetExceeded
+
+JUDGE_SCALE = """Dá un puntaje del 1 al 5 donde:
+1 = Muy mala (no cumple nada, respuesta incorrecta o peligrosa)
+2 = Mala (no cumple la mayoría de los comportamientos)
+3 = Aceptable (cumple algunos comportamientos, tono correcto)
+4 = Buena (cumple casi todo, tono natural)
+5 = Excelente (cumple todo, tono perfecto, respuesta natural)"""
+
 
 class Evaluator:
     """Runs test cases against the agent and checks expected behaviors."""
 
-    def __init__(self, agent, knowledge_base, test_cases_path: str = "training/evaluaciones/test-cases.yaml"):
+    def __init__(self, agent, knowledge_base, test_cases_path: str = "training/evaluaciones/test-cases.yaml",
+                 judge_cache=None, judge_batch_size: int = 1, history=None, tenant: str = "default"):
         self.agent = agent
         self.kb = knowledge_base
         self.test_cases_path = Path(test_cases_path)
+        # LLM judge: results reused while reply + expectations are unchanged (app.judge_cache);
+        # judge_batch_size > 1 judges that many cases per call in run_all
+        self.judge_cache = judge_cache
+        self.judge_batch_size = judge_batch_size
+        # app.eval_history.EvalHistory: run_all reports are stored and diffed against the previous run
+        self.history = history
+        self.tenant = tenant
+        self._cases: tuple[float | None, list[dict]] = (None, [])  # (file mtime, parsed cases)
 
     def load_test_cases(self) -> list[dict]:
+        """Test cases, re-parsed only when the file's mtime changes."""
         if not self.test_cases_path.exists():
             return []
-        with open(self.test_cases_path, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
-        return data.get("test_cases", [])
+        mtime = self.test_cases_path.stat().st_mtime
+        if mtime != self._cases[0]:
+            with open(self.test_cases_path, "r", encoding="utf-8") as f:
+                data = yaml.safe_load(f) or {}
+            self._cases = (mtime, data.get("test_cases", []))
+        return list(self._cases[1])
 
     def _save_test_cases(self, cases: list[dict]) -> None:
         os.makedirs(self.test_cases_path.parent, exist_ok=True)
         with open(self.test_cases_path, "w", encoding="utf-8") as f:
             yaml.dump({"test_cases": cases}, f, allow_unicode=True, default_flow_style=False, sort_keys=False)
+        self._cases = (self.test_cases_path.stat().st_mtime, list(cases))
 
-    def add_test_case(self, name: str, user_message: str, expected_behaviors: list[str], tags: list[str] = None) -> dict:
+    def add_test_case(self, name: str, user_message: str, expected_behaviors: list[str], tags: list[str] = None,
+                      expected_sources: list[str] = None, expected_chunks: list[str] = None) -> dict:
         cases = self.load_test_cases()
         # Generate next ID
         existing_ids = [c.get("id", "") for c in cases]
@@ -44,11 +76,25 @@ class Evaluator:
             "expected_behaviors": expected_behaviors,
             "tags": tags or [],
         }
+        # Optional retrieval expectations (see run_retrieval)
+        if expected_sources:
+            tc["expected_sources"] = expected_sources
+        if expected_chunks:
+            tc["expected_chunks"] = expected_chunks
         cases.append(tc)
         self._save_test_cases(cases)
         return tc
 
     async def run_single(self, test_case: dict, use_llm_judge: bool = False) -> dict:
+        out = await self._run_case(test_case)
+        if use_llm_judge and "error" not in out:
+            judgments, out["judge_calls"] = await self._judge_many([(test_case, out["reply"])], batch_size=1)
+            self._apply_judge(out, judgments[0])
+        return out
+
+    async def _run_case(self, test_case: dict, variant: dict | None = None) -> dict:
+        """Agent reply + rule checks for one case (no judge)."""
+        variant = variant or {}
         user_message = test_case["user_message"]
         expected = test_case.get("expected_behaviors", [])
 
@@ -59,14 +105,20 @@ class Evaluator:
                 user_message=user_message,
                 knowledge_base=self.kb,
                 prompt_context="",
+                system_prompt_override=variant.get("system_prompt"),
+                caller="eval",
+                model_override=variant.get("model"),
             )
             reply = result["reply"]
+            usage = result["debug"]["token_usage"]
+            inputs, input_hash = self._inputs(test_case, result["debug"]["rag"]["chunks"], variant)
         except Exception as e:
             return {
                 "test_id": test_case["id"],
                 "passed": False,
                 "reply": f"[Error: {e}]",
                 "checks": [],
+                "error": str(e),
             }
 
         # Check rules
@@ -91,87 +143,283 @@ class Evaluator:
             if not passed:
                 all_passed = False
 
-        out = {
+        return {
             "test_id": test_case["id"],
             "passed": all_passed,
             "reply": reply,
             "checks": checks,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "context_tokens": result["debug"]["rag"]["context_tokens"],
+            "inputs": inputs,
+            "input_hash": input_hash,
         }
 
-        # Optional LLM judge
-        if use_llm_judge:
-            judge_result = await self._llm_judge(test_case, reply)
-            out["llm_judge"] = judge_result
-            # If LLM judge gives score < 3, mark as fail
-            if judge_result.get("score", 5) < 3:
-                out["passed"] = False
-
-        return out
-
-    async def run_all(self, use_llm_judge: bool = False) -> dict:
+    def _inputs(self, test_case: dict, rag_chunks: list[dict], variant: dict | None = None) -> tuple[dict, str]:
+        """What the reply depends on: ({"prompt_version", "model", "chunks"}, hash).
+
+        The hash also covers the chunk texts, the sampling params and the case itself,
+        so an edited document or expectation counts as a change.
+        """
+        chunk_ids = [
+            f"{c.get('doc_id', '')}_chunk_{i}" for c in rag_chunks for i in c.get("merged", [c.get("chunk_index", 0)])
+        ]
+        variant = variant or {}
+        system_prompt = variant.get("system_prompt") or self.agent.system_prompt
+        inputs = {
+            "prompt_version": hashlib.sha256(system_prompt.encode("utf-8")).hexdigest(),
+            "model": variant.get("model") or self.agent.model,
+            "chunks": chunk_ids,
+        }
+        raw = json.dumps(
+            [inputs, self.agent.temperature, self.agent.max_tokens, [c.get("text", "") for c in rag_chunks], test_case],
+            ensure_ascii=False, sort_keys=True,
+        )
+        return inputs, hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _current_input_hash(self, test_case: dict, variant: dict | None = None) -> str:
+        """input_hash the case would have now, from a fresh retrieval (no LLM call)."""
+        chunks = []
+        if self.kb:
+            result, _ = self.agent.planner.retrieve(self.kb, "", [], test_case["user_message"], **self.agent.rag_params)
+            chunks = result.get("debug", [])
+        return self._inputs(test_case, chunks, variant)[1]
+
+    @staticmethod
+    def _apply_judge(out: dict, judge_result: dict) -> None:
+        out["llm_judge"] = judge_result
+        # If LLM judge gives score < 3, mark as fail
+        score = judge_result.get("score")
+        if score is not None and score < 3:
+            out["passed"] = False
+
+    async def run_all(self, use_llm_judge: bool = False, judge_batch_size: int | None = None,
+                      incremental: bool = False, variant: dict | None = None) -> dict:
+        """Run every case. incremental: reuse the previous run's result of the cases whose
+        inputs (prompt, model, retrieved chunks, the case) didn't change.
+
+        variant: {"key", "system_prompt", "model"} of an A/B experiment variant (see
+        Experiment.overrides); its runs have their own history.
+        """
         cases = self.load_test_cases()
-        results = []
-        passed_count = 0
+        history_scope = variant["key"] if variant else ""
+        # History (SQLite) and the retrieval behind input hashes run off the event loop
+        previous = None
+        if self.history:
+            previous = await asyncio.to_thread(self.history.previous, self.tenant, None, history_scope)
+        reusable = {r["test_id"]: r for r in previous["results"]} if incremental and previous else {}
 
+        results = []
         for tc in cases:
-            r = await self.run_single(tc, use_llm_judge=use_llm_judge)
-            results.append(r)
-            if r["passed"]:
-                passed_count += 1
+            old = reusable.get(tc["id"])
+            if old and "error" not in old and (
+                old.get("input_hash") == await asyncio.to_thread(self._current_input_hash, tc, variant)
+            ):
+                r = {**old, "reused": True}
+                if "llm_judge" in r and not use_llm_judge:
+                    # Drop the old judge verdict: pass/fail from the rule checks alone
+                    del r["llm_judge"]
+                    r["passed"] = all(c["passed"] for c in r["checks"])
+                results.append(r)
+            else:
+                results.append(await self._run_case(tc, variant))
 
-        return {
+        judge = None
+        if use_llm_judge:
+            judged = [(tc, r) for tc, r in zip(cases, results) if "error" not in r and "llm_judge" not in r]
+            batch_size = judge_batch_size or self.judge_batch_size
+            judgments, judge = await self._judge_many([(tc, r["reply"]) for tc, r in judged], batch_size)
+            for (_, r), judgment in zip(judged, judgments):
+                self._apply_judge(r, judgment)
+
+        passed_count = sum(1 for r in results if r["passed"])
+        prompt_tokens = [r["prompt_tokens"] for r in results if r.get("prompt_tokens") is not None]
+        scores = [r["llm_judge"]["score"] for r in results if (r.get("llm_judge") or {}).get("score") is not None]
+        report = {
             "total": len(results),
             "passed": passed_count,
             "failed": len(results) - passed_count,
+            # To compare context settings (knowledge.context) at equal pass rate
+            "prompt_tokens_mean": round(statistics.mean(prompt_tokens), 1) if prompt_tokens else None,
+            # Judge calls made vs one per case: cached + batched
+            "judge": judge,
+            "judge_score_mean": round(statistics.mean(scores), 2) if scores else None,
+            "variant": variant["key"] if variant else None,
+            "incremental": incremental,
+            "reused": sum(1 for r in results if r.get("reused")),
             "results": results,
         }
+        if self.history:
+            if previous:
+                report["previous_run"] = previous["id"]
+                report["diff"] = diff_runs(previous["results"], results)
+            report["run_id"] = await asyncio.to_thread(self.history.save, self.tenant, report, history_scope)
+        return report
+
+    # --- Retrieval only (no LLM) ---
+
+    @staticmethod
+    def _expected_retrieval(test_case: dict) -> list[tuple[str, str]]:
+        """What a test case expects retrieval to find: [("source", name) | ("chunk", text)]."""
+        items = [("source", s.strip().lower()) for s in test_case.get("expected_sources", []) if s.strip()]
+        items += [("chunk", c.strip().lower()) for c in test_case.get("expected_chunks", []) if c.strip()]
+        return items
+
+    @staticmethod
+    def _matches(item: tuple[str, str], entry: dict) -> bool:
+        kind, value = item
+        if kind == "source":
+            # "catalogo/orales.txt" or just "orales.txt"
+            source = entry.get("source", "").lower()
+            return source == value or source.endswith("/" + value)
+        return value in entry.get("text", "").lower()
+
+    def run_retrieval_single(self, test_case: dict, k: int = 5, router=None, **search_params) -> dict:
+        """Run only the knowledge search for a test case and score it against its expectations.
+
+        recall: share of expected sources/chunks found in what search_with_debug returned
+        (the top k, or the packed context when search_params has a token_budget).
+        reciprocal_rank: 1 / rank of the first result matching any expectation (0 if none).
+        router: a CategoryRouter to narrow the search by category, as in chat.
+        """
+        expected = self._expected_retrieval(test_case)
+        if router is not None:
+            search_params = {**search_params, **router.search_params(test_case["user_message"])}
+        t_start = time.perf_counter()
+        result = self.kb.search_with_debug(test_case["user_message"], n_results=k, **search_params)
+        latency_ms = (time.perf_counter() - t_start) * 1000
+        entries = result["debug"]
+
+        found = {}
+        first_rank = None
+        for rank, entry in enumerate(entries, start=1):
+            for item in expected:
+                if self._matches(item, entry):
+                    found.setdefault(item, rank)
+                    first_rank = first_rank or rank
 
-    async def _llm_judge(self, test_case: dict, reply: str) -> dict:
-        """Use the same LLM to judge the quality of a response."""
-        behaviors_text = "\n".join(f"- {b}" for b in test_case.get("expected_behaviors", []))
+        return {
+            "test_id": test_case["id"],
+            "query": test_case["user_message"],
+            "recall": round(len(found) / len(expected), 3) if expected else None,
+            "reciprocal_rank": round(1 / first_rank, 3) if first_rank else 0.0,
+            "latency_ms": round(latency_ms, 2),
+            "context_tokens": sum(estimate_tokens(c) for c in result["chunks"]),
+            "categories": result.get("categories", []),
+            "missing": [value for kind, value in expected if (kind, value) not in found],
+            "retrieved": [
+                {"rank": rank, "source": e["source"], "score": e["score"], "relevant": any(self._matches(i, e) for i in expected)}
+                for rank, e in enumerate(entries, start=1)
+            ],
+        }
 
-        judge_prompt = f"""Evaluá la siguiente respuesta de un agente de ventas de suplementos deportivos.
+    def run_retrieval(self, k: int = 5, test_ids: list[str] | None = None, router=None, **search_params) -> dict:
+        """Offline retrieval evaluation over the cases that declare expected_sources/expected_chunks.
+
+        Blocking (embeds each query); call from a thread in request handlers.
+        """
+        cases = [
+            tc for tc in self.load_test_cases()
+            if self._expected_retrieval(tc) and (test_ids is None or tc["id"] in test_ids)
+        ]
+        results = [self.run_retrieval_single(tc, k, router=router, **search_params) for tc in cases]
+        latencies = sorted(r["latency_ms"] for r in results)
 
-Mensaje del usuario: "{test_case['user_message']}"
+        def pct(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            "k": k,
+            "params": {**search_params, "router": router is not None and router.enabled},
+            "total": len(results),
+            "filtered": sum(bool(r["categories"]) for r in results),
+            "recall": round(statistics.mean(r["recall"] for r in results), 3) if results else None,
+            "mrr": round(statistics.mean(r["reciprocal_rank"] for r in results), 3) if results else None,
+            "context_tokens_mean": round(statistics.mean(r["context_tokens"] for r in results), 1) if results else None,
+            "latency_ms_p50": pct(0.5),
+            "latency_ms_p95": pct(0.95),
+            "latency_ms_max": latencies[-1] if latencies else 0.0,
+            "results": results,
+        }
+
+    # --- LLM judge ---
+
+    async def _judge_many(self, items: list[tuple[dict, str]], batch_size: int = 1) -> tuple[list[dict], dict]:
+        """Judge (test case, reply) pairs: cache first, then batches of batch_size per call.
+
+        Cases a batched response doesn't score are judged one by one. Returns the
+        judgments (in order) and {"cases", "cached", "calls", "calls_avoided", "batch_size"}.
+        """
+        model = self.agent.model
+        judgments: list[dict | None] = [None] * len(items)
+        misses = []  # (index, cache key)
+        for i, (tc, reply) in enumerate(items):
+            key = judge_key(model, tc, reply)
+            cached = self.judge_cache.get(key) if self.judge_cache else None
+            if cached is not None:
+                judgments[i] = cached
+            else:
+                misses.append((i, key))
+
+        calls = 0
+        if batch_size > 1:
+            for start in range(0, len(misses), batch_size):
+                batch = misses[start:start + batch_size]
+                if len(batch) < 2:
+                    break
+                calls += 1
+                for (i, _), judgment in zip(batch, await self._llm_judge_batch([items[i] for i, _ in batch])):
+                    judgments[i] = judgment
+        for i, key in misses:
+            if judgments[i] is None:
+                calls += 1
+                judgments[i] = await self._llm_judge(*items[i])
+            if self.judge_cache:
+                self.judge_cache.put(key, model, judgments[i])
+
+        return judgments, {
+            "cases": len(items),
+            "cached": len(items) - len(misses),
+            "calls": calls,
+            "calls_avoided": len(items) - calls,
+            "batch_size": batch_size,
+        }
+
+    async def _judge_call(self, prompt: str, max_tokens: int) -> str:
+        data = await self.agent.complete(
+            {
+                "model": self.agent.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.1,
+                "max_tokens": max_tokens,
+            },
+            caller="judge",
+        )
+        return data["choices"][0]["message"]["content"].strip()
+
+    @staticmethod
+    def _case_block(test_case: dict, reply: str) -> str:
+        behaviors_text = "\n".join(f"- {b}" for b in test_case.get("expected_behaviors", []))
+        return f"""Mensaje del usuario: "{test_case['user_message']}"
 
 Respuesta del agente: "{reply}"
 
 Comportamientos esperados:
-{behaviors_text}
+{behaviors_text}"""
 
-Dá un puntaje del 1 al 5 donde:
-1 = Muy mala (no cumple nada, respuesta incorrecta o peligrosa)
-2 = Mala (no cumple la mayoría de los comportamientos)
-3 = Aceptable (cumple algunos comportamientos, tono correcto)
-4 = Buena (cumple casi todo, tono natural)
-5 = Excelente (cumple todo, tono perfecto, respuesta natural)
+    async def _llm_judge(self, test_case: dict, reply: str) -> dict:
+        """Use the same LLM to judge the quality of a response."""
+        judge_prompt = f"""Evaluá la siguiente respuesta de un agente de ventas de suplementos deportivos.
+
+{self._case_block(test_case, reply)}
+
+{JUDGE_SCALE}
 
 Respondé EXACTAMENTE en este formato (sin nada más):
 SCORE: [numero]
 REASON: [explicación breve en una línea]"""
 
         try:
-            import httpx
-            from app.agent import OPENROUTER_URL
-
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    OPENROUTER_URL,
-                    headers={
-                        "Authorization": f"Bearer {self.agent.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": self.agent.model,
-                        "messages": [{"role": "user", "content": judge_prompt}],
-                        "temperature": 0.1,
-                        "max_tokens": 150,
-                    },
-                )
-                response.raise_for_status()
-                data = response.json()
-
-            judge_text = data["choices"][0]["message"]["content"].strip()
+            judge_text = await self._judge_call(judge_prompt, max_tokens=150)
 
             # Parse SCORE and REASON
             score = 3
@@ -188,5 +436,43 @@ REASON: [explicación breve en una línea]"""
 
             return {"score": max(1, min(5, score)), "reason": reason}
 
+        except BudgetExceeded as e:
+            # Over the daily budget: the rule checks still count, the judge is skipped
+            return {"score": None, "reason": f"LLM judge omitido: {e}"}
         except Exception as e:
             return {"score": 0, "reason": f"Error en LLM judge: {e}"}
+
+    async def _llm_judge_batch(self, items: list[tuple[dict, str]]) -> list[dict | None]:
+        """Judge several cases in one call (JSON answer). None for cases it didn't score."""
+        cases_text = "\n\n".join(
+            f"### Caso {n}\n{self._case_block(tc, reply)}" for n, (tc, reply) in enumerate(items, start=1)
+        )
+        judge_prompt = f"""Evaluá cada una de las siguientes respuestas de un agente de ventas de suplementos deportivos, por separado.
+
+{cases_text}
+
+Para cada caso, {JUDGE_SCALE[0].lower()}{JUDGE_SCALE[1:]}
+
+Respondé SOLO con un JSON (sin nada más), un objeto por caso:
+[{{"caso": 1, "score": [numero], "reason": "[explicación breve en una línea]"}}, ...]"""
+
+        try:
+            judge_text = await self._judge_call(judge_prompt, max_tokens=60 + 80 * len(items))
+        except BudgetExceeded as e:
+            return [{"score": None, "reason": f"LLM judge omitido: {e}"} for _ in items]
+        except Exception:
+            return [None] * len(items)  # judged one by one instead
+
+        out: list[dict | None] = [None] * len(items)
+        try:
+            parsed = json.loads(judge_text[judge_text.index("["):judge_text.rindex("]") + 1])
+        except ValueError:
+            return out
+        for entry in parsed if isinstance(parsed, list) else []:
+            try:
+                n, score = int(entry["caso"]), int(entry["score"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 1 <= n <= len(items):
+                out[n - 1] = {"score": max(1, min(5, score)), "reason": str(entry.get("reason", ""))}
+        return out
@@ -0,0 +1,79 @@
+"""In-process event bus for the operator console (served as Server-Sent Events).
+
+Handlers publish session/message/handoff changes; each /api/events client streams
+them. Recent events are kept in a ring buffer so a reconnecting client resumes from
+its Last-Event-ID; if that id already fell out of the buffer it gets a "resync"
+event and reloads everything once. Events tagged with a tenant only reach that
+tenant's consoles.
+"""
+
+import asyncio
+import json
+from collections import deque
+
+
+BUFFER_SIZE = 1000
+HEARTBEAT_SECONDS = 15.0
+
+
+class EventBus:
+    def __init__(self, buffer_size: int = BUFFER_SIZE):
+        self._events: deque[dict] = deque(maxlen=buffer_size)
+        self._last_id = 0
+        self._changed: asyncio.Condition | None = None
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, event_type: str, data: dict, tenant: str | None = None) -> dict:
+        """Record an event and wake up subscribers. Call from the event loop."""
+        self._last_id += 1
+        event = {"id": self._last_id, "type": event_type, "data": data, "tenant": tenant}
+        self._events.append(event)
+        if self._changed is not None:
+            asyncio.get_running_loop().create_task(self._notify())
+        return event
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    def since(self, last_event_id: int) -> list[dict] | None:
+        """Events after last_event_id, or None if some of them were already dropped."""
+        if last_event_id >= self._last_id:
+            return []
+        oldest = self._events[0]["id"] if self._events else self._last_id + 1
+        if last_event_id < oldest - 1:
+            return None
+        return [e for e in self._events if e["id"] > last_event_id]
+
+    async def stream(self, last_event_id: int | None = None, tenant: str | None = None):
+        """Yield SSE-formatted strings forever (until the client disconnects)."""
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+
+        cursor = self._last_id if last_event_id is None else last_event_id
+        yield "retry: 3000\n\n"
+        while True:
+            events = self.since(cursor)
+            if events is None:
+                yield _format({"id": self._last_id, "type": "resync", "data": {}})
+                cursor = self._last_id
+                continue
+            for event in events:
+                if tenant is None or event["tenant"] in (None, tenant):
+                    yield _format(event)
+                cursor = event["id"]
+            if events:
+                continue
+            try:
+                async with self._changed:
+                    await asyncio.wait_for(self._changed.wait(), timeout=HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+
+
+def _format(event: dict) -> str:
+    data = json.dumps(event["data"], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
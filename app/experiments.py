@@ -0,0 +1,237 @@
+"""Prompt/model A/B experiments: live chat traffic split between variants.
+
+An experiment (one active per tenant, kept in runtime_config.yaml by ConfigStore) has
+variants {name, system_prompt, model, weight}; an empty prompt or model means the
+tenant's current one, so a variant with neither is the control. A conversation's
+variant comes from sha256(experiment id + phone number) mapped to [0, 1) against the
+cumulative weights (in variant order): a customer keeps their variant across sessions
+and restarts, and ramping (changing the weights) only moves the customers between the
+old and the new boundary.
+
+Every LLM turn of an assigned conversation is logged in ExperimentLog (SQLite, buffered
+like the usage ledger): latency, tokens and handoff. Eval suite runs per variant
+(Evaluator.run_all(variant=...)) are logged there too, so metrics() compares cost,
+speed and quality side by side.
+"""
+
+import hashlib
+import sqlite3
+import statistics
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiment_turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    tenant TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    latency_ms REAL NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    handoff INTEGER NOT NULL DEFAULT 0,
+    ok INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_experiment_turns ON experiment_turns (experiment, variant);
+CREATE TABLE IF NOT EXISTS experiment_evals (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    tenant TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    run_id TEXT NOT NULL DEFAULT '',
+    total INTEGER NOT NULL,
+    passed INTEGER NOT NULL,
+    judge_score_mean REAL
+);
+"""
+
+TURN_COLUMNS = (
+    "ts", "tenant", "experiment", "variant", "session_id", "latency_ms",
+    "prompt_tokens", "completion_tokens", "total_tokens", "handoff", "ok",
+)
+
+
+class Experiment:
+    def __init__(self, name: str, variants: list[dict], id: str = "", created_at: str = ""):
+        self.id = id or uuid.uuid4().hex[:12]
+        self.name = name
+        self.created_at = created_at or datetime.now().isoformat(timespec="seconds")
+        self.variants = [
+            {
+                "name": v["name"],
+                "system_prompt": v.get("system_prompt") or "",
+                "model": v.get("model") or "",
+                "weight": float(v.get("weight", 1)),
+            }
+            for v in variants
+        ]
+        self._validate()
+
+    def _validate(self) -> None:
+        names = [v["name"] for v in self.variants]
+        if len(names) < 2:
+            raise ValueError("an experiment needs at least 2 variants")
+        if len(set(names)) != len(names) or not all(names):
+            raise ValueError("variant names must be unique and non-empty")
+        if any(v["weight"] < 0 for v in self.variants) or not sum(v["weight"] for v in self.variants):
+            raise ValueError("weights must be >= 0 and not all 0")
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Experiment":
+        return cls(data["name"], data["variants"], id=data.get("id", ""), created_at=data.get("created_at", ""))
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "name": self.name, "created_at": self.created_at, "variants": self.variants}
+
+    def shares(self) -> dict[str, float]:
+        """Traffic share per variant (weights normalized)."""
+        total = sum(v["weight"] for v in self.variants)
+        return {v["name"]: round(v["weight"] / total, 4) for v in self.variants}
+
+    def set_weights(self, weights: dict[str, float]) -> None:
+        """Ramp: new weights for some or all variants."""
+        unknown = set(weights) - {v["name"] for v in self.variants}
+        if unknown:
+            raise ValueError(f"unknown variants: {sorted(unknown)}")
+        previous = [v["weight"] for v in self.variants]
+        for v in self.variants:
+            v["weight"] = float(weights.get(v["name"], v["weight"]))
+        try:
+            self._validate()
+        except ValueError:
+            for v, w in zip(self.variants, previous):
+                v["weight"] = w
+            raise
+
+    def assign(self, key: str) -> dict:
+        """The variant for a phone number (or session id when there is none)."""
+        digest = hashlib.sha256(f"{self.id}:{key}".encode("utf-8")).hexdigest()
+        point = int(digest[:8], 16) / 0x100000000 * sum(v["weight"] for v in self.variants)
+        for v in self.variants:
+            point -= v["weight"]
+            if point < 0:
+                return v
+        return next(v for v in reversed(self.variants) if v["weight"])
+
+    def overrides(self, variant: dict) -> dict:
+        """Evaluator.run_all(variant=...) argument for a variant."""
+        return {
+            "key": f"{self.id}/{variant['name']}",
+            "system_prompt": variant["system_prompt"] or None,
+            "model": variant["model"] or None,
+        }
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+
+class ExperimentLog:
+    def __init__(self, db_path: str = "data/experiments.db"):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()  # connection
+        self._buffer_lock = threading.Lock()
+        self._buffer: list[tuple] = []
+
+    def record_turn(
+        self,
+        tenant: str,
+        experiment: str,
+        variant: str,
+        session_id: str,
+        latency_ms: float,
+        token_usage: dict | None,
+        handoff: bool,
+        ok: bool = True,
+    ) -> None:
+        usage = token_usage or {}
+        prompt = usage.get("prompt_tokens") or 0
+        completion = usage.get("completion_tokens") or 0
+        with self._buffer_lock:
+            self._buffer.append((
+                time.time(), tenant, experiment, variant, session_id, round(latency_ms, 1),
+                prompt, completion, usage.get("total_tokens") or prompt + completion, int(handoff), int(ok),
+            ))
+
+    def flush(self) -> int:
+        with self._buffer_lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            with self._lock:
+                self._conn.executemany(
+                    f"INSERT INTO experiment_turns ({', '.join(TURN_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(TURN_COLUMNS))})",
+                    rows,
+                )
+        return len(rows)
+
+    def record_eval(self, tenant: str, experiment: str, variant: str, report: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO experiment_evals (ts, tenant, experiment, variant, run_id, total, passed, judge_score_mean) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), tenant, experiment, variant, report.get("run_id", ""),
+                 report["total"], report["passed"], report.get("judge_score_mean")),
+            )
+
+    def metrics(self, tenant: str, experiment: str) -> dict[str, dict]:
+        """Per variant: sessions, turns, latency, tokens, handoff rate and the latest eval run."""
+        self.flush()
+        with self._lock:
+            turns = self._conn.execute(
+                "SELECT variant, session_id, latency_ms, prompt_tokens, completion_tokens, total_tokens, handoff, ok "
+                "FROM experiment_turns WHERE tenant = ? AND experiment = ?",
+                (tenant, experiment),
+            ).fetchall()
+            evals = self._conn.execute(
+                "SELECT variant, ts, run_id, total, passed, judge_score_mean FROM experiment_evals "
+                "WHERE tenant = ? AND experiment = ? ORDER BY id",
+                (tenant, experiment),
+            ).fetchall()
+
+        by_variant: dict[str, list[tuple]] = {}
+        for row in turns:
+            by_variant.setdefault(row[0], []).append(row)
+        out = {}
+        for variant, rows in by_variant.items():
+            ok_rows = [r for r in rows if r[7]]
+            latencies = [r[2] for r in ok_rows]
+            sessions = {r[1] for r in rows}
+            handoff_sessions = {r[1] for r in rows if r[6]}
+            out[variant] = {
+                "sessions": len(sessions),
+                "turns": len(rows),
+                "errors": len(rows) - len(ok_rows),
+                "latency_ms_p50": _percentile(latencies, 0.5),
+                "latency_ms_p95": _percentile(latencies, 0.95),
+                "prompt_tokens_mean": round(statistics.mean(r[3] for r in ok_rows), 1) if ok_rows else None,
+                "completion_tokens_mean": round(statistics.mean(r[4] for r in ok_rows), 1) if ok_rows else None,
+                "total_tokens_mean": round(statistics.mean(r[5] for r in ok_rows), 1) if ok_rows else None,
+                "handoff_rate": round(len(handoff_sessions) / len(sessions), 4),
+                "eval": None,
+            }
+        for variant, ts, run_id, total, passed, judge_mean in evals:
+            entry = out.setdefault(variant, {"sessions": 0, "turns": 0, "eval": None})
+            entry["eval"] = {  # latest run wins
+                "at": datetime.fromtimestamp(ts).isoformat(timespec="seconds"),
+                "run_id": run_id,
+                "total": total,
+                "passed": passed,
+                "pass_rate": round(passed / total, 4) if total else None,
+                "judge_score_mean": judge_mean,
+            }
+        return out
@@ -2,18 +2,19 @@
 
 import re
 
-from app.images import get_image_by_title, get_image_url
+from app.images import ImageRegistry, default_registry
 
 IMAGE_MARKER_RE = re.compile(r"\[IMAGEN:\s*([^\]]+)\]", re.IGNORECASE)
 
 
-def process_reply(raw_reply: str) -> dict:
-    """Parse image markers from agent reply and resolve to URLs.
+def process_reply(raw_reply: str, registry: ImageRegistry | None = None) -> dict:
+    """Parse image markers from agent reply and resolve to URLs (in the tenant's registry).
 
     Returns:
         {
             "text": "clean text without markers",
-            "images": [{"title": ..., "url": "/images/...", "filename": ...}],
+            "images": [{"title": ..., "url": "/images/...", "filename": ...,
+                        "webp_url": ..., "thumb_url": ..., "full_url": ...}],
             "unresolved_images": ["title that didn't match"],
             "raw_reply": "original text with markers",
         }
@@ -28,19 +29,24 @@ def process_reply(raw_reply: str) -> dict:
             "raw_reply": raw_reply,
         }
 
+    registry = registry or default_registry
     images = []
     unresolved = []
     seen_ids = set()
 
     for title in matches:
         title = title.strip()
-        entry = get_image_by_title(title)
+        entry = registry.get_image_by_title(title)
         if entry and entry["id"] not in seen_ids:
             seen_ids.add(entry["id"])
+            # url = medium JPEG (every channel accepts it); webp_url for browsers
             images.append({
                 "title": entry["title"],
-                "url": get_image_url(entry),
+                "url": registry.get_image_url(entry),
                 "filename": entry["filename"],
+                "webp_url": registry.get_image_url(entry, fmt="webp"),
+                "thumb_url": registry.get_image_url(entry, size="thumb", fmt="webp"),
+                "full_url": registry.get_image_url(entry, size="large"),
             })
         elif not entry:
             unresolved.append(title)
@@ -1,16 +1,48 @@
-"""Image registry: filesystem + JSON for product images."""
+"""Image registry: filesystem + JSON for product images.
 
+Each tenant has its own ImageRegistry (root dir + URL prefix); the module-level
+functions operate on the default tenant's registry under data/images.
+
+registry.json is the source of truth, but reads are served from an in-memory copy
+with a slug index, a token inverted index and a character n-gram index (partial
+matches inside a word). The file is re-read only when its mtime changes (checked
+at most every RELOAD_CHECK_SECONDS), so resolving the [IMAGEN: ...] markers of a
+reply does no disk I/O. Resolved markers are kept in a bounded LRU.
+
+On upload each image also gets resized WebP + JPEG derivatives under data/images/v/
+with content-hashed filenames, so they can be cached forever by clients.
+"""
+
+import hashlib
+import io
 import json
+import logging
 import os
 import re
+import tempfile
+import threading
+import time
 import unicodedata
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 
 
+logger = logging.getLogger("app.images")
+
 IMAGES_DIR = Path("data/images")
-REGISTRY_PATH = IMAGES_DIR / "registry.json"
+VARIANTS_DIR = IMAGES_DIR / "v"
+RELOAD_CHECK_SECONDS = 2.0
+LOOKUP_CACHE_SIZE = 1024  # resolved [IMAGEN: ...] markers (free-form LLM text)
+NGRAM_MAX = 3
+
+# Derivatives: name -> max side in px (never upscaled). "medium" is what chats show.
+VARIANT_SIZES = {"large": 1600, "medium": 800, "thumb": 240}
+VARIANT_FORMATS = {
+    "webp": ("WEBP", ".webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", ".jpg", {"quality": 82, "optimize": True, "progressive": True}),
+}
 
 
 def _slugify(text: str) -> str:
@@ -24,110 +56,291 @@ def _slugify(text: str) -> str:
     return text.strip("-")
 
 
-def _load_registry() -> list[dict]:
-    if not REGISTRY_PATH.exists():
-        return []
-    with open(REGISTRY_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-
-def _save_registry(entries: list[dict]):
-    IMAGES_DIR.mkdir(parents=True, exist_ok=True)
-    with open(REGISTRY_PATH, "w", encoding="utf-8") as f:
-        json.dump(entries, f, ensure_ascii=False, indent=2)
-
-
-def add_image(
-    file_bytes: bytes,
-    original_filename: str,
-    title: str,
-    description: str = "",
-    tags: str = "",
-) -> dict:
-    """Save image file and add entry to registry. Returns the new entry."""
-    IMAGES_DIR.mkdir(parents=True, exist_ok=True)
-
-    image_id = str(uuid.uuid4())[:8]
-    slug = _slugify(title)
-    ext = Path(original_filename).suffix.lower() or ".jpg"
-    filename = f"{slug}-{image_id}{ext}"
-
-    filepath = IMAGES_DIR / filename
-    filepath.write_bytes(file_bytes)
-
-    entry = {
-        "id": image_id,
-        "title": title,
-        "slug": slug,
-        "description": description,
-        "tags": tags,
-        "filename": filename,
-        "created_at": datetime.now().isoformat(),
-    }
-
-    registry = _load_registry()
-    registry.append(entry)
-    _save_registry(registry)
-
-    return entry
-
-
-def list_images() -> list[dict]:
-    return _load_registry()
-
-
-def get_image_by_title(title: str) -> dict | None:
-    """Fuzzy match by slug: exact match first, then partial/contains."""
-    registry = _load_registry()
-    if not registry:
-        return None
-
-    query_slug = _slugify(title)
-    if not query_slug:
-        return None
-
-    # Exact slug match
-    for entry in registry:
-        if entry["slug"] == query_slug:
-            return entry
-
-    # Partial match: query contained in slug or slug contained in query
-    for entry in registry:
-        if query_slug in entry["slug"] or entry["slug"] in query_slug:
+def _ngrams(text: str) -> set[str]:
+    """Every substring of up to NGRAM_MAX characters."""
+    return {text[i:i + n] for n in range(1, NGRAM_MAX + 1) for i in range(len(text) - n + 1)}
+
+
+class _RegistryCache:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.mtime: float | None = None
+        self.checked_at = 0.0
+        self.entries: list[dict] = []
+        self.by_id: dict[str, dict] = {}
+        self.by_slug: dict[str, int] = {}  # slug -> position in entries
+        self.by_token: dict[str, list[int]] = {}  # token -> positions in entries
+        self.by_ngram: dict[str, set[int]] = {}  # character n-gram -> positions in entries
+        self.lookups: OrderedDict[str, dict | None] = OrderedDict()  # query slug -> resolved entry (LRU)
+
+    def set(self, entries: list[dict], mtime: float | None) -> None:
+        with self.lock:
+            self.entries = entries
+            self.mtime = mtime
+            self.checked_at = time.monotonic()
+            self.by_id = {e["id"]: e for e in entries}
+            self.by_slug = {}
+            self.by_token = {}
+            self.by_ngram = {}
+            for pos, e in enumerate(entries):
+                # First entry wins, like the old linear scan
+                self.by_slug.setdefault(e["slug"], pos)
+                for token in set(e["slug"].split("-")):
+                    self.by_token.setdefault(token, []).append(pos)
+                for gram in _ngrams(e["slug"]):
+                    self.by_ngram.setdefault(gram, set()).add(pos)
+            self.lookups = OrderedDict()
+
+
+def _variant_files(entry: dict) -> set[str]:
+    return {rel for formats in entry.get("variants", {}).values() for rel in formats.values()}
+
+
+class ImageRegistry:
+    """Images of one tenant: files + registry.json under `root`, served under `url_prefix`."""
+
+    def __init__(self, root: Path = IMAGES_DIR, url_prefix: str = "/images"):
+        self.root = Path(root)
+        self.registry_path = self.root / "registry.json"
+        self.variants_dir = self.root / VARIANTS_DIR.name
+        self.url_prefix = url_prefix.rstrip("/")
+        self._cache = _RegistryCache()
+        # Serializes load-modify-save cycles (concurrent uploads/deletes)
+        self._write_lock = threading.Lock()
+
+    def _registry_mtime(self) -> float | None:
+        try:
+            return self.registry_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _load_registry(self, force: bool = False) -> list[dict]:
+        """Cached registry entries; re-reads registry.json only if it changed on disk."""
+        cache = self._cache
+        now = time.monotonic()
+        if not force and cache.mtime is not None and now - cache.checked_at < RELOAD_CHECK_SECONDS:
+            return cache.entries
+        with cache.lock:
+            mtime = self._registry_mtime()
+            if mtime is None:
+                cache.set([], None)
+            elif mtime != cache.mtime:
+                with open(self.registry_path, "r", encoding="utf-8") as f:
+                    cache.set(json.load(f), mtime)
+            else:
+                cache.checked_at = now
+            return cache.entries
+
+    def _save_registry(self, entries: list[dict]):
+        """Atomic write (temp file + rename) and cache refresh."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".registry-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.registry_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._cache.set(entries, self._registry_mtime())
+
+    def _build_variants(self, file_bytes: bytes, slug: str) -> dict:
+        """Write resized WebP/JPEG derivatives. Returns {size: {format: relative path}}."""
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            logger.warning("Pillow not installed; serving original images only")
+            return {}
+
+        try:
+            img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes)))
+            img.load()
+        except Exception as e:
+            logger.warning("could not decode image %s: %s", slug, e)
+            return {}
+
+        if img.mode in ("RGBA", "LA", "P"):
+            # JPEG has no alpha: flatten onto white
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[-1])
+        else:
+            img = img.convert("RGB")
+
+        digest = hashlib.sha256(file_bytes).hexdigest()[:12]
+        self.variants_dir.mkdir(parents=True, exist_ok=True)
+        variants = {}
+        for size, max_side in VARIANT_SIZES.items():
+            resized = img.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+            variants[size] = {}
+            for fmt, (pil_format, ext, options) in VARIANT_FORMATS.items():
+                name = f"{slug}-{digest}-{size}{ext}"
+                path = self.variants_dir / name
+                if not path.exists():
+                    resized.save(path, pil_format, **options)
+                variants[size][fmt] = f"{self.variants_dir.name}/{name}"
+        return variants
+
+    def add_image(
+        self,
+        file_bytes: bytes,
+        original_filename: str,
+        title: str,
+        description: str = "",
+        tags: str = "",
+    ) -> dict:
+        """Save image file and add entry to registry. Returns the new entry."""
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        image_id = str(uuid.uuid4())[:8]
+        slug = _slugify(title)
+        ext = Path(original_filename).suffix.lower() or ".jpg"
+        filename = f"{slug}-{image_id}{ext}"
+
+        filepath = self.root / filename
+        filepath.write_bytes(file_bytes)
+
+        entry = {
+            "id": image_id,
+            "title": title,
+            "slug": slug,
+            "description": description,
+            "tags": tags,
+            "filename": filename,
+            "variants": self._build_variants(file_bytes, slug),
+            "created_at": datetime.now().isoformat(),
+        }
+
+        with self._write_lock:
+            registry = list(self._load_registry(force=True))
+            registry.append(entry)
+            self._save_registry(registry)
+
+        # Copy: callers annotate the returned dict (e.g. rag_doc_id) without touching the cache
+        return dict(entry)
+
+    def list_images(self) -> list[dict]:
+        return list(self._load_registry())
+
+    def get_image_by_title(self, title: str) -> dict | None:
+        """Fuzzy match by slug: exact match first, then partial/contains, then word overlap."""
+        registry = self._load_registry()
+        if not registry:
+            return None
+
+        query_slug = _slugify(title)
+        if not query_slug:
+            return None
+
+        lookups = self._cache.lookups
+        with self._cache.lock:
+            if query_slug in lookups:
+                lookups.move_to_end(query_slug)
+                return lookups[query_slug]
+            entry = self._match(query_slug)
+            lookups[query_slug] = entry
+            if len(lookups) > LOOKUP_CACHE_SIZE:
+                lookups.popitem(last=False)
             return entry
 
-    # Word overlap: at least one word matches
-    query_words = set(query_slug.split("-"))
-    best = None
-    best_overlap = 0
-    for entry in registry:
-        entry_words = set(entry["slug"].split("-"))
-        overlap = len(query_words & entry_words)
-        if overlap > best_overlap:
-            best_overlap = overlap
-            best = entry
-
-    return best if best_overlap > 0 else None
-
-
-def get_image_url(entry: dict) -> str:
-    return f"/images/{entry['filename']}"
-
-
-def delete_image(image_id: str) -> dict | None:
-    """Delete image file and registry entry. Returns deleted entry or None."""
-    registry = _load_registry()
-    entry = next((e for e in registry if e["id"] == image_id), None)
-    if not entry:
-        return None
-
-    # Remove file
-    filepath = IMAGES_DIR / entry["filename"]
-    if filepath.exists():
-        filepath.unlink()
-
-    # Remove from registry
-    registry = [e for e in registry if e["id"] != image_id]
-    _save_registry(registry)
-
-    return entry
+    def _match(self, query_slug: str) -> dict | None:
+        cache = self._cache
+        # Exact slug match — O(1)
+        pos = cache.by_slug.get(query_slug)
+        if pos is not None:
+            return cache.entries[pos]
+
+        # Candidates sharing at least one word with the query, in registry order
+        query_words = set(query_slug.split("-"))
+        overlaps: dict[int, int] = {}
+        for word in query_words:
+            for pos in cache.by_token.get(word, ()):
+                overlaps[pos] = overlaps.get(pos, 0) + 1
+
+        # Partial match: query contained in slug or slug contained in query. Sharing a
+        # word first, then any (e.g. "inyect" inside "inyectable"), earliest entry wins.
+        partial = self._partial_matches(query_slug)
+        if partial:
+            return cache.entries[min(partial & overlaps.keys() or partial)]
+        if not overlaps:
+            return None
+
+        # Word overlap: most shared words, earliest entry on ties
+        best_pos = max(overlaps, key=lambda pos: (overlaps[pos], -pos))
+        return cache.entries[best_pos]
+
+    def _partial_matches(self, query_slug: str) -> set[int]:
+        """Positions whose slug contains the query or is contained in it, from the indexes."""
+        cache = self._cache
+        # Slug contains the query: every n-gram of the query is in the slug (then verified)
+        postings = sorted((cache.by_ngram.get(g, set()) for g in _ngrams(query_slug)), key=len)
+        found = set(postings[0]).intersection(*postings[1:]) if postings else set()
+        found = {pos for pos in found if query_slug in cache.entries[pos]["slug"]}
+        # Query contains the slug: the slug is one of the query's substrings
+        k = len(query_slug)
+        for i in range(k):
+            for j in range(i + 1, k + 1):
+                pos = cache.by_slug.get(query_slug[i:j])
+                if pos is not None:
+                    found.add(pos)
+        return found
+
+    def get_image_url(self, entry: dict, size: str = "medium", fmt: str = "jpeg") -> str:
+        """URL of a derivative, falling back to the original when it has none."""
+        rel = entry.get("variants", {}).get(size, {}).get(fmt)
+        return f"{self.url_prefix}/{rel or entry['filename']}"
+
+    def backfill_variants(self) -> int:
+        """Generate derivatives for entries uploaded before they existed. Returns count."""
+        with self._write_lock:
+            registry = [dict(e) for e in self._load_registry(force=True)]
+            updated = 0
+            for entry in registry:
+                if entry.get("variants"):
+                    continue
+                original = self.root / entry["filename"]
+                if not original.exists():
+                    continue
+                variants = self._build_variants(original.read_bytes(), entry["slug"])
+                if variants:
+                    entry["variants"] = variants
+                    updated += 1
+            if updated:
+                self._save_registry(registry)
+        return updated
+
+    def delete_image(self, image_id: str) -> dict | None:
+        """Delete image file and registry entry. Returns deleted entry or None."""
+        with self._write_lock:
+            registry = self._load_registry(force=True)
+            entry = self._cache.by_id.get(image_id)
+            if not entry:
+                return None
+
+            # Remove from registry first so a failed unlink never leaves a dangling entry
+            self._save_registry([e for e in registry if e["id"] != image_id])
+
+            # Same bytes + same title share derivative files; keep them if still referenced
+            still_used = set().union(*(_variant_files(e) for e in registry if e["id"] != image_id))
+
+        for rel in [entry["filename"], *(_variant_files(entry) - still_used)]:
+            filepath = self.root / rel
+            if filepath.exists():
+                filepath.unlink()
+
+        return entry
+
+
+# The default tenant's registry (data/images), also exposed as module functions
+default_registry = ImageRegistry()
+
+add_image = default_registry.add_image
+list_images = default_registry.list_images
+get_image_by_title = default_registry.get_image_by_title
+get_image_url = default_registry.get_image_url
+backfill_variants = default_registry.backfill_variants
+delete_image = default_registry.delete_image
@@ -1,9 +1,5 @@
 import re
 
-import httpx
-
-from app.agent import OPENROUTER_URL
-
 
 class Introspector:
     """Analyses agent responses citing concrete evidence (RAG chunks, prompt sections)
@@ -12,6 +8,14 @@ class Introspector:
     def __init__(self, agent, knowledge_base):
         self.agent = agent
         self.kb = knowledge_base
+        self._docs: tuple[int, list[dict]] = (-1, [])
+
+    def _documents(self) -> list[dict]:
+        """kb.list_documents(), reused while the KB is unchanged (batch jobs build many prompts)."""
+        version = getattr(self.kb, "version", None)
+        if version is None or self._docs[0] != version:
+            self._docs = (version if version is not None else -1, self.kb.list_documents())
+        return self._docs[1]
 
     async def ask(self, debug_snapshot: dict, history: list[dict], question: str) -> dict:
         meta_prompt = self._build_meta_prompt(debug_snapshot)
@@ -25,6 +29,13 @@ class Introspector:
 
         return {"answer": answer, "actions": actions}
 
+    async def diagnose(self, debug_snapshot: dict, question: str) -> dict:
+        """One-shot analysis for batch jobs: the answer's "CAUSA:" line is returned apart."""
+        result = await self.ask(debug_snapshot, [], question)
+        match = self.CAUSE_RE.search(result["answer"])
+        cause = (match.group(1) if match else result["answer"].split("\n", 1)[0]).strip(" *")
+        return {"cause": cause, **result}
+
     # ------------------------------------------------------------------
     # Meta-prompt
     # ------------------------------------------------------------------
@@ -57,7 +68,7 @@ class Introspector:
             )
 
         # Build available docs list for actions
-        docs = self.kb.list_documents()
+        docs = self._documents()
         docs_text = ""
         for d in docs:
             docs_text += (
@@ -107,27 +118,19 @@ Modelo: {snap.get('model', '?')} | Temp: {snap.get('temperature', '?')} | Tokens
 6. Se conciso: causa raiz en 2-3 oraciones, despues acciones concretas."""
 
     # ------------------------------------------------------------------
-    # LLM call (same pattern as evaluator._llm_judge)
+    # LLM call (through the agent: usage ledger + budgets, like evaluator._llm_judge)
     # ------------------------------------------------------------------
 
     async def _call_llm(self, messages: list[dict]) -> str:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                OPENROUTER_URL,
-                headers={
-                    "Authorization": f"Bearer {self.agent.api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": self.agent.model,
-                    "messages": messages,
-                    "temperature": 0.3,
-                    "max_tokens": 1000,
-                },
-            )
-            response.raise_for_status()
-            data = response.json()
-
+        data = await self.agent.complete(
+            {
+                "model": self.agent.model,
+                "messages": messages,
+                "temperature": 0.3,
+                "max_tokens": 1000,
+            },
+            caller="introspect",
+        )
         return data["choices"][0]["message"]["content"].strip()
 
     # ------------------------------------------------------------------
@@ -136,6 +139,7 @@ Modelo: {snap.get('model', '?')} | Temp: {snap.get('temperature', '?')} | Tokens
 
     # Format: ACTION:type:label:params  (label has no colons, params can have anything)
     ACTION_RE = re.compile(r"^ACTION:(\w+):([^:]+):(.+)$", re.MULTILINE)
+    CAUSE_RE = re.compile(r"^\W*CAUSA\W*:\s*(.+)$", re.MULTILINE | re.IGNORECASE)
 
     def _parse_actions(self, raw: str) -> tuple[str, list[dict]]:
         actions = []
@@ -169,7 +173,7 @@ Modelo: {snap.get('model', '?')} | Temp: {snap.get('temperature', '?')} | Tokens
         return clean, actions
 
     def _validate_actions(self, actions: list[dict]) -> list[dict]:
-        valid_doc_ids = {d["id"] for d in self.kb.list_documents()}
+        valid_doc_ids = {d["id"] for d in self._documents()}
         validated = []
         for action in actions:
             if action["type"] in ("delete_rag_doc", "update_rag_priority"):
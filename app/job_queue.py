@@ -0,0 +1,129 @@
+"""Durable inbound message queue (SQLite) for the WhatsApp webhook.
+
+The webhook only inserts rows and returns; workers claim them later. The provider
+message id is UNIQUE, so webhook retries/redeliveries are dropped at insert time.
+A phone number is never claimed while another of its messages is in flight, which
+keeps each customer's messages in order across workers.
+
+A job stays "processing" until its reply is delivered. The generated reply is
+stored on the job first (save_reply), so after a crash the job is re-delivered
+from it instead of running the chat pipeline again.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbound (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider_msg_id TEXT NOT NULL UNIQUE,
+    phone TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',  -- pending | processing | done | failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT NOT NULL DEFAULT '',
+    reply TEXT,  -- JSON outbound parts, once generated
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_inbound_status ON inbound (status, id);
+"""
+
+
+class JobQueue:
+    def __init__(self, db_path: str = "data/queue.db"):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(inbound)")}
+        if "reply" not in columns:  # queue.db from before replies were stored
+            self._conn.execute("ALTER TABLE inbound ADD COLUMN reply TEXT")
+        self._lock = threading.Lock()
+        # Jobs left "processing" by a crash go back to the queue
+        with self._lock:
+            self._conn.execute("UPDATE inbound SET status = 'pending' WHERE status = 'processing'")
+
+    def enqueue(self, provider_msg_id: str, phone: str, payload: dict) -> bool:
+        """Insert a job. Returns False if this provider message id was already queued."""
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO inbound (provider_msg_id, phone, payload, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (provider_msg_id, phone, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            return cur.rowcount == 1
+
+    def claim(self) -> dict | None:
+        """Take the oldest pending job whose phone has nothing in flight."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, provider_msg_id, phone, payload, attempts, reply FROM inbound "
+                    "WHERE status = 'pending' AND phone NOT IN "
+                    "(SELECT phone FROM inbound WHERE status = 'processing') "
+                    "ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE inbound SET status = 'processing', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (time.time(), row[0]),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {
+            "id": row[0],
+            "provider_msg_id": row[1],
+            "phone": row[2],
+            "payload": json.loads(row[3]),
+            "attempts": row[4] + 1,
+            "reply": json.loads(row[5]) if row[5] is not None else None,
+        }
+
+    def save_reply(self, job_id: int, parts: list[dict]) -> None:
+        """Store the generated reply: a retry after a crash only re-delivers it."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE inbound SET reply = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(parts, ensure_ascii=False), time.time(), job_id),
+            )
+
+    def complete(self, job_id: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE inbound SET status = 'done', error = '', updated_at = ? WHERE id = ?",
+                (time.time(), job_id),
+            )
+
+    def fail(self, job_id: int, attempts: int, error: str) -> None:
+        """Put the job back in the queue, or mark it failed after MAX_ATTEMPTS."""
+        status = "failed" if attempts >= MAX_ATTEMPTS else "pending"
+        with self._lock:
+            self._conn.execute(
+                "UPDATE inbound SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error[:500], time.time(), job_id),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM inbound GROUP BY status").fetchall()
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM inbound WHERE status = 'pending'"
+            ).fetchone()[0]
+        counts = {"pending": 0, "processing": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        counts["oldest_pending_age_s"] = round(time.time() - oldest, 1) if oldest else 0
+        return counts
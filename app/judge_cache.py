@@ -0,0 +1,67 @@
+"""LLM-judge results cached in SQLite, so re-running the suite doesn't re-judge unchanged replies.
+
+Key: (judge model, hash of the reply, hash of what the case expects: user message +
+expected behaviors, plus JUDGE_VERSION so a change to the judge prompt starts over).
+Only real scores are stored: judge errors and budget skips are judged again next time.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+JUDGE_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS judge_results (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    reason TEXT NOT NULL,
+    ts REAL NOT NULL
+);
+"""
+
+
+def _sha(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def judge_key(model: str, test_case: dict, reply: str) -> str:
+    expected = "\n".join([test_case.get("user_message", ""), *test_case.get("expected_behaviors", [])])
+    return _sha(f"{JUDGE_VERSION}\0{model}\0{_sha(reply)}\0{_sha(expected)}")
+
+
+class JudgeCache:
+    def __init__(self, db_path: str = "data/judge_cache.db"):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT score, reason FROM judge_results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"score": row[0], "reason": row[1], "cached": True}
+
+    def put(self, key: str, model: str, result: dict) -> None:
+        if not result.get("score"):
+            return  # None (budget skip) / 0 (error)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO judge_results (key, model, score, reason, ts) VALUES (?, ?, ?, ?, ?)",
+                (key, model, result["score"], result.get("reason", ""), time.time()),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM judge_results").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
@@ -1,18 +1,106 @@
 import uuid
+import functools
+import hashlib
+import json
+import logging
+import os
+import pickle
 import re
+import shutil
+import sqlite3
+import threading
+import time
 from datetime import datetime
+from pathlib import Path
 
-import fitz  # PyMuPDF
 import chromadb
+import numpy as np
+
+from app.context_packer import estimate_tokens, merge_adjacent, mmr_select, truncate_to_tokens
+from app.embeddings import build_embedder
+
+logger = logging.getLogger(__name__)
+
+# Parámetros del índice HNSW de Chroma (ver config.yaml knowledge.hnsw). Se fijan al
+# crear la colección; para cambiarlos en una existente hace falta rebuild()
+HNSW_PARAMS = ("M", "construction_ef", "search_ef")
+REBUILD_PAGE_SIZE = 500
+
+# Snapshots: <collection>-<content hash>.npz, restorable without re-embedding
+SNAPSHOT_DIR = "data/snapshots"
+SNAPSHOT_FORMAT = 1
+
+
+# One client per store: tenants' collections live in the same data/chroma, and two
+# clients opening the same path at once race on Chroma's sqlite migrations
+_clients: dict[str, chromadb.ClientAPI] = {}
+_clients_lock = threading.Lock()
+
+
+def _client_for(persist_dir: str):
+    with _clients_lock:
+        if persist_dir not in _clients:
+            _clients[persist_dir] = chromadb.PersistentClient(path=persist_dir)
+        return _clients[persist_dir]
+
+
+def _retry_after_swap(method):
+    """Reads that picked up self.collection right before _swap_in dropped it fail with
+    a missing-collection error: run them once more against the new collection."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        collection = self.collection
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            if self.collection is collection:
+                raise
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class KnowledgeBase:
-    def __init__(self, persist_dir: str = "data/chroma"):
-        self.client = chromadb.PersistentClient(path=persist_dir)
+    def __init__(
+        self,
+        persist_dir: str = "data/chroma",
+        embedding: dict | None = None,
+        collection_name: str = "knowledge",
+        embedder=None,
+        hnsw: dict | None = None,
+    ):
+        self.persist_dir = persist_dir
+        self.collection_name = collection_name
+        self.hnsw = {k: int(v) for k, v in (hnsw or {}).items() if k in HNSW_PARAMS}
+        self.client = _client_for(persist_dir)
+        # Embeds ingestion in batches of embedding.batch_size (Chroma passes the whole
+        # document list to the embedding function in one call). Tenants with the same
+        # embedding settings pass a shared embedder so the model is loaded once.
+        self.embedder = embedder or build_embedder(embedding)
+        # True when the collection didn't exist in persist_dir (fresh node or new tenant)
+        self.created = not self._recover_swap()
         self.collection = self.client.get_or_create_collection(
-            name="knowledge",
-            metadata={"hnsw:space": "cosine"},
+            name=collection_name,
+            metadata=self._collection_metadata(self.hnsw),
+            embedding_function=self.embedder,
         )
+        # Bumped on every change to the collection; cached retrieval results are
+        # only reused while it's unchanged (app.retrieval)
+        self.version = 0
+        # Writers vs rebuild(): chunks added while the index is copied would be lost
+        self._write_lock = threading.RLock()
+        self.restored_snapshot: dict | None = None  # set by import_snapshot()
+        self._categories: tuple[int, set[str]] = (-1, set())
+        if self.pending_hnsw():
+            logger.warning("collection %s was built with other HNSW params %s; run a rebuild to apply %s",
+                           collection_name, self.current_hnsw(), self.hnsw)
+
+    @staticmethod
+    def _collection_metadata(hnsw: dict) -> dict:
+        return {"hnsw:space": "cosine", **{f"hnsw:{k}": v for k, v in hnsw.items()}}
+
+    def warmup(self) -> float:
+        """Load the embedding model so the first customer query doesn't pay for it."""
+        return self.embedder.warmup()
 
     def _chunk_text(self, text: str, max_chars: int = 500) -> list[str]:
         """Split text into chunks by paragraphs, respecting max_chars."""
@@ -52,6 +140,8 @@ class KnowledgeBase:
 
     def add_pdf(self, file_bytes: bytes, filename: str) -> dict:
         """Extract text from PDF and index it."""
+        import fitz  # PyMuPDF — imported on first PDF, it's slow to load
+
         doc = fitz.open(stream=file_bytes, filetype="pdf")
         full_text = ""
         for page in doc:
@@ -101,7 +191,9 @@ class KnowledgeBase:
             })
 
         if ids:
-            self.collection.add(ids=ids, documents=documents, metadatas=metadatas)
+            with self._write_lock:
+                self.collection.add(ids=ids, documents=documents, metadatas=metadatas)
+                self.version += 1
 
         return {
             "id": doc_id,
@@ -135,7 +227,9 @@ class KnowledgeBase:
             })
 
         if ids:
-            self.collection.add(ids=ids, documents=documents, metadatas=metadatas)
+            with self._write_lock:
+                self.collection.add(ids=ids, documents=documents, metadatas=metadatas)
+                self.version += 1
 
         return {
             "id": doc_id,
@@ -145,6 +239,7 @@ class KnowledgeBase:
             "created_at": datetime.now().isoformat(),
         }
 
+    @_retry_after_swap
     def search(self, query: str, n_results: int = 5) -> list[str]:
         """Search for relevant chunks."""
         if self.collection.count() == 0:
@@ -154,53 +249,110 @@ class KnowledgeBase:
         results = self.collection.query(query_texts=[query], n_results=n)
         return results["documents"][0] if results["documents"] else []
 
-    def search_with_debug(self, query: str, n_results: int = 5) -> dict:
-        """Search for relevant chunks with priority re-ranking."""
-        if self.collection.count() == 0:
-            return {"chunks": [], "debug": []}
-
-        # Fetch double, then re-rank by priority-weighted score
-        fetch_n = min(n_results * 2, self.collection.count())
-        results = self.collection.query(
-            query_texts=[query],
-            n_results=fetch_n,
-            include=["documents", "metadatas", "distances"],
-        )
+    @_retry_after_swap
+    def search_with_debug(self, query: str, n_results: int = 5,
+                          fetch_factor: int = 2, priority_weight: float = 0.1,
+                          token_budget: int = 0, candidates: int = 20, mmr_lambda: float = 0.7,
+                          categories: list[str] | None = None, category_filter: bool = True,
+                          category_weight: float = 0.0, fallback_similarity: float = 0.3) -> dict:
+        """Search for relevant chunks with priority re-ranking.
+
+        token_budget = 0: the n_results best by score.
+        token_budget > 0: MMR over `candidates` chunks, packed up to token_budget with
+        adjacent chunks merged (app.context_packer); n_results is ignored.
+        score = similarity * (1 + priority_weight * priority) + category_weight if the
+        chunk is in one of `categories` (app.category_router).
+        category_filter: search only those categories (Chroma `where`); if that finds
+        nothing with similarity >= fallback_similarity, the whole collection is searched.
+        fetch_factor and priority_weight are exposed for the retrieval evaluation.
+        """
+        count = self.collection.count()
+        if count == 0:
+            return {"chunks": [], "debug": [], "categories": []}
+
+        # Fetch n_results * fetch_factor (or the MMR candidates), then re-rank by score
+        packing = token_budget > 0
+        fetch_n = min(candidates if packing else n_results * max(1, fetch_factor), count)
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if packing else [])
+        routed = [c for c in categories or [] if c in self.categories()]
+        query_embeddings = self.embedder([query])
+
+        results = None
+        if routed and category_filter:
+            where = {"category": routed[0]} if len(routed) == 1 else {"category": {"$in": routed}}
+            results = self.collection.query(query_embeddings=query_embeddings, n_results=fetch_n,
+                                            where=where, include=include)
+            distances = results["distances"][0] if results.get("distances") else []
+            if not distances or 1 - min(distances) < fallback_similarity:
+                results = None
+        filtered = results is not None
+        if results is None:
+            results = self.collection.query(query_embeddings=query_embeddings, n_results=fetch_n, include=include)
 
         chunks = results["documents"][0] if results["documents"] else []
         metadatas = results["metadatas"][0] if results.get("metadatas") else []
         distances = results["distances"][0] if results.get("distances") else []
-
-        # Build scored entries and re-rank
-        entries = []
-        for i, chunk_text in enumerate(chunks):
-            meta = metadatas[i] if i < len(metadatas) else {}
-            dist = distances[i] if i < len(distances) else None
-            similarity = (1 - dist) if dist is not None else 0
+        if not chunks:
+            return {"chunks": [], "debug": [], "categories": routed if filtered else []}
+        metadatas = [(metadatas[i] if i < len(metadatas) else None) or {} for i in range(len(chunks))]
+
+        # Vectorized scoring
+        similarity = 1 - np.asarray(distances[:len(chunks)], dtype=np.float64)
+        priorities = []
+        for meta in metadatas:
             priority = meta.get("priority", 3)
-            if not isinstance(priority, (int, float)):
-                priority = 3
-            score = similarity * (1 + priority * 0.1)
-            entries.append({
+            priorities.append(priority if isinstance(priority, (int, float)) else 3)
+        in_category = np.array([m.get("category") in routed for m in metadatas], dtype=np.float64)
+        scores = (similarity * (1 + np.asarray(priorities, dtype=np.float64) * priority_weight)
+                  + category_weight * in_category)
+
+        entries = [
+            {
                 "text": chunk_text,
                 "source": meta.get("source", "desconocido"),
                 "type": meta.get("type", ""),
                 "category": meta.get("category", ""),
-                "priority": priority,
+                "priority": priorities[i],
                 "chunk_index": meta.get("chunk_index", 0),
-                "distance": round(dist, 4) if dist is not None else None,
-                "similarity": round(similarity, 4),
-                "score": round(score, 4),
-            })
+                "doc_id": meta.get("doc_id", ""),
+                "distance": round(distances[i], 4),
+                "similarity": round(float(similarity[i]), 4),
+                "score": round(float(scores[i]), 4),
+            }
+            for i, (chunk_text, meta) in enumerate(zip(chunks, metadatas))
+        ]
 
-        entries.sort(key=lambda e: e["score"], reverse=True)
-        entries = entries[:n_results]
+        if packing:
+            picked = mmr_select(
+                scores.tolist(),
+                results["embeddings"][0],
+                [estimate_tokens(e["text"]) for e in entries],
+                token_budget,
+                mmr_lambda,
+            )
+            picked_entries = [entries[i] for i in picked]
+            if picked_entries and estimate_tokens(picked_entries[0]["text"]) > token_budget:
+                first = picked_entries[0]
+                picked_entries[0] = {**first, "text": truncate_to_tokens(first["text"], token_budget), "truncated": True}
+            entries = merge_adjacent(picked_entries)
+        else:
+            entries = [entries[i] for i in np.argsort(-scores, kind="stable")[:n_results]]
 
         return {
             "chunks": [e["text"] for e in entries],
             "debug": entries,
+            "categories": routed if filtered else [],
         }
 
+    @_retry_after_swap
+    def categories(self) -> set[str]:
+        """Distinct chunk categories (cached until the collection changes)."""
+        if self._categories[0] != self.version:
+            metadatas = self.collection.get(include=["metadatas"])["metadatas"] if self.collection.count() else []
+            self._categories = (self.version, {(m or {}).get("category", "") for m in metadatas})
+        return self._categories[1]
+
+    @_retry_after_swap
     def list_documents(self) -> list[dict]:
         """List all unique documents in the knowledge base."""
         if self.collection.count() == 0:
@@ -225,41 +377,335 @@ class KnowledgeBase:
 
     def delete_document(self, doc_id: str) -> bool:
         """Delete all chunks belonging to a document."""
-        if self.collection.count() == 0:
+        with self._write_lock:
+            if self.collection.count() == 0:
+                return False
+
+            all_data = self.collection.get(include=["metadatas"])
+            ids_to_delete = [
+                id_ for id_, meta in zip(all_data["ids"], all_data["metadatas"])
+                if meta.get("doc_id") == doc_id
+            ]
+
+            if ids_to_delete:
+                self.collection.delete(ids=ids_to_delete)
+                self.version += 1
+                return True
             return False
 
-        all_data = self.collection.get(include=["metadatas"])
-        ids_to_delete = [
-            id_ for id_, meta in zip(all_data["ids"], all_data["metadatas"])
-            if meta.get("doc_id") == doc_id
-        ]
-
-        if ids_to_delete:
-            self.collection.delete(ids=ids_to_delete)
-            return True
-        return False
-
     def update_document_metadata(self, doc_id: str, category: str = None, priority: int = None) -> bool:
         """Update category/priority metadata for all chunks of a document."""
-        if self.collection.count() == 0:
-            return False
+        with self._write_lock:
+            if self.collection.count() == 0:
+                return False
+
+            all_data = self.collection.get(include=["metadatas"])
+            target_ids = []
+            target_metas = []
+
+            for chunk_id, meta in zip(all_data["ids"], all_data["metadatas"]):
+                if meta.get("doc_id") == doc_id:
+                    updated = dict(meta)
+                    if category is not None:
+                        updated["category"] = category
+                    if priority is not None:
+                        updated["priority"] = priority
+                    target_ids.append(chunk_id)
+                    target_metas.append(updated)
+
+            if not target_ids:
+                return False
+
+            self.collection.update(ids=target_ids, metadatas=target_metas)
+            self.version += 1
+            return True
 
-        all_data = self.collection.get(include=["metadatas"])
-        target_ids = []
-        target_metas = []
-
-        for chunk_id, meta in zip(all_data["ids"], all_data["metadatas"]):
-            if meta.get("doc_id") == doc_id:
-                updated = dict(meta)
-                if category is not None:
-                    updated["category"] = category
-                if priority is not None:
-                    updated["priority"] = priority
-                target_ids.append(chunk_id)
-                target_metas.append(updated)
-
-        if not target_ids:
-            return False
+    # --- Index maintenance ---
+
+    def current_hnsw(self) -> dict:
+        """HNSW params the collection was built with (Chroma defaults when not set)."""
+        meta = self.collection.metadata or {}
+        defaults = {"M": 16, "construction_ef": 100, "search_ef": 10}
+        return {k: meta.get(f"hnsw:{k}", default) for k, default in defaults.items()}
+
+    def pending_hnsw(self) -> dict:
+        """Configured params that differ from the built index (applied by rebuild())."""
+        current = self.current_hnsw()
+        return {k: v for k, v in self.hnsw.items() if current.get(k) != v}
+
+    def _index_files(self, collection=None) -> tuple[str | None, int, int]:
+        """(vector segment dir, queued adds, queued ops) of `collection` (default: the
+        current one) from Chroma's sqlite, read-only.
+
+        Queued ops are writes not yet persisted to the HNSW files (fewer than
+        hnsw:sync_threshold since the last sync); Chroma purges them after each sync.
+        """
+        db = os.path.join(self.persist_dir, "chroma.sqlite3")
+        collection_id = str((collection or self.collection).id)
+        try:
+            conn = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+            try:
+                row = conn.execute(
+                    "SELECT id FROM segments WHERE collection = ? AND scope = 'VECTOR'", (collection_id,),
+                ).fetchone()
+                adds, ops = conn.execute(
+                    "SELECT COALESCE(SUM(operation IN (0, 2)), 0), COUNT(*) FROM embeddings_queue "
+                    "WHERE topic LIKE ?", (f"%/{collection_id}",),
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None, 0, 0
+        return (os.path.join(self.persist_dir, row[0]) if row else None), adds, ops
+
+    @staticmethod
+    def _dir_bytes(path: str) -> int:
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def index_stats(self) -> dict:
+        """Size of the HNSW index, deleted-but-not-compacted entries and disk usage.
+
+        Tombstones = elements ever added to the index (persisted + queued adds) minus
+        live chunks; approximate while there are queued ops (upserts count as adds).
+        """
+        count = self.collection.count()
+        segment_dir, queued_adds, queued_ops = self._index_files()
+        persisted_added = 0
+        if segment_dir:
+            try:
+                with open(os.path.join(segment_dir, "index_metadata.pickle"), "rb") as f:
+                    persisted_added = pickle.load(f).total_elements_added
+            except (OSError, pickle.UnpicklingError, AttributeError, ImportError):
+                pass  # not synced yet: everything is still queued
+        added = persisted_added + queued_adds
+        tombstones = max(0, added - count)
+        sqlite_path = os.path.join(self.persist_dir, "chroma.sqlite3")
+        return {
+            "collection": self.collection.name,
+            "chunks": count,
+            "hnsw": self.current_hnsw(),
+            "configured_hnsw": self.hnsw,
+            "pending_hnsw": self.pending_hnsw(),
+            "index_elements_added": added,
+            "tombstones": tombstones,
+            "tombstone_ratio": round(tombstones / added, 3) if added else 0.0,
+            "queued_ops": queued_ops,
+            "index_bytes": self._dir_bytes(segment_dir) if segment_dir else 0,
+            "sqlite_bytes": os.path.getsize(sqlite_path) if os.path.exists(sqlite_path) else 0,
+            "store_bytes": self._dir_bytes(self.persist_dir),
+        }
 
-        self.collection.update(ids=target_ids, metadatas=target_metas)
-        return True
+    def _swap_names(self) -> tuple[str, str]:
+        """(new index being filled, old index set aside) during _swap_in (Chroma: <= 63 chars)."""
+        base = self.collection_name[:55]
+        return f"{base}-rebuild", f"{base}-old"
+
+    def _recover_swap(self) -> bool:
+        """Finish a _swap_in interrupted by a crash, before the collection is opened.
+
+        The old index is renamed aside only after the new one is filled, so with the
+        primary name missing, "-rebuild" is complete and wins over "-old". Returns
+        whether the collection exists.
+        """
+        # list_collections() returns names in Chroma >= 0.6, Collection objects before
+        names = {getattr(c, "name", c) for c in self.client.list_collections()}
+        tmp_name, aside_name = self._swap_names()
+        if self.collection_name not in names:
+            for leftover in (tmp_name, aside_name):
+                if leftover in names:
+                    self.client.get_collection(leftover).modify(name=self.collection_name)
+                    names = (names - {leftover}) | {self.collection_name}
+                    logger.warning("collection %s recovered from %s (interrupted swap)", self.collection_name, leftover)
+                    break
+        if aside_name in names:
+            segment_dir = self._index_files(self.client.get_collection(aside_name))[0]
+            self.client.delete_collection(aside_name)
+            if segment_dir:
+                shutil.rmtree(segment_dir, ignore_errors=True)
+        return self.collection_name in names
+
+    def _swap_in(self, fill, hnsw: dict | None = None) -> None:
+        """Build a fresh collection (with `hnsw` or the configured params) with
+        fill(collection), then replace the current one with it. Caller holds the write lock.
+
+        Crash-safe: the old index is renamed aside before the new one takes its name
+        and dropped last; _recover_swap() completes an interrupted swap on startup.
+        Searches still running on the old index are retried (_retry_after_swap).
+        """
+        tmp_name, aside_name = self._swap_names()
+        try:
+            self.client.delete_collection(tmp_name)  # leftover from an interrupted rebuild
+        except ValueError:
+            pass
+        new = self.client.create_collection(
+            name=tmp_name, metadata=self._collection_metadata(hnsw or self.hnsw), embedding_function=self.embedder,
+        )
+        fill(new)
+        old = self.collection
+        old_segment_dir = self._index_files()[0]
+        self.collection = new  # searches switch to the new index here
+        old.modify(name=aside_name)
+        new.modify(name=self.collection_name)
+        self.client.delete_collection(aside_name)
+        if old_segment_dir:
+            # Chroma leaves the deleted collection's HNSW files on disk
+            shutil.rmtree(old_segment_dir, ignore_errors=True)
+        self.version += 1
+
+    def rebuild(self, hnsw: dict | None = None) -> dict:
+        """Copy the collection into a fresh index (with `hnsw` or the configured params)
+        and swap it in: drops tombstones and applies HNSW param changes.
+
+        Stored embeddings are copied, nothing is re-embedded. Writes wait for it
+        (searches keep using the old index until the swap).
+        """
+        before = self.index_stats()
+        t_start = time.perf_counter()
+        with self._write_lock:
+            target = {**self.hnsw, **{k: int(v) for k, v in (hnsw or {}).items() if k in HNSW_PARAMS}}
+            old = self.collection
+            total = old.count()
+
+            def copy(new):
+                for offset in range(0, total, REBUILD_PAGE_SIZE):
+                    page = old.get(include=["embeddings", "documents", "metadatas"],
+                                   limit=REBUILD_PAGE_SIZE, offset=offset)
+                    if page["ids"]:
+                        new.add(ids=page["ids"], embeddings=page["embeddings"],
+                                documents=page["documents"], metadatas=page["metadatas"])
+
+            self._swap_in(copy, target)
+            self.hnsw = target  # only once the index built with them is in
+        elapsed_ms = round((time.perf_counter() - t_start) * 1000)
+        logger.info("rebuilt %s: %s chunks in %sms, hnsw %s", self.collection_name, total, elapsed_ms, self.hnsw)
+        return {"chunks": total, "elapsed_ms": elapsed_ms, "before": before, "after": self.index_stats()}
+
+    # --- Snapshots ---
+
+    def _embedding_id(self) -> str:
+        """Model the stored vectors come from; a snapshot only loads into the same one."""
+        return getattr(self.embedder, "model_name", None) or self.embedder.name()
+
+    def export_snapshot(self, snapshot_dir: str = SNAPSHOT_DIR) -> dict:
+        """Write chunks, metadata and embeddings to <snapshot_dir>/<collection>-<hash>.npz.
+
+        The hash covers the content (not the time), so exporting an unchanged
+        collection again returns the existing file.
+        """
+        with self._write_lock:
+            data = self.collection.get(include=["embeddings", "documents", "metadatas"])
+        if not data["ids"]:
+            raise ValueError("Knowledge base is empty")
+        order = sorted(range(len(data["ids"])), key=lambda i: data["ids"][i])
+        ids = np.array([data["ids"][i] for i in order])
+        documents = np.array([data["documents"][i] or "" for i in order])
+        metadatas = np.array([json.dumps(data["metadatas"][i], sort_keys=True, ensure_ascii=False) for i in order])
+        # float16 embedders already round their vectors, the snapshot stores them at that size
+        dtype = np.float16 if getattr(self.embedder, "precision", "") == "float16" else np.float32
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)[order].astype(dtype)
+
+        digest = snapshot_hash(ids, documents, metadatas, embeddings)
+        path = Path(snapshot_dir) / f"{self.collection_name}-{digest}.npz"
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "hash": digest,
+            "collection": self.collection_name,
+            "embedding_model": self._embedding_id(),
+            "dimensions": int(embeddings.shape[1]),
+            "dtype": np.dtype(dtype).name,
+            "chunks": len(ids),
+            "hnsw": self.current_hnsw(),
+            "created_at": datetime.now().isoformat(),
+        }
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp.npz")
+            # Uncompressed: nothing to inflate on load (npz members are still read into
+            # memory, np.load doesn't memory-map them)
+            np.savez(tmp, ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings,
+                     manifest=np.array(json.dumps(manifest)))
+            os.replace(tmp, path)
+            logger.info("snapshot %s: %s chunks -> %s", self.collection_name, len(ids), path)
+        return {**read_manifest(path), "path": str(path), "bytes": path.stat().st_size}
+
+    def import_snapshot(self, path: str, replace: bool = False) -> dict:
+        """Load a snapshot's chunks and embeddings (nothing is re-embedded).
+
+        Into an empty collection it adds them directly; replace=True swaps the
+        current contents for the snapshot's (like rebuild()).
+        """
+        t_start = time.perf_counter()
+        with np.load(path, allow_pickle=False) as npz:
+            manifest = json.loads(str(npz["manifest"]))
+            if manifest.get("format") != SNAPSHOT_FORMAT:
+                raise ValueError(f"Unsupported snapshot format {manifest.get('format')}")
+            if manifest["embedding_model"] != self._embedding_id():
+                raise ValueError(f"Snapshot embeddings are from {manifest['embedding_model']}, "
+                                 f"this knowledge base uses {self._embedding_id()}")
+            ids, documents, metadatas, embeddings = (
+                npz["ids"], npz["documents"], npz["metadatas"], npz["embeddings"],
+            )
+        if snapshot_hash(ids, documents, metadatas, embeddings) != manifest["hash"]:
+            raise ValueError("Snapshot content doesn't match its hash")
+
+        def load(collection):
+            for start in range(0, len(ids), REBUILD_PAGE_SIZE):
+                end = start + REBUILD_PAGE_SIZE
+                collection.add(
+                    ids=ids[start:end].tolist(),
+                    documents=documents[start:end].tolist(),
+                    metadatas=[json.loads(m) for m in metadatas[start:end]],
+                    embeddings=embeddings[start:end].astype(np.float32).tolist(),
+                )
+
+        with self._write_lock:
+            if self.collection.count() == 0:
+                load(self.collection)
+                self.version += 1
+            elif replace:
+                self._swap_in(load)
+            else:
+                raise ValueError("Knowledge base is not empty (use replace)")
+        elapsed_ms = round((time.perf_counter() - t_start) * 1000)
+        logger.info("restored %s from snapshot %s: %s chunks in %sms",
+                    self.collection_name, manifest["hash"], len(ids), elapsed_ms)
+        self.restored_snapshot = {"hash": manifest["hash"], "chunks": len(ids), "elapsed_ms": elapsed_ms}
+        return {**manifest, **self.restored_snapshot}
+
+
+def snapshot_hash(ids, documents, metadatas, embeddings) -> str:
+    h = hashlib.sha256()
+    for column in (ids, documents, metadatas):
+        for value in column:
+            h.update(str(value).encode("utf-8"))
+            h.update(b"\0")
+    h.update(np.ascontiguousarray(embeddings).tobytes())
+    return h.hexdigest()[:16]
+
+
+def read_manifest(path) -> dict:
+    with np.load(path, allow_pickle=False) as npz:
+        return json.loads(str(npz["manifest"]))
+
+
+def list_snapshots(collection_name: str, snapshot_dir: str = SNAPSHOT_DIR) -> list[dict]:
+    """The collection's snapshots, newest first."""
+    paths = sorted(Path(snapshot_dir).glob(f"{collection_name}-*.npz"), key=lambda p: p.stat().st_mtime, reverse=True)
+    snapshots = []
+    for path in paths:
+        if path.name.endswith(".tmp.npz"):
+            continue
+        try:
+            manifest = read_manifest(path)
+        except (OSError, ValueError, KeyError):
+            continue
+        if manifest.get("collection") == collection_name:
+            snapshots.append({**manifest, "path": str(path), "bytes": path.stat().st_size})
+    return snapshots
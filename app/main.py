@@ -2,26 +2,46 @@ import uuid
 import random
 import logging
 import os
+import time
+import json
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request, Depends
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse as StarletteFileResponse
+from starlette.staticfiles import NotModifiedResponse
 from pydantic import BaseModel
 
-from app.config import load_client_config, OPENROUTER_API_KEY
+from app.config import (
+    load_client_config, OPENROUTER_API_KEY, WHATSAPP_TOKEN, WHATSAPP_PHONE_NUMBER_ID,
+    WHATSAPP_VERIFY_TOKEN, WHATSAPP_APP_SECRET, PUBLIC_BASE_URL,
+)
 from app.models import (
-    ChatMessage, ChatSession, SendMessageRequest, NewSessionRequest,
+    Message, ChatSession, SendMessageRequest, NewSessionRequest,
     HandoffRequest, OperatorReplyRequest,
 )
-from app.agent import WhatsAppAgent
-from app.knowledge import KnowledgeBase
-from app.config_store import ConfigStore
-from app.evaluator import Evaluator
-from app.introspector import Introspector
+from app.events import EventBus
+from app.job_queue import JobQueue
+from app import whatsapp
+from app.outbound import OutboundDispatcher
+from app.recorder import ConversationRecorder
+from app.session_store import SessionStore
 from app import images as image_registry
 from app.image_processor import process_reply
+from app.tenants import Tenant, TenantRegistry, TenantNotFound, DEFAULT_TENANT
+from app.usage import UsageLedger, BudgetExceeded, GROUP_BY
+from app.judge_cache import JudgeCache
+from app.eval_history import EvalHistory, diff_runs
+from app.experiments import Experiment, ExperimentLog
+
+if TYPE_CHECKING:
+    from app.batch_introspection import IntrospectionJob  # imported lazily at runtime
 
 # --- Logging ---
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -32,46 +52,329 @@ logging.basicConfig(
 )
 logger = logging.getLogger("app.main")
 
-# Load config and create agent
+# Load config (deployment-wide settings + the default tenant's business config)
 client_config = load_client_config()
-agent = WhatsAppAgent(api_key=OPENROUTER_API_KEY, config=client_config)
-
-# Persistent config store (data/runtime_config.yaml)
-config_store = ConfigStore(runtime_path="data/runtime_config.yaml", defaults=client_config)
-runtime = config_store.load()
-
-# Apply persisted runtime config to agent on startup
-agent.system_prompt = runtime.get("system_prompt", agent.system_prompt)
-agent.update_params(
-    model=runtime.get("model", agent.model),
-    temperature=runtime.get("temperature", agent.temperature),
-    max_tokens=runtime.get("max_tokens", agent.max_tokens),
+
+# Every OpenRouter call (chat, judge, introspection) is recorded here; budgets can
+# downgrade or throttle callers. Shared by all tenants (one API key).
+usage_config = client_config.get("usage", {})
+ledger = UsageLedger(
+    db_path=usage_config.get("db_path", "data/usage.db"),
+    budgets=usage_config.get("budgets"),
+    critical_callers=tuple(usage_config.get("critical_callers", ["chat"])),
+    prices=usage_config.get("prices"),
+)
+# LLM-judge scores by (judge model, reply, expected behaviors), shared by all tenants
+evaluation_config = client_config.get("evaluation", {})
+judge_cache = JudgeCache(evaluation_config.get("judge_cache_path", "data/judge_cache.db"))
+# Every run_all report per tenant, to diff runs and re-run only changed cases
+eval_history = EvalHistory(
+    evaluation_config.get("history_path", "data/eval_history.db"),
+    max_runs=evaluation_config.get("history_max_runs", 50),
 )
+# Per-variant turn metrics of prompt/model A/B experiments (buffered, flushed with the ledger)
+experiment_log = ExperimentLog(client_config.get("experiments", {}).get("db_path", "data/experiments.db"))
+
+# Tenants: each business has its own agent, runtime config (data/runtime_config.yaml for
+# the default one), knowledge collection and image registry. Loaded on first request,
+# idle ones are unloaded (LRU). Each tenant's knowledge base (ChromaDB) opens lazily —
+# importing app.knowledge pulls in chromadb, onnxruntime and fitz, so it is deferred too.
+tenant_config = client_config.get("tenants", {})
+tenants = TenantRegistry(
+    api_key=OPENROUTER_API_KEY,
+    default_config=client_config,
+    max_active=tenant_config.get("max_active", 8),
+    ledger=ledger,
+)
+default_tenant = tenants.get(DEFAULT_TENANT)
+
+# Startup progress, reported by /api/health/ready
+startup_state = {
+    "started_at": time.monotonic(),
+    "knowledge": "pending",  # "pending" | "loading" | "ready" | "error"
+    "knowledge_ready_ms": None,
+    "embedding_warmup_ms": None,
+    "snapshot": None,  # {"hash", "chunks", "elapsed_ms"} when restored from a snapshot
+    "error": "",
+}
+
 
-# Knowledge base (ChromaDB with disk persistence)
-kb = KnowledgeBase(persist_dir="data/chroma")
+def current_tenant(request: Request) -> Tenant:
+    """Tenant from the X-Tenant header or ?tenant= (EventSource can't send headers).
 
-# In-memory session storage
-sessions: dict[str, ChatSession] = {}
+    Sync on purpose: FastAPI runs it in the threadpool, so loading a tenant from disk
+    never blocks the event loop.
+    """
+    tenant_id = request.headers.get("x-tenant") or request.query_params.get("tenant") or DEFAULT_TENANT
+    try:
+        return tenants.get(tenant_id)
+    except TenantNotFound:
+        raise HTTPException(status_code=404, detail=f"Unknown tenant: {tenant_id}")
 
-# Default prompt context — loaded from persisted config
-default_prompt_context: str = runtime.get("prompt_context_default", "")
 
-# Session timeout — clears conversation context after inactivity
-session_timeout_minutes: int = runtime.get("session_timeout_minutes", 120)
+async def tenant_for(tenant_id: str) -> Tenant:
+    """Tenant by id for background work (WhatsApp workers, sweeper)."""
+    return tenants.peek(tenant_id) or await asyncio.to_thread(tenants.get, tenant_id)
 
-# Fixed greeting — bypasses LLM for first message in a session
-greeting_config = {
-    "enabled": runtime.get("greeting_enabled", True),
-    "text": runtime.get("greeting_text", ""),
-    "patterns": runtime.get("greeting_patterns", []),
-}
 
-app = FastAPI(title="La Fórmula - WhatsApp Agent MVP")
+def _warm_knowledge() -> None:
+    startup_state["knowledge"] = "loading"
+    try:
+        kb = default_tenant.get_kb()
+        startup_state["snapshot"] = kb.restored_snapshot
+        try:
+            startup_state["embedding_warmup_ms"] = kb.warmup()
+        except Exception as e:
+            # Chroma is usable; the model will load on the first query instead
+            logger.warning("embedding warm-up failed: %s", e)
+        startup_state["knowledge"] = "ready"
+    except Exception as e:
+        startup_state["knowledge"] = "error"
+        startup_state["error"] = str(e)
+        logger.exception("knowledge base failed to open")
+    startup_state["knowledge_ready_ms"] = round((time.monotonic() - startup_state["started_at"]) * 1000)
+    logger.info("startup: knowledge %s after %sms", startup_state["knowledge"], startup_state["knowledge_ready_ms"])
+
+
+# In-memory session storage, indexed by mode / is_simulation / last activity.
+# Idle sessions are archived to disk by the sweeper and reloaded on access.
+session_config = client_config.get("sessions", {})
+sessions = SessionStore(archive_dir=session_config.get("archive_dir", "data/sessions"))
+
+# Pushes session/message/handoff changes to the operator console (/api/events)
+bus = EventBus()
+
+# WhatsApp: the webhook only enqueues; workers run the chat pipeline and send replies
+whatsapp_config = client_config.get("whatsapp", {})
+inbound_queue = JobQueue(whatsapp_config.get("queue_path", "data/queue.db"))
+sender = whatsapp.build_sender(WHATSAPP_TOKEN, WHATSAPP_PHONE_NUMBER_ID, PUBLIC_BASE_URL, WHATSAPP_APP_SECRET)
+outbound_config = whatsapp_config.get("outbound", {})
+outbound = OutboundDispatcher(
+    sender,
+    rate_per_second=outbound_config.get("rate_per_second", 20),
+    max_attempts=outbound_config.get("max_attempts", 4),
+    backoff_seconds=outbound_config.get("backoff_seconds", 0.5),
+)
+_queue_wakeup = asyncio.Event()
+
+# Every chat turn (inputs, raw LLM output, result) to data/recordings for app.replay
+recording_config = client_config.get("recording", {})
+recorder = ConversationRecorder(
+    dir=recording_config.get("dir", "data/recordings"),
+    enabled=recording_config.get("enabled", True),
+    redact=recording_config.get("redact", True),
+)
+
+
+def _backfill_image_variants() -> None:
+    """Derivatives for images uploaded before they existed, for every tenant."""
+    for tenant_id in tenants.list_ids():
+        try:
+            count = tenants.images_for(tenant_id).backfill_variants()
+            if count:
+                logger.info("startup: generated derivatives for %d images (tenant %s)", count, tenant_id)
+        except Exception:
+            logger.exception("image derivative backfill failed (tenant %s)", tenant_id)
+
+
+_sweep_lock = asyncio.Lock()
+
+
+async def sweep_sessions() -> dict:
+    """Archive + evict idle bot sessions, purge idle simulator sessions, unload idle tenants."""
+    # One sweep at a time: a concurrent one would delete the archive this one just wrote
+    async with _sweep_lock:
+        return await _sweep_sessions()
+
+
+async def _sweep_sessions() -> dict:
+    now = time.time()
+    archived = purged = 0
+
+    for tenant_id in sessions.tenant_ids():
+        # Unloaded tenants use the default timeout rather than being loaded just for this
+        timeout = (tenants.peek(tenant_id) or default_tenant).session_timeout_minutes
+        # Sessions waiting for an operator stay resident regardless of inactivity
+        for session in sessions.expired(now - timeout * 60, is_simulation=False, modes=("bot",), tenant=tenant_id):
+            activity = session.last_activity
+            await asyncio.to_thread(sessions.write_archive, session.id, session.model_dump())
+            if session.last_activity != activity or not sessions.is_resident(session.id):
+                # Active again (the archive is stale) or deleted meanwhile (it would resurrect it)
+                sessions.delete_archive(session.id)
+                continue
+            sessions.evict(session.id)
+            bus.publish("session.deleted", {"session_id": session.id, "archived": True,
+                                            "pending_count": _pending_count(tenant_id)}, tenant=tenant_id)
+            archived += 1
+
+    sim_ttl = session_config.get("simulation_ttl_minutes", 30)
+    for session in sessions.expired(now - sim_ttl * 60, is_simulation=True):
+        del sessions[session.id]
+        bus.publish("session.deleted", {"session_id": session.id, "pending_count": _pending_count(session.tenant)},
+                    tenant=session.tenant)
+        purged += 1
+
+    unloaded = await asyncio.to_thread(tenants.evict_idle, tenant_config.get("idle_minutes", 30) * 60)
+
+    if archived or purged or unloaded:
+        logger.info("session sweep: archived=%d purged=%d resident=%d tenants_unloaded=%d",
+                    archived, purged, len(sessions), unloaded)
+    return {"archived": archived, "purged": purged, "tenants_unloaded": unloaded}
+
+
+async def _sweep_sessions_forever() -> None:
+    interval = session_config.get("sweep_interval_seconds", 60)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep_sessions()
+        except Exception:
+            logger.exception("session sweep failed")
+
+
+async def _flush_usage_forever() -> None:
+    interval = usage_config.get("flush_interval_seconds", 2)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(ledger.flush)
+            await asyncio.to_thread(experiment_log.flush)
+        except Exception:
+            logger.exception("usage ledger flush failed")
+
+
+def _whatsapp_session(tenant: Tenant, phone: str) -> ChatSession:
+    session = sessions.find_by_phone(phone, tenant=tenant.id)
+    if session is None:
+        session = ChatSession(
+            id=str(uuid.uuid4())[:8],
+            phone_number=phone,
+            prompt_context=tenant.default_prompt_context,
+            channel="whatsapp",
+            tenant=tenant.id,
+        )
+        sessions[session.id] = session
+        bus.publish("session.created", {"session": _session_summary(session)}, tenant=tenant.id)
+    return session
+
+
+def _reply_parts(result: dict) -> list[dict]:
+    """Outbound parts (text + images) of a /api/chat result."""
+    parts = [{"type": "text", "text": result["reply"]}] if result.get("reply") else []
+    parts += [{"type": "image", "url": img["url"], "caption": img.get("title", "")}
+              for img in result.get("images", [])]
+    return parts
+
+
+async def _complete_after_delivery(job: dict, delivery: asyncio.Future) -> None:
+    delivered = await delivery
+    if not delivered:
+        logger.error("whatsapp job %s: reply dropped by the dispatcher", job["provider_msg_id"])
+    await asyncio.to_thread(inbound_queue.complete, job["id"])
+    _queue_wakeup.set()  # the phone's next message can be claimed now
+
+
+_delivery_tasks: set[asyncio.Task] = set()
+
+
+def _deliver_and_complete(job: dict, parts: list[dict]) -> None:
+    task = asyncio.create_task(_complete_after_delivery(job, outbound.send(job["phone"], parts)))
+    _delivery_tasks.add(task)
+    task.add_done_callback(_delivery_tasks.discard)
+
+
+async def _process_inbound(job: dict) -> None:
+    payload = job["payload"]
+    if job["reply"] is not None:
+        # Generated before a crash/restart but maybe not delivered: send it, don't re-run the chat
+        _deliver_and_complete(job, job["reply"])
+        return
+
+    session = None
+    trace = {}
+    try:
+        tenant = await tenant_for(payload.get("tenant", DEFAULT_TENANT))
+        session = _whatsapp_session(tenant, job["phone"])
+        result = await _chat(tenant, session, SendMessageRequest(session_id=session.id, message=payload["text"]),
+                             inline_errors=False, trace=trace)
+    except Exception as e:
+        logger.exception("whatsapp job %s failed (attempt %d)", job["provider_msg_id"], job["attempts"])
+        # The retry appends the message again: take this attempt's copy out of the session
+        if session is not None and trace.get("user_msg") in session.messages:
+            session.messages.remove(trace["user_msg"])
+            sessions.touch(session)
+        await asyncio.to_thread(inbound_queue.fail, job["id"], job["attempts"], str(e))
+        return
+
+    # The reply is already in the session; delivery (and its retries) belongs to the dispatcher.
+    # The job is completed once it's out; until then the stored reply survives a restart.
+    parts = _reply_parts(result)
+    await asyncio.to_thread(inbound_queue.save_reply, job["id"], parts)
+    _deliver_and_complete(job, parts)
+
+
+async def _inbound_worker(n: int) -> None:
+    while True:
+        try:
+            job = await asyncio.to_thread(inbound_queue.claim)
+        except Exception:
+            logger.exception("inbound worker %d: claim failed", n)
+            job = None
+        if job is None:
+            _queue_wakeup.clear()
+            try:
+                await asyncio.wait_for(_queue_wakeup.wait(), timeout=2.0)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        await _process_inbound(job)
+        # Another job for the same phone may have been waiting on this one
+        _queue_wakeup.set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve immediately; open Chroma and load the embedding model in the background
+    warm_task = asyncio.create_task(asyncio.to_thread(_warm_knowledge))
+    asyncio.create_task(asyncio.to_thread(_backfill_image_variants))
+    sweeper = asyncio.create_task(_sweep_sessions_forever())
+    usage_flusher = asyncio.create_task(_flush_usage_forever())
+    workers = [asyncio.create_task(_inbound_worker(n)) for n in range(whatsapp_config.get("workers", 4))]
+    logger.info("startup: serving after %dms",
+                round((time.monotonic() - startup_state["started_at"]) * 1000))
+    yield
+    sweeper.cancel()
+    usage_flusher.cancel()
+    for w in workers:
+        w.cancel()
+    await outbound.drain()
+    tenants.flush()
+    ledger.flush()
+    experiment_log.flush()
+    if not warm_task.done():
+        logger.info("shutdown: knowledge warm-up still running")
+
+
+app = FastAPI(title="La Fórmula - WhatsApp Agent MVP", lifespan=lifespan)
+
+
+class ImageFiles(StaticFiles):
+    """Product images with Cache-Control: content-hashed derivatives never change."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = StarletteFileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        if Path(full_path).parent.name == image_registry.VARIANTS_DIR.name:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=300"
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
 
 # Serve product images (must be before /static)
 os.makedirs("data/images", exist_ok=True)
-app.mount("/images", StaticFiles(directory="data/images"), name="images")
+app.mount("/images", ImageFiles(directory="data/images"), name="images")
 
 # Serve static files
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -89,22 +392,49 @@ async def admin_page():
     return FileResponse("app/static/admin.html")
 
 
+# --- Health ---
+
+@app.get("/api/health")
+async def health():
+    return {"ok": True}
+
+
+@app.get("/api/health/ready")
+async def health_ready():
+    body = {
+        "ready": startup_state["knowledge"] == "ready",
+        "knowledge": startup_state["knowledge"],
+        "knowledge_ready_ms": startup_state["knowledge_ready_ms"],
+        "embedding_warmup_ms": startup_state["embedding_warmup_ms"],
+        "snapshot": startup_state["snapshot"],
+        "error": startup_state["error"],
+    }
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
 # --- Config ---
 
 @app.get("/api/config")
-async def get_config():
+async def get_config(tenant: Tenant = Depends(current_tenant)):
     return {
-        "business_name": client_config["business"]["name"],
-        "agent_name": client_config["agent"]["name"],
-        "description": client_config["business"]["description"],
+        "tenant": tenant.id,
+        "business_name": tenant.config["business"]["name"],
+        "agent_name": tenant.config["agent"]["name"],
+        "description": tenant.config["business"]["description"],
     }
 
 
+@app.get("/api/tenants")
+async def list_tenants():
+    ids = await asyncio.to_thread(tenants.list_ids)
+    return {"tenants": ids, **tenants.stats()}
+
+
 # --- Prompt (persisted) ---
 
 @app.get("/api/config/prompt")
-async def get_prompt():
-    return {"system_prompt": agent.system_prompt}
+async def get_prompt(tenant: Tenant = Depends(current_tenant)):
+    return {"system_prompt": tenant.agent.system_prompt}
 
 
 class UpdatePromptRequest(BaseModel):
@@ -112,11 +442,12 @@ class UpdatePromptRequest(BaseModel):
 
 
 @app.post("/api/config/prompt")
-async def update_prompt(req: UpdatePromptRequest):
+async def update_prompt(req: UpdatePromptRequest, tenant: Tenant = Depends(current_tenant)):
     if not req.system_prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
-    agent.system_prompt = req.system_prompt
-    config_store.save_prompt(req.system_prompt)
+    tenant.agent.system_prompt = req.system_prompt
+    # Writes the prompt version blob; keep it off the event loop
+    await asyncio.to_thread(tenant.config_store.save_prompt, req.system_prompt)
     return {"ok": True}
 
 
@@ -129,93 +460,176 @@ class UpdateModelParamsRequest(BaseModel):
 
 
 @app.get("/api/config/model-params")
-async def get_model_params():
+async def get_model_params(tenant: Tenant = Depends(current_tenant)):
     return {
-        "model": agent.model,
-        "temperature": agent.temperature,
-        "max_tokens": agent.max_tokens,
+        "model": tenant.agent.model,
+        "temperature": tenant.agent.temperature,
+        "max_tokens": tenant.agent.max_tokens,
     }
 
 
 @app.put("/api/config/model-params")
-async def update_model_params(req: UpdateModelParamsRequest):
+async def update_model_params(req: UpdateModelParamsRequest, tenant: Tenant = Depends(current_tenant)):
     if not req.model.strip():
         raise HTTPException(status_code=400, detail="Model cannot be empty")
     if not (0.0 <= req.temperature <= 1.5):
         raise HTTPException(status_code=400, detail="Temperature must be 0.0–1.5")
     if not (50 <= req.max_tokens <= 4000):
         raise HTTPException(status_code=400, detail="max_tokens must be 50–4000")
-    agent.update_params(req.model, req.temperature, req.max_tokens)
-    config_store.save_model_params(req.model, req.temperature, req.max_tokens)
+    tenant.agent.update_params(req.model, req.temperature, req.max_tokens)
+    tenant.config_store.save_model_params(req.model, req.temperature, req.max_tokens)
     return {"ok": True}
 
 
 # --- Prompt Versions ---
 
 @app.get("/api/config/prompt-versions")
-async def get_prompt_versions():
-    return config_store.get_prompt_versions()
+async def get_prompt_versions(tenant: Tenant = Depends(current_tenant)):
+    return tenant.config_store.get_prompt_versions()
+
+
+@app.get("/api/config/prompt-versions/{index}/diff")
+async def get_prompt_version_diff(index: int, tenant: Tenant = Depends(current_tenant)):
+    try:
+        diff = tenant.config_store.get_version_diff(index)
+    except IndexError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"diff": diff}
 
 
 @app.post("/api/config/prompt-versions/{index}/restore")
-async def restore_prompt_version(index: int):
+async def restore_prompt_version(index: int, tenant: Tenant = Depends(current_tenant)):
     try:
-        text = config_store.restore_version(index)
+        text = tenant.config_store.restore_version(index)
     except IndexError as e:
         raise HTTPException(status_code=404, detail=str(e))
-    agent.system_prompt = text
+    tenant.agent.system_prompt = text
     return {"ok": True, "system_prompt": text}
 
 
 # --- Sessions ---
 
+HANDOFF_MODES = ("handoff_pending", "human")
+
+
+def _session_summary(s: ChatSession) -> dict:
+    return sessions.summary(s.id)
+
+
+def _pending_count(tenant_id: str) -> int:
+    return sessions.count(HANDOFF_MODES, tenant=tenant_id)
+
+
+def _tenant_session(tenant: Tenant, session_id: str) -> ChatSession:
+    """The session, if it exists and belongs to this tenant (404 otherwise)."""
+    session = sessions.get(session_id)
+    if not session or session.tenant != tenant.id:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+
+def _append_message(session: ChatSession, msg: Message) -> None:
+    session.messages.append(msg)
+    sessions.touch(session)
+    bus.publish("message.new", {"session": _session_summary(session), "message": msg.to_dict()},
+                tenant=session.tenant)
+
+
+def _publish_handoff(session: ChatSession) -> None:
+    sessions.touch(session)
+    bus.publish("handoff.changed", {"session": _session_summary(session),
+                                    "pending_count": _pending_count(session.tenant)}, tenant=session.tenant)
+
+
 @app.post("/api/sessions")
-async def create_session(req: NewSessionRequest = NewSessionRequest()):
+async def create_session(req: NewSessionRequest = NewSessionRequest(), tenant: Tenant = Depends(current_tenant)):
     session_id = str(uuid.uuid4())[:8]
     phone = req.phone_number or f"+54 9 11 {random.randint(1000, 9999)}-{random.randint(1000, 9999)}"
     session = ChatSession(
         id=session_id,
         phone_number=phone,
-        prompt_context=default_prompt_context,
+        prompt_context=tenant.default_prompt_context,
         is_simulation=req.is_simulation,
+        tenant=tenant.id,
     )
     sessions[session_id] = session
+    bus.publish("session.created", {"session": _session_summary(session)}, tenant=tenant.id)
     return {"id": session_id, "phone_number": phone}
 
 
 @app.get("/api/sessions")
-async def list_sessions(mode: str = Query(None), is_simulation: bool = Query(None)):
-    result = []
-    for s in sessions.values():
-        if mode and s.mode != mode:
-            continue
-        if is_simulation is not None and s.is_simulation != is_simulation:
-            continue
-        result.append({
-            "id": s.id,
-            "phone_number": s.phone_number,
-            "last_message": s.messages[-1].content[:50] if s.messages else "",
-            "message_count": len(s.messages),
-            "mode": s.mode,
-            "handoff_reason": s.handoff_reason,
-            "handoff_at": s.handoff_at,
-        })
-    return result
+async def list_sessions(
+    response: Response,
+    mode: str = Query(None),
+    is_simulation: bool = Query(None),
+    limit: int = Query(None, ge=1, le=500),
+    cursor: str = Query(None),
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Summary rows, most recent activity first. With `limit`, the next page's cursor
+    is returned in the X-Next-Cursor header."""
+    try:
+        rows, next_cursor = sessions.page(
+            modes=(mode,) if mode else None,
+            is_simulation=is_simulation,
+            limit=limit,
+            cursor=cursor,
+            tenant=tenant.id,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+
+@app.get("/api/sessions/stats")
+async def session_stats():
+    """Deployment-wide (all tenants): the store's memory use, like /api/tenants."""
+    return sessions.stats()
+
+
+@app.post("/api/sessions/sweep")
+async def run_session_sweep():
+    """Deployment-wide (all tenants): archive every idle session now, each with its
+    tenant's timeout."""
+    return await sweep_sessions()
 
 
 @app.get("/api/sessions/{session_id}")
-async def get_session(session_id: str):
-    session = sessions.get(session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    return session
+async def get_session(
+    session_id: str,
+    after: int = Query(None, ge=-1),
+    limit: int = Query(None, ge=1, le=1000),
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Session with its messages. `after=i` returns messages with index > i; `limit`
+    caps the count (the most recent ones when `after` is not given)."""
+    session = _tenant_session(tenant, session_id)
+
+    total = len(session.messages)
+    if after is not None:
+        start = after + 1
+        end = total if limit is None else min(total, start + limit)
+    else:
+        end = total
+        start = 0 if limit is None else max(0, total - limit)
+    messages = [m.to_dict() for m in session.messages[start:end]]
+
+    out = session.model_dump(exclude={"messages"})
+    out["messages"] = messages
+    out["message_offset"] = start
+    out["message_count"] = total
+    return out
 
 
 @app.delete("/api/sessions/{session_id}")
-async def delete_session(session_id: str):
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def delete_session(session_id: str, tenant: Tenant = Depends(current_tenant)):
+    _tenant_session(tenant, session_id)
     del sessions[session_id]
+    tenant.agent.planner.forget(session_id)
+    bus.publish("session.deleted", {"session_id": session_id, "pending_count": _pending_count(tenant.id)},
+                tenant=tenant.id)
     return {"ok": True}
 
 
@@ -224,10 +638,10 @@ class UpdatePromptContextRequest(BaseModel):
 
 
 @app.put("/api/sessions/{session_id}/prompt-context")
-async def update_session_prompt_context(session_id: str, req: UpdatePromptContextRequest):
-    session = sessions.get(session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def update_session_prompt_context(
+    session_id: str, req: UpdatePromptContextRequest, tenant: Tenant = Depends(current_tenant)
+):
+    session = _tenant_session(tenant, session_id)
     session.prompt_context = req.prompt_context or ""
     return {"ok": True, "prompt_context": session.prompt_context}
 
@@ -235,23 +649,22 @@ async def update_session_prompt_context(session_id: str, req: UpdatePromptContex
 # --- Config: default prompt context (persisted) ---
 
 @app.get("/api/config/prompt-context")
-async def get_default_prompt_context():
-    return {"prompt_context": default_prompt_context}
+async def get_default_prompt_context(tenant: Tenant = Depends(current_tenant)):
+    return {"prompt_context": tenant.default_prompt_context}
 
 
 @app.put("/api/config/prompt-context")
-async def update_default_prompt_context(req: UpdatePromptContextRequest):
-    global default_prompt_context
-    default_prompt_context = req.prompt_context or ""
-    config_store.save_default_context(default_prompt_context)
-    return {"ok": True, "prompt_context": default_prompt_context}
+async def update_default_prompt_context(req: UpdatePromptContextRequest, tenant: Tenant = Depends(current_tenant)):
+    tenant.default_prompt_context = req.prompt_context or ""
+    tenant.config_store.save_default_context(tenant.default_prompt_context)
+    return {"ok": True, "prompt_context": tenant.default_prompt_context}
 
 
 # --- Session Timeout (persisted) ---
 
 @app.get("/api/config/session-timeout")
-async def get_session_timeout():
-    return {"timeout_minutes": session_timeout_minutes}
+async def get_session_timeout(tenant: Tenant = Depends(current_tenant)):
+    return {"timeout_minutes": tenant.session_timeout_minutes}
 
 
 class UpdateSessionTimeoutRequest(BaseModel):
@@ -259,20 +672,19 @@ class UpdateSessionTimeoutRequest(BaseModel):
 
 
 @app.put("/api/config/session-timeout")
-async def update_session_timeout(req: UpdateSessionTimeoutRequest):
-    global session_timeout_minutes
+async def update_session_timeout(req: UpdateSessionTimeoutRequest, tenant: Tenant = Depends(current_tenant)):
     if req.timeout_minutes < 1:
         raise HTTPException(status_code=400, detail="Timeout must be at least 1 minute")
-    session_timeout_minutes = req.timeout_minutes
-    config_store.save_session_timeout(req.timeout_minutes)
+    tenant.session_timeout_minutes = req.timeout_minutes
+    tenant.config_store.save_session_timeout(req.timeout_minutes)
     return {"ok": True}
 
 
 # --- Fixed Greeting (persisted) ---
 
 @app.get("/api/config/greeting")
-async def get_greeting():
-    return greeting_config
+async def get_greeting(tenant: Tenant = Depends(current_tenant)):
+    return tenant.greeting_config
 
 
 class UpdateGreetingRequest(BaseModel):
@@ -282,37 +694,73 @@ class UpdateGreetingRequest(BaseModel):
 
 
 @app.put("/api/config/greeting")
-async def update_greeting(req: UpdateGreetingRequest):
-    greeting_config["enabled"] = req.enabled
-    greeting_config["text"] = req.text
-    greeting_config["patterns"] = req.patterns
-    config_store.save_greeting(req.enabled, req.text, req.patterns)
+async def update_greeting(req: UpdateGreetingRequest, tenant: Tenant = Depends(current_tenant)):
+    tenant.greeting_config["enabled"] = req.enabled
+    tenant.greeting_config["text"] = req.text
+    tenant.greeting_config["patterns"] = req.patterns
+    tenant.config_store.save_greeting(req.enabled, req.text, req.patterns)
     return {"ok": True}
 
 
 # --- Chat (with RAG) ---
 
 @app.post("/api/chat")
-async def send_message(req: SendMessageRequest):
-    session = sessions.get(req.session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def send_message(req: SendMessageRequest, tenant: Tenant = Depends(current_tenant)):
+    session = _tenant_session(tenant, req.session_id)
+    return await _chat(tenant, session, req)
+
+
+async def _chat(tenant: Tenant, session: ChatSession, req: SendMessageRequest,
+                inline_errors: bool = True, trace: dict | None = None) -> dict:
+    """The chat pipeline (simulator and WhatsApp workers): greeting, RAG + LLM, images, handoff.
+
+    inline_errors: an LLM failure becomes the reply text (simulator). Otherwise it is
+    raised, so the WhatsApp job is retried and the customer never sees it.
+    """
+    t_start = time.monotonic()
+    trace = trace if trace is not None else {}
+    trace.update({"path": "llm", "llm": None, "experiment": None, "inline_errors": inline_errors})
+    out = await _chat_turn(tenant, session, req, trace)
+    latency_ms = (time.monotonic() - t_start) * 1000
+    experiment = trace["experiment"]
+    recorder.record(
+        session, tenant.agent, req.message,
+        prompt_context=session.prompt_context or "",
+        system_prompt_override=req.system_prompt_override or (experiment or {}).get("system_prompt") or None,
+        path=trace["path"],
+        result=out,
+        latency_ms=latency_ms,
+        llm=trace["llm"],
+        experiment=experiment and {k: experiment[k] for k in ("id", "variant", "model")},
+    )
+    if experiment and trace["path"] == "llm":
+        experiment_log.record_turn(
+            tenant.id, experiment["id"], experiment["variant"], session.id, latency_ms,
+            (trace["llm"] or {}).get("token_usage"), bool(out.get("handoff")), ok=trace["llm"] is not None,
+        )
+    return out
+
 
+async def _chat_turn(tenant: Tenant, session: ChatSession, req: SendMessageRequest, trace: dict) -> dict:
     # Session timeout — clear old context if inactive too long
     if session.messages:
         try:
             last = datetime.fromisoformat(session.last_activity)
             elapsed = (datetime.now() - last).total_seconds() / 60
-            if elapsed >= session_timeout_minutes:
+            if elapsed >= tenant.session_timeout_minutes:
                 session.messages.clear()
+                tenant.agent.planner.forget(session.id)
+                sessions.touch(session)
+                bus.publish("session.updated", {"session": _session_summary(session)}, tenant=tenant.id)
         except (ValueError, TypeError):
             pass
 
     # Add user message
-    user_msg = ChatMessage(role="user", content=req.message)
-    session.messages.append(user_msg)
-    logger.debug("chat session=%s mode=%s message=%r", req.session_id, session.mode, req.message[:100])
     session.last_activity = datetime.now().isoformat()
+    user_msg = Message("user", req.message)
+    _append_message(session, user_msg)
+    trace["user_msg"] = user_msg
+    logger.debug("chat session=%s mode=%s message=%r", req.session_id, session.mode, req.message[:100])
 
     # Update session prompt_context if provided in request
     if req.prompt_context is not None:
@@ -321,9 +769,11 @@ async def send_message(req: SendMessageRequest):
     # If session is in handoff/human mode, save message but don't call LLM
     if session.mode in ("handoff_pending", "human"):
         logger.debug("chat session=%s skipped (mode=%s)", req.session_id, session.mode)
+        trace["path"] = "human"
         return {"reply": None, "mode": session.mode, "handoff": True}
 
     # Fixed greeting bypass — return exact text without LLM
+    greeting_config = tenant.greeting_config
     if greeting_config["enabled"] and greeting_config["text"].strip():
         is_first_message = len(session.messages) <= 1
         if is_first_message:
@@ -331,27 +781,52 @@ async def send_message(req: SendMessageRequest):
             msg_lower = req.message.strip().lower()
             if not patterns or any(p.lower() in msg_lower for p in patterns):
                 reply = greeting_config["text"]
-                assistant_msg = ChatMessage(role="assistant", content=reply)
-                session.messages.append(assistant_msg)
+                assistant_msg = Message("assistant", reply)
+                _append_message(session, assistant_msg)
+                trace["path"] = "greeting"
                 return {"reply": reply, "timestamp": assistant_msg.timestamp}
 
+    # A/B experiment: the conversation's variant (not when the simulator overrides the prompt)
+    system_prompt_override, model_override = req.system_prompt_override, None
+    if tenant.experiment is not None and req.system_prompt_override is None:
+        variant = tenant.experiment.assign(session.phone_number or session.id)
+        system_prompt_override = variant["system_prompt"] or None
+        model_override = variant["model"] or None
+        trace["experiment"] = {
+            "id": tenant.experiment.id,
+            "variant": variant["name"],
+            "model": model_override or tenant.agent.model,
+            "system_prompt": system_prompt_override,
+        }
+
     # Get agent response with RAG
     debug_info = None
+    kb = await tenant.knowledge()
     try:
-        result = await agent.chat(
+        result = await tenant.agent.chat(
             session.messages[:-1],
             req.message,
             knowledge_base=kb,
             prompt_context=getattr(session, "prompt_context", "") or "",
-            system_prompt_override=req.system_prompt_override,
+            system_prompt_override=system_prompt_override,
+            session_id=session.id,
+            model_override=model_override,
         )
         reply = result["reply"]
         debug_info = result.get("debug")
+        trace["llm"] = {
+            "reply": reply,
+            "response_time_ms": debug_info["response_time_ms"],
+            "token_usage": debug_info["token_usage"],
+            "rag_sources": debug_info["rag"]["sources"],
+        }
     except Exception as e:
+        if not trace["inline_errors"]:
+            raise
         reply = f"[Error del agente: {e}]"
 
     # Post-process image markers
-    processed = process_reply(reply)
+    processed = process_reply(reply, tenant.images)
     clean_reply = processed["text"]
 
     # Detect [HANDOFF] tag anywhere in reply and remove it.
@@ -366,24 +841,26 @@ async def send_message(req: SendMessageRequest):
         logger.info("handoff triggered session=%s reason='Derivado por Nico'", req.session_id)
 
     # Add assistant message (clean text, no markers)
-    assistant_msg = ChatMessage(role="assistant", content=clean_reply, source="bot")
-    session.messages.append(assistant_msg)
+    assistant_msg = Message("assistant", clean_reply, source="bot")
+    _append_message(session, assistant_msg)
+    if handoff:
+        _publish_handoff(session)
 
     out = {"reply": clean_reply, "timestamp": assistant_msg.timestamp, "mode": session.mode, "handoff": handoff}
     if processed["images"]:
         out["images"] = processed["images"]
     if debug_info is not None:
         out["debug"] = debug_info
+    if trace["experiment"]:
+        out["experiment"] = {k: trace["experiment"][k] for k in ("id", "variant")}
     return out
 
 
 # --- Handoff ---
 
 @app.post("/api/sessions/{session_id}/handoff")
-async def set_handoff(session_id: str, req: HandoffRequest):
-    session = sessions.get(session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def set_handoff(session_id: str, req: HandoffRequest, tenant: Tenant = Depends(current_tenant)):
+    session = _tenant_session(tenant, session_id)
     if req.mode not in ("handoff_pending", "human", "bot"):
         raise HTTPException(status_code=400, detail="Invalid mode")
 
@@ -392,103 +869,281 @@ async def set_handoff(session_id: str, req: HandoffRequest):
     if req.mode == "handoff_pending":
         session.handoff_reason = req.reason or "Derivacion manual"
         session.handoff_at = datetime.now().isoformat()
-        sys_msg = ChatMessage(role="assistant", content="[Sistema] Sesion derivada a un operador.", source="system")
-        session.messages.append(sys_msg)
+        sys_msg = Message("assistant", "[Sistema] Sesion derivada a un operador.", source="system")
+        _append_message(session, sys_msg)
     elif req.mode == "bot":
         session.handoff_reason = ""
         session.handoff_at = ""
-        sys_msg = ChatMessage(role="assistant", content="[Sistema] Nico retomo la conversacion.", source="system")
-        session.messages.append(sys_msg)
+        sys_msg = Message("assistant", "[Sistema] Nico retomo la conversacion.", source="system")
+        _append_message(session, sys_msg)
 
+    _publish_handoff(session)
     return {"ok": True, "mode": session.mode}
 
 
 @app.post("/api/sessions/{session_id}/reply")
-async def operator_reply(session_id: str, req: OperatorReplyRequest):
-    session = sessions.get(session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
+async def operator_reply(session_id: str, req: OperatorReplyRequest, tenant: Tenant = Depends(current_tenant)):
+    session = _tenant_session(tenant, session_id)
     if session.mode not in ("handoff_pending", "human"):
         raise HTTPException(status_code=400, detail="Session is not in handoff mode")
 
-    if session.mode == "handoff_pending":
+    taken = session.mode == "handoff_pending"
+    if taken:
         session.mode = "human"
 
-    msg = ChatMessage(role="assistant", content=req.message, source="human")
-    session.messages.append(msg)
+    msg = Message("assistant", req.message, source="human")
+    _append_message(session, msg)
+    if taken:
+        _publish_handoff(session)
+    if session.channel == "whatsapp":
+        outbound.send_text(session.phone_number, req.message)
     return {"ok": True, "timestamp": msg.timestamp, "mode": session.mode}
 
 
 @app.get("/api/handoffs/pending")
-async def pending_handoffs():
+async def pending_handoffs(tenant: Tenant = Depends(current_tenant)):
+    rows, _ = sessions.page(modes=HANDOFF_MODES, tenant=tenant.id)
     pending = [
         {
-            "id": s.id,
-            "phone_number": s.phone_number,
-            "handoff_reason": s.handoff_reason,
-            "handoff_at": s.handoff_at,
+            "id": r["id"],
+            "phone_number": r["phone_number"],
+            "handoff_reason": r["handoff_reason"],
+            "handoff_at": r["handoff_at"],
         }
-        for s in sessions.values()
-        if s.mode in ("handoff_pending", "human")
+        for r in rows
     ]
     return {"count": len(pending), "sessions": pending}
 
 
+@app.get("/api/events")
+async def events(request: Request, last_event_id: int = Query(None), tenant: Tenant = Depends(current_tenant)):
+    """SSE stream for the operator console. EventSource resends Last-Event-ID on reconnect."""
+    header = request.headers.get("last-event-id")
+    if last_event_id is None and header and header.isdigit():
+        last_event_id = int(header)
+    return StreamingResponse(
+        bus.stream(last_event_id, tenant=tenant.id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# --- WhatsApp webhook ---
+
+@app.get("/api/whatsapp/webhook")
+async def verify_whatsapp_webhook(
+    hub_mode: str = Query("", alias="hub.mode"),
+    hub_verify_token: str = Query("", alias="hub.verify_token"),
+    hub_challenge: str = Query("", alias="hub.challenge"),
+):
+    if hub_mode == "subscribe" and WHATSAPP_VERIFY_TOKEN and hub_verify_token == WHATSAPP_VERIFY_TOKEN:
+        return Response(content=hub_challenge, media_type="text/plain")
+    raise HTTPException(status_code=403, detail="Verification failed")
+
+
+@app.post("/api/whatsapp/webhook")
+async def whatsapp_webhook(request: Request, tenant: Tenant = Depends(current_tenant)):
+    """Acknowledge right away: messages are queued (deduplicated by provider id) for the workers."""
+    body = await request.body()
+    # Unsigned payloads only for local testing with the fake sender (build_sender requires the secret otherwise)
+    signed = WHATSAPP_APP_SECRET or not isinstance(sender, whatsapp.FakeSender)
+    if signed and not whatsapp.verify_signature(
+        WHATSAPP_APP_SECRET, body, request.headers.get("x-hub-signature-256", "")
+    ):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    queued = duplicates = 0
+    for msg in whatsapp.parse_webhook(payload):
+        msg["tenant"] = tenant.id
+        if await asyncio.to_thread(inbound_queue.enqueue, msg["id"], msg["phone"], msg):
+            queued += 1
+        else:
+            duplicates += 1
+    if queued:
+        _queue_wakeup.set()
+    logger.debug("webhook: queued=%d duplicates=%d", queued, duplicates)
+    return {"ok": True, "queued": queued, "duplicates": duplicates}
+
+
+@app.get("/api/whatsapp/queue")
+async def whatsapp_queue_stats():
+    return await asyncio.to_thread(inbound_queue.stats)
+
+
+@app.get("/api/whatsapp/outbound")
+async def whatsapp_outbound_stats():
+    return outbound.stats()
+
+
+@app.get("/api/whatsapp/outbox")
+async def whatsapp_outbox(limit: int = Query(50, ge=1, le=500)):
+    """Messages recorded by the fake sender (local testing without WhatsApp credentials)."""
+    if not isinstance(sender, whatsapp.FakeSender):
+        raise HTTPException(status_code=404, detail="Outbox only available with the fake sender")
+    return {"sent": sender.sent[-limit:]}
+
+
 # --- Knowledge Base ---
 
 @app.post("/api/knowledge/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
     content = await file.read()
     filename = file.filename or "documento"
 
+    # KB writes run in a thread: they wait on a running rebuild (KnowledgeBase._write_lock)
     if filename.lower().endswith(".pdf"):
-        result = kb.add_pdf(content, filename)
+        result = await asyncio.to_thread(kb.add_pdf, content, filename)
     else:
         text = content.decode("utf-8", errors="ignore")
-        result = kb.add_text(text, filename, "note")
+        result = await asyncio.to_thread(kb.add_text, text, filename, "note")
 
     return result
 
 
 @app.post("/api/knowledge/text")
-async def add_text(title: str = Form(...), text: str = Form(...), doc_type: str = Form("note")):
+async def add_text(title: str = Form(...), text: str = Form(...), doc_type: str = Form("note"), tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
     if not text.strip():
         raise HTTPException(status_code=400, detail="Text cannot be empty")
-    result = kb.add_text(text, title, doc_type)
+    result = await asyncio.to_thread(kb.add_text, text, title, doc_type)
     return result
 
 
 @app.post("/api/knowledge/chat-export")
-async def add_chat_export(title: str = Form(...), text: str = Form(...)):
+async def add_chat_export(title: str = Form(...), text: str = Form(...), tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
     if not text.strip():
         raise HTTPException(status_code=400, detail="Text cannot be empty")
-    result = kb.add_chat_export(text, title)
+    result = await asyncio.to_thread(kb.add_chat_export, text, title)
     return result
 
 
+@app.get("/api/retrieval/stats")
+async def retrieval_stats(tenant: Tenant = Depends(current_tenant)):
+    """Retrieval planner: searches vs reused/skipped turns and the time saved."""
+    return tenant.agent.planner.stats()
+
+
 @app.get("/api/knowledge/documents")
-async def list_documents():
+async def list_documents(tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
     return kb.list_documents()
 
 
 @app.delete("/api/knowledge/documents/{doc_id}")
-async def delete_document(doc_id: str):
-    deleted = kb.delete_document(doc_id)
+async def delete_document(doc_id: str, tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
+    deleted = await asyncio.to_thread(kb.delete_document, doc_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Document not found")
     return {"ok": True}
 
 
 @app.put("/api/knowledge/documents/{doc_id}/metadata")
-async def update_document_metadata(doc_id: str, req: dict):
+async def update_document_metadata(doc_id: str, req: dict, tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
     category = req.get("category")
     priority = req.get("priority")
-    updated = kb.update_document_metadata(doc_id, category=category, priority=priority)
+    updated = await asyncio.to_thread(kb.update_document_metadata, doc_id, category=category, priority=priority)
     if not updated:
         raise HTTPException(status_code=404, detail="Document not found")
     return {"ok": True}
 
 
+# Index rebuild per tenant (runs in a thread; writes to the KB wait for it)
+kb_rebuilds: dict[str, dict] = {}
+_rebuild_tasks: set[asyncio.Task] = set()
+
+
+class RebuildIndexRequest(BaseModel):
+    M: int | None = None
+    construction_ef: int | None = None
+    search_ef: int | None = None
+
+
+async def _rebuild_index(tenant_id: str, kb, hnsw: dict) -> None:
+    state = kb_rebuilds[tenant_id]
+    try:
+        result = await asyncio.to_thread(kb.rebuild, hnsw)
+        state.update(state="done", **result)
+    except Exception as e:
+        logger.exception("index rebuild failed for tenant %s", tenant_id)
+        state.update(state="error", error=str(e))
+    state["finished_at"] = datetime.now().isoformat()
+
+
+@app.get("/api/knowledge/maintenance")
+async def knowledge_maintenance(tenant: Tenant = Depends(current_tenant)):
+    """HNSW index size, tombstones and disk usage under data/chroma, plus the last rebuild."""
+    kb = await tenant.knowledge()
+    return {
+        "index": await asyncio.to_thread(kb.index_stats),
+        "rebuild": kb_rebuilds.get(tenant.id, {"state": "idle"}),
+    }
+
+
+@app.post("/api/knowledge/maintenance/rebuild", status_code=202)
+async def rebuild_knowledge_index(req: RebuildIndexRequest = RebuildIndexRequest(),
+                                  tenant: Tenant = Depends(current_tenant)):
+    """Compact the index / apply new HNSW params in the background (poll GET .../maintenance)."""
+    if kb_rebuilds.get(tenant.id, {}).get("state") == "running":
+        raise HTTPException(status_code=409, detail="A rebuild is already running")
+    kb = await tenant.knowledge()
+    hnsw = req.model_dump(exclude_none=True)
+    kb_rebuilds[tenant.id] = {"state": "running", "hnsw": {**kb.hnsw, **hnsw},
+                              "started_at": datetime.now().isoformat()}
+    task = asyncio.create_task(_rebuild_index(tenant.id, kb, hnsw))
+    _rebuild_tasks.add(task)
+    task.add_done_callback(_rebuild_tasks.discard)
+    return kb_rebuilds[tenant.id]
+
+
+def _snapshot_dir(tenant: Tenant) -> str:
+    from app.knowledge import SNAPSHOT_DIR
+    return tenant.config.get("knowledge", {}).get("snapshot", {}).get("dir", SNAPSHOT_DIR)
+
+
+@app.post("/api/knowledge/snapshot")
+async def export_knowledge_snapshot(tenant: Tenant = Depends(current_tenant)):
+    """Chunks + metadata + embeddings to data/snapshots/<collection>-<hash>.npz."""
+    kb = await tenant.knowledge()
+    try:
+        return await asyncio.to_thread(kb.export_snapshot, _snapshot_dir(tenant))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/knowledge/snapshots")
+async def list_knowledge_snapshots(tenant: Tenant = Depends(current_tenant)):
+    from app.knowledge import list_snapshots
+    return await asyncio.to_thread(list_snapshots, tenant.collection_name, _snapshot_dir(tenant))
+
+
+class RestoreSnapshotRequest(BaseModel):
+    hash: str
+    replace: bool = False
+
+
+@app.post("/api/knowledge/snapshots/restore")
+async def restore_knowledge_snapshot(req: RestoreSnapshotRequest, tenant: Tenant = Depends(current_tenant)):
+    """Load a snapshot without re-embedding; replace=true swaps out the current contents."""
+    from app.knowledge import list_snapshots
+    kb = await tenant.knowledge()
+    snapshots = await asyncio.to_thread(list_snapshots, tenant.collection_name, _snapshot_dir(tenant))
+    snapshot = next((s for s in snapshots if s["hash"] == req.hash), None)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    try:
+        return await asyncio.to_thread(kb.import_snapshot, snapshot["path"], req.replace)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
 # --- Product Images ---
 
 @app.post("/api/images/upload")
@@ -497,13 +1152,18 @@ async def upload_image(
     title: str = Form(...),
     description: str = Form(""),
     tags: str = Form(""),
+    tenant: Tenant = Depends(current_tenant),
 ):
+    kb = await tenant.knowledge()
     if not title.strip():
         raise HTTPException(status_code=400, detail="Title is required")
 
     file_bytes = await file.read()
     original_filename = file.filename or "image.jpg"
-    entry = image_registry.add_image(file_bytes, original_filename, title.strip(), description.strip(), tags.strip())
+    # Resizing + encoding the derivatives is CPU-bound: keep it off the event loop
+    entry = await asyncio.to_thread(
+        tenant.images.add_image, file_bytes, original_filename, title.strip(), description.strip(), tags.strip(),
+    )
 
     # Index description in RAG so the agent knows the image exists
     rag_text = (
@@ -512,29 +1172,38 @@ async def upload_image(
         f"Tags: {tags.strip()}\n"
         f"Para mostrar esta imagen en la respuesta, escribi: [IMAGEN: {title.strip()}]"
     )
-    rag_result = kb.add_text(rag_text, f"img:{title.strip()}", "image")
+    rag_result = await asyncio.to_thread(kb.add_text, rag_text, f"img:{title.strip()}", "image")
     entry["rag_doc_id"] = rag_result["id"]
 
     return entry
 
 
 @app.get("/api/images")
-async def list_images():
-    return image_registry.list_images()
+async def list_images(tenant: Tenant = Depends(current_tenant)):
+    return [
+        {
+            **entry,
+            "url": tenant.images.get_image_url(entry),
+            "thumb_url": tenant.images.get_image_url(entry, size="thumb", fmt="webp"),
+            "full_url": tenant.images.get_image_url(entry, size="large"),
+        }
+        for entry in tenant.images.list_images()
+    ]
 
 
 @app.delete("/api/images/{image_id}")
-async def delete_image(image_id: str):
-    entry = image_registry.delete_image(image_id)
+async def delete_image(image_id: str, tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
+    entry = await asyncio.to_thread(tenant.images.delete_image, image_id)
     if not entry:
         raise HTTPException(status_code=404, detail="Image not found")
 
     # Remove from RAG: find doc with source "img:{title}"
     rag_source = f"img:{entry['title']}"
-    docs = kb.list_documents()
+    docs = await asyncio.to_thread(kb.list_documents)
     for doc in docs:
         if doc["filename"] == rag_source:
-            kb.delete_document(doc["id"])
+            await asyncio.to_thread(kb.delete_document, doc["id"])
             break
 
     return {"ok": True}
@@ -542,26 +1211,28 @@ async def delete_image(image_id: str):
 
 # --- Training Materials ---
 
-TRAINING_DIR = Path("training")
 SUPPORTED_EXTENSIONS = {".txt", ".pdf", ".yaml", ".yml"}
 
 
 @app.get("/api/training/materials")
-async def list_training_materials():
-    if not TRAINING_DIR.exists():
+async def list_training_materials(tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
+    training_dir = tenant.training_dir
+    if not training_dir.exists():
         return []
 
     indexed_sources = {d["filename"] for d in kb.list_documents()}
     files = []
-    exclude_dirs = {"evaluaciones"}
-    for path in sorted(TRAINING_DIR.rglob("*")):
+    # training/tenants/<id>/ belongs to the other tenants
+    exclude_dirs = {"evaluaciones", "tenants"}
+    for path in sorted(training_dir.rglob("*")):
         if not path.is_file():
             continue
-        if any(part in exclude_dirs for part in path.relative_to(TRAINING_DIR).parts):
+        if any(part in exclude_dirs for part in path.relative_to(training_dir).parts):
             continue
         if path.suffix.lower() not in SUPPORTED_EXTENSIONS:
             continue
-        rel = str(path.relative_to(TRAINING_DIR))
+        rel = str(path.relative_to(training_dir))
         file_type = "chat" if ".chat." in path.name.lower() else path.suffix.lstrip(".")
         files.append({
             "path": rel,
@@ -576,15 +1247,22 @@ class ImportTrainingRequest(BaseModel):
 
 
 @app.post("/api/training/import")
-async def import_training(req: ImportTrainingRequest):
+async def import_training(req: ImportTrainingRequest, tenant: Tenant = Depends(current_tenant)):
+    kb = await tenant.knowledge()
+    imported = await asyncio.to_thread(_import_training_files, kb, tenant.training_dir, req.paths)
+    return {"imported": imported}
+
+
+def _import_training_files(kb, training_dir: Path, paths: list[str]) -> int:
+    """Index training files into the KB (blocking: file reads, embedding, write lock)."""
     imported = 0
-    for rel_path in req.paths:
-        full = TRAINING_DIR / rel_path
+    for rel_path in paths:
+        full = training_dir / rel_path
         if not full.exists() or not full.is_file():
             continue
         # Prevent path traversal
         try:
-            full.resolve().relative_to(TRAINING_DIR.resolve())
+            full.resolve().relative_to(training_dir.resolve())
         except ValueError:
             continue
 
@@ -601,22 +1279,44 @@ async def import_training(req: ImportTrainingRequest):
         else:
             continue
         imported += 1
-    return {"imported": imported}
+    return imported
 
 
 # --- Evaluations ---
 
-evaluator = Evaluator(
-    agent=agent,
-    knowledge_base=kb,
-    test_cases_path="training/evaluaciones/test-cases.yaml",
-)
-
-introspector = Introspector(agent=agent, knowledge_base=kb)
+# Built on first use per tenant: keeps evaluator/introspector imports and the KB out of
+# the startup path
+
+
+async def get_evaluator(tenant: Tenant = Depends(current_tenant)):
+    if tenant.evaluator is None:
+        from app.evaluator import Evaluator
+        kb = await tenant.knowledge()
+        # Re-checked after the await: a concurrent first request may have built it meanwhile
+        if tenant.evaluator is None:
+            tenant.evaluator = Evaluator(
+                agent=tenant.agent,
+                knowledge_base=kb,
+                test_cases_path=str(tenant.training_dir / "evaluaciones" / "test-cases.yaml"),
+                judge_cache=judge_cache,
+                judge_batch_size=evaluation_config.get("judge_batch_size", 1),
+                history=eval_history,
+                tenant=tenant.id,
+            )
+    return tenant.evaluator
+
+
+async def get_introspector(tenant: Tenant = Depends(current_tenant)):
+    if tenant.introspector is None:
+        from app.introspector import Introspector
+        kb = await tenant.knowledge()
+        if tenant.introspector is None:  # same as get_evaluator
+            tenant.introspector = Introspector(agent=tenant.agent, knowledge_base=kb)
+    return tenant.introspector
 
 
 @app.get("/api/evaluations/test-cases")
-async def list_test_cases():
+async def list_test_cases(evaluator=Depends(get_evaluator)):
     return evaluator.load_test_cases()
 
 
@@ -625,26 +1325,67 @@ class AddTestCaseRequest(BaseModel):
     user_message: str
     expected_behaviors: list[str]
     tags: list[str] = []
+    expected_sources: list[str] = []
+    expected_chunks: list[str] = []
 
 
 @app.post("/api/evaluations/test-cases")
-async def add_test_case(req: AddTestCaseRequest):
-    tc = evaluator.add_test_case(req.name, req.user_message, req.expected_behaviors, req.tags)
+async def add_test_case(req: AddTestCaseRequest, evaluator=Depends(get_evaluator)):
+    tc = evaluator.add_test_case(
+        req.name, req.user_message, req.expected_behaviors, req.tags,
+        expected_sources=req.expected_sources, expected_chunks=req.expected_chunks,
+    )
     return tc
 
 
 class RunEvalRequest(BaseModel):
     use_llm_judge: bool = False
+    judge_batch_size: int | None = None  # cases per judge call (None = evaluation.judge_batch_size)
+    incremental: bool = False  # re-run only the cases whose prompt/model/chunks changed since the last run
 
 
 @app.post("/api/evaluations/run")
-async def run_all_evaluations(req: RunEvalRequest):
-    report = await evaluator.run_all(use_llm_judge=req.use_llm_judge)
+async def run_all_evaluations(req: RunEvalRequest, evaluator=Depends(get_evaluator)):
+    report = await evaluator.run_all(
+        use_llm_judge=req.use_llm_judge, judge_batch_size=req.judge_batch_size, incremental=req.incremental,
+    )
     return report
 
 
+@app.get("/api/evaluations/runs")
+async def list_evaluation_runs(limit: int = 20, scope: str | None = None, tenant: Tenant = Depends(current_tenant)):
+    """Newest first. scope: '' for the tenant's own runs, "<experiment>/<variant>" for a
+    variant's; all of them when omitted."""
+    return eval_history.list_runs(tenant.id, limit=limit, scope=scope)
+
+
+@app.get("/api/evaluations/runs/{run_id}")
+async def get_evaluation_run(run_id: str, tenant: Tenant = Depends(current_tenant)):
+    run = eval_history.get_run(tenant.id, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+
+@app.get("/api/evaluations/runs/{run_id}/diff")
+async def diff_evaluation_runs(run_id: str, against: str = "", tenant: Tenant = Depends(current_tenant)):
+    """Per-case changes of a run vs `against` (default: the run before it)."""
+    run = eval_history.get_run(tenant.id, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    base = eval_history.get_run(tenant.id, against) if against else eval_history.previous(tenant.id, run_id)
+    if base is None:
+        raise HTTPException(status_code=404, detail="No run to compare against")
+    return {"run": run_id, "against": base["id"], **diff_runs(base["results"], run["results"])}
+
+
+@app.get("/api/evaluations/judge-cache")
+async def judge_cache_stats():
+    return judge_cache.stats()
+
+
 @app.post("/api/evaluations/run/{test_id}")
-async def run_single_evaluation(test_id: str, req: RunEvalRequest):
+async def run_single_evaluation(test_id: str, req: RunEvalRequest, evaluator=Depends(get_evaluator)):
     cases = evaluator.load_test_cases()
     tc = next((c for c in cases if c["id"] == test_id), None)
     if not tc:
@@ -653,6 +1394,135 @@ async def run_single_evaluation(test_id: str, req: RunEvalRequest):
     return result
 
 
+class RunRetrievalEvalRequest(BaseModel):
+    k: int = 5
+    fetch_factor: int = 2
+    priority_weight: float = 0.1
+    token_budget: int = 0  # > 0: MMR packing (knowledge.context) instead of top k
+    candidates: int = 20
+    mmr_lambda: float = 0.7
+    category_weight: float = 0.0
+    route: bool = False  # narrow each query with the tenant's category router
+    test_ids: list[str] | None = None
+
+
+@app.post("/api/evaluations/retrieval")
+async def run_retrieval_evaluation(req: RunRetrievalEvalRequest, evaluator=Depends(get_evaluator)):
+    """Search-only evaluation: recall@k, MRR and query latency, no LLM calls."""
+    return await asyncio.to_thread(
+        evaluator.run_retrieval,
+        k=max(1, req.k),
+        fetch_factor=req.fetch_factor,
+        priority_weight=req.priority_weight,
+        token_budget=req.token_budget,
+        candidates=req.candidates,
+        mmr_lambda=req.mmr_lambda,
+        category_weight=req.category_weight,
+        router=evaluator.agent.planner.router if req.route else None,
+        test_ids=req.test_ids,
+    )
+
+
+# --- Experiments (prompt/model A/B) ---
+
+class ExperimentVariant(BaseModel):
+    name: str
+    system_prompt: str = ""  # empty = the tenant's current prompt
+    model: str = ""  # empty = the tenant's current model
+    weight: float = 1
+
+
+class CreateExperimentRequest(BaseModel):
+    name: str
+    variants: list[ExperimentVariant]
+
+
+class RampExperimentRequest(BaseModel):
+    weights: dict[str, float]
+
+
+class RunExperimentEvalRequest(BaseModel):
+    use_llm_judge: bool = False
+    incremental: bool = True
+
+
+def _active_experiment(tenant: Tenant) -> Experiment:
+    if tenant.experiment is None:
+        raise HTTPException(status_code=404, detail="No active experiment")
+    return tenant.experiment
+
+
+def _experiment_state(tenant: Tenant, experiment: Experiment) -> dict:
+    return {
+        **experiment.to_dict(),
+        "shares": experiment.shares(),
+        "metrics": experiment_log.metrics(tenant.id, experiment.id),
+    }
+
+
+@app.get("/api/experiments")
+async def get_experiment(tenant: Tenant = Depends(current_tenant)):
+    if tenant.experiment is None:
+        return {"experiment": None}
+    return {"experiment": await asyncio.to_thread(_experiment_state, tenant, tenant.experiment)}
+
+
+@app.post("/api/experiments")
+async def create_experiment(req: CreateExperimentRequest, tenant: Tenant = Depends(current_tenant)):
+    if tenant.experiment is not None:
+        raise HTTPException(status_code=409, detail=f"Experiment {tenant.experiment.id} is running; stop it first")
+    try:
+        experiment = Experiment(req.name, [v.model_dump() for v in req.variants])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tenant.experiment = experiment
+    tenant.config_store.save_experiment(experiment.to_dict())
+    logger.info("tenant %s: experiment %s started (%s)", tenant.id, experiment.id, experiment.shares())
+    return {"experiment": experiment.to_dict(), "shares": experiment.shares()}
+
+
+@app.put("/api/experiments/weights")
+async def ramp_experiment(req: RampExperimentRequest, tenant: Tenant = Depends(current_tenant)):
+    """Shift traffic between variants; only customers between the old and new split change variant."""
+    experiment = _active_experiment(tenant)
+    try:
+        experiment.set_weights(req.weights)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tenant.config_store.save_experiment(experiment.to_dict())
+    logger.info("tenant %s: experiment %s ramped to %s", tenant.id, experiment.id, experiment.shares())
+    return {"shares": experiment.shares()}
+
+
+@app.delete("/api/experiments")
+async def stop_experiment(tenant: Tenant = Depends(current_tenant)):
+    """Stop the experiment: everyone back on the current prompt/model. Its metrics stay queryable."""
+    experiment = _active_experiment(tenant)
+    tenant.experiment = None
+    tenant.config_store.save_experiment(None)
+    return await asyncio.to_thread(_experiment_state, tenant, experiment)
+
+
+@app.get("/api/experiments/{experiment_id}/metrics")
+async def experiment_metrics(experiment_id: str, tenant: Tenant = Depends(current_tenant)):
+    return await asyncio.to_thread(experiment_log.metrics, tenant.id, experiment_id)
+
+
+@app.post("/api/experiments/eval")
+async def run_experiment_eval(req: RunExperimentEvalRequest, tenant: Tenant = Depends(current_tenant),
+                              evaluator=Depends(get_evaluator)):
+    """Run the eval suite once per variant (incremental by default: unchanged cases are reused)."""
+    experiment = _active_experiment(tenant)
+    out = {}
+    for variant in experiment.variants:
+        report = await evaluator.run_all(
+            use_llm_judge=req.use_llm_judge, incremental=req.incremental, variant=experiment.overrides(variant),
+        )
+        await asyncio.to_thread(experiment_log.record_eval, tenant.id, experiment.id, variant["name"], report)
+        out[variant["name"]] = {k: v for k, v in report.items() if k not in ("results", "diff")}
+    return out
+
+
 # --- Introspection ---
 
 class IntrospectRequest(BaseModel):
@@ -662,6 +1532,110 @@ class IntrospectRequest(BaseModel):
 
 
 @app.post("/api/introspect")
-async def introspect(req: IntrospectRequest):
-    result = await introspector.ask(req.debug_snapshot, req.introspection_history, req.question)
+async def introspect(req: IntrospectRequest, introspector=Depends(get_introspector)):
+    try:
+        result = await introspector.ask(req.debug_snapshot, req.introspection_history, req.question)
+    except BudgetExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
     return result
+
+
+# Batch introspection jobs (in memory, newest MAX_JOBS kept)
+introspection_jobs: dict[str, "IntrospectionJob"] = {}
+_introspection_tasks: set[asyncio.Task] = set()
+
+
+class BatchIntrospectRequest(BaseModel):
+    session_ids: list[str] | None = None  # None = the tenant's most recent sessions
+    max_sessions: int = 100
+    per_session: str = "last"  # "last" bot reply | "all" of them
+    include_simulations: bool = False
+    eval_results: list[dict] = []  # results of an evaluation run; the failed ones are analyzed
+
+
+@app.post("/api/introspect/batch", status_code=202)
+async def start_batch_introspection(req: BatchIntrospectRequest, tenant: Tenant = Depends(current_tenant),
+                                    introspector=Depends(get_introspector), evaluator=Depends(get_evaluator)):
+    """Analyze many conversations / failed eval cases; poll GET /api/introspect/batch/{id}."""
+    from app.batch_introspection import BatchIntrospector, IntrospectionJob, MAX_JOBS, eval_items, session_items
+
+    if req.per_session not in ("last", "all"):
+        raise HTTPException(status_code=400, detail="per_session must be 'last' or 'all'")
+    if req.session_ids is not None:
+        ids = req.session_ids
+    elif req.eval_results:
+        ids = []
+    else:
+        rows, _ = sessions.page(is_simulation=None if req.include_simulations else False,
+                                limit=req.max_sessions, tenant=tenant.id)
+        ids = [r["id"] for r in rows]
+
+    kb = await tenant.knowledge()
+    # Resolved here: restoring an archived session mutates the store, which only the loop does
+    resolved = [s for s in map(sessions.get, ids) if s is not None and s.tenant == tenant.id]
+
+    def build() -> list[dict]:
+        items = []
+        for session in resolved:
+            items += session_items(session, tenant.agent, kb, req.per_session)
+        if req.eval_results:
+            items += eval_items(req.eval_results, evaluator.load_test_cases(), tenant.agent, kb)
+        return items
+
+    items = await asyncio.to_thread(build)
+    if not items:
+        raise HTTPException(status_code=400, detail="Nothing to analyze")
+
+    job = IntrospectionJob(items, tenant=tenant.id)
+    introspection_jobs[job.id] = job
+    while len(introspection_jobs) > MAX_JOBS:
+        introspection_jobs.pop(next(iter(introspection_jobs)))
+    batch_config = client_config.get("introspection", {})
+    runner = BatchIntrospector(
+        introspector,
+        concurrency=batch_config.get("batch_concurrency", 4),
+        rate_per_minute=batch_config.get("batch_rate_per_minute", 60),
+    )
+    task = asyncio.create_task(runner.run(job))
+    _introspection_tasks.add(task)
+    task.add_done_callback(_introspection_tasks.discard)
+    return job.to_dict(include_analyses=False)
+
+
+@app.get("/api/introspect/batch")
+async def list_batch_introspections(tenant: Tenant = Depends(current_tenant)):
+    return [job.to_dict(include_analyses=False) for job in reversed(introspection_jobs.values())
+            if job.tenant == tenant.id]
+
+
+@app.get("/api/introspect/batch/{job_id}")
+async def get_batch_introspection(job_id: str, tenant: Tenant = Depends(current_tenant)):
+    """Progress, merged root causes and ranked proposals (with per-conversation analyses)."""
+    job = introspection_jobs.get(job_id)
+    if job is None or job.tenant != tenant.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+# --- Usage (tokens / cost) ---
+
+@app.get("/api/usage")
+async def usage(
+    group_by: str = Query("day"),
+    hours: float = Query(None, gt=0),
+    session_id: str = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+    tenant: Tenant = Depends(current_tenant),
+):
+    """Token/cost totals for this tenant grouped by day | hour | model | caller | session."""
+    if group_by not in GROUP_BY:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of {sorted(GROUP_BY)}")
+    since = time.time() - hours * 3600 if hours else None
+    return await asyncio.to_thread(
+        ledger.aggregate, group_by, since=since, tenant=tenant.id, session_id=session_id, limit=limit,
+    )
+
+
+@app.get("/api/usage/budget")
+async def usage_budget():
+    return ledger.budget_status()
@@ -1,28 +1,74 @@
-from pydantic import BaseModel
+import sys
+import time
+from functools import lru_cache
+from pydantic import BaseModel, ConfigDict, field_serializer, field_validator
 from datetime import datetime
 
 
 class ChatMessage(BaseModel):
+    """API/serialized shape of a message. Sessions store Message internally."""
     role: str  # "user" or "assistant"
     content: str
     timestamp: str = ""
     source: str = ""  # "bot" | "human" | "system" | "" (user msgs)
+    ts: float = 0.0  # epoch seconds
 
     def model_post_init(self, __context):
         if not self.timestamp:
             self.timestamp = datetime.now().strftime("%H:%M")
 
 
+@lru_cache(maxsize=4096)
+def _hhmm(epoch_minute: int) -> str:
+    # Messages in the same minute share the formatted string
+    return datetime.fromtimestamp(epoch_minute * 60).strftime("%H:%M")
+
+
+class Message:
+    """Compact in-memory message: slotted, epoch timestamp, interned role/source.
+    Long conversations hold thousands of these, so no Pydantic model per message."""
+
+    __slots__ = ("role", "content", "source", "ts")
+
+    def __init__(self, role: str, content: str, source: str = "", ts: float | None = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.source = sys.intern(source)
+        self.ts = time.time() if ts is None else ts
+
+    @property
+    def timestamp(self) -> str:
+        return _hhmm(int(self.ts // 60))
+
+    def to_dict(self) -> dict:
+        """Same fields as ChatMessage."""
+        return {
+            "role": self.role,
+            "content": self.content,
+            "timestamp": self.timestamp,
+            "source": self.source,
+            "ts": self.ts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Message":
+        return cls(data["role"], data["content"], data.get("source", ""), data.get("ts") or None)
+
+
 class ChatSession(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     id: str
     phone_number: str
-    messages: list[ChatMessage] = []
+    messages: list[Message] = []
     prompt_context: str = ""
     created_at: str = ""
     mode: str = "bot"  # "bot" | "handoff_pending" | "human"
     handoff_reason: str = ""
     handoff_at: str = ""
     is_simulation: bool = False
+    channel: str = "web"  # "web" (simulador / admin) | "whatsapp"
+    tenant: str = "default"
     last_activity: str = ""
 
     def model_post_init(self, __context):
@@ -32,6 +78,15 @@ class ChatSession(BaseModel):
         if not self.last_activity:
             self.last_activity = now
 
+    @field_validator("messages", mode="before")
+    @classmethod
+    def _load_messages(cls, value):
+        return [m if isinstance(m, Message) else Message.from_dict(m) for m in value or []]
+
+    @field_serializer("messages")
+    def _dump_messages(self, messages: list[Message]) -> list[dict]:
+        return [m.to_dict() for m in messages]
+
 
 class SendMessageRequest(BaseModel):
     session_id: str
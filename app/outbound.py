@@ -0,0 +1,180 @@
+"""Outbound delivery for WhatsApp replies.
+
+Every reply (bot text + images, operator messages) goes through one dispatcher:
+- per-recipient FIFO: a customer's messages are sent one after another, in order;
+  different customers are served concurrently;
+- a global token bucket keeps the whole process under the provider's messages/sec;
+- failed sends are retried with exponential backoff (4xx other than 429 is final);
+- a reply's text is folded into the first image's caption when it fits, so
+  "text + photo" costs one send instead of two.
+
+send() returns a future that resolves once the whole reply is out (True) or a part
+was dropped (False), so callers can hold on to durable state until then.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger("app.outbound")
+
+CAPTION_LIMIT = 1024  # WhatsApp Cloud API image caption limit
+LATENCY_SAMPLES = 500
+
+
+def coalesce(parts: list[dict]) -> list[dict]:
+    """Merge a text part into the caption of the image that follows it, when possible."""
+    out = []
+    for part in parts:
+        prev = out[-1] if out else None
+        if (
+            part["type"] == "image"
+            and prev is not None
+            and prev["type"] == "text"
+            and len(prev["text"]) <= CAPTION_LIMIT
+        ):
+            out[-1] = {"type": "image", "url": part["url"], "caption": prev["text"]}
+        else:
+            out.append(dict(part))
+    return out
+
+
+def _retryable(exc: Exception) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+
+class RateLimiter:
+    """Token bucket shared by all recipients."""
+
+    def __init__(self, rate_per_second: float, burst: int | None = None):
+        self.rate = rate_per_second
+        self.capacity = burst or max(1, int(rate_per_second))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited_seconds = 0.0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited_seconds += wait
+                await asyncio.sleep(wait)
+
+
+class OutboundDispatcher:
+    def __init__(
+        self,
+        sender,
+        rate_per_second: float = 20.0,
+        max_attempts: int = 4,
+        backoff_seconds: float = 0.5,
+    ):
+        self.sender = sender
+        self.limiter = RateLimiter(rate_per_second)
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._queues: dict[str, deque] = {}
+        self._drainers: dict[str, asyncio.Task] = {}
+        self._latencies: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {"enqueued": 0, "sent": 0, "coalesced": 0, "retries": 0, "failed": 0}
+
+    def send(self, to: str, parts: list[dict]) -> asyncio.Future:
+        """Queue a reply for `to` (parts: {"type": "text", "text"} / {"type": "image", "url", "caption"}).
+
+        Returns immediately (call from the event loop) with a future: True once every
+        part was sent, False if one was dropped after its retries.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        parts = [p for p in parts if p.get("text") or p.get("url")]
+        merged = coalesce(parts)
+        self._counters["coalesced"] += len(parts) - len(merged)
+        if not merged:
+            done.set_result(True)
+            return done
+        now = time.monotonic()
+        reply = {"remaining": len(merged), "ok": True, "done": done}
+        queue = self._queues.setdefault(to, deque())
+        for part in merged:
+            queue.append((now, part, reply))
+        self._counters["enqueued"] += len(merged)
+        if to not in self._drainers:
+            self._drainers[to] = loop.create_task(self._drain(to))
+        return done
+
+    def send_text(self, to: str, text: str) -> asyncio.Future:
+        return self.send(to, [{"type": "text", "text": text}])
+
+    async def _drain(self, to: str) -> None:
+        queue = self._queues[to]
+        try:
+            while queue:
+                enqueued_at, part, reply = queue[0]
+                delivered = await self._deliver(to, part)
+                queue.popleft()
+                if delivered:
+                    self._latencies.append(time.monotonic() - enqueued_at)
+                reply["ok"] = reply["ok"] and delivered
+                reply["remaining"] -= 1
+                if not reply["remaining"] and not reply["done"].done():
+                    reply["done"].set_result(reply["ok"])
+        finally:
+            del self._drainers[to]
+            if not queue:
+                self._queues.pop(to, None)
+
+    async def _deliver(self, to: str, part: dict) -> bool:
+        for attempt in range(1, self.max_attempts + 1):
+            await self.limiter.acquire()
+            try:
+                if part["type"] == "image":
+                    await self.sender.send_image(to, part["url"], part.get("caption", ""))
+                else:
+                    await self.sender.send_text(to, part["text"])
+                self._counters["sent"] += 1
+                return True
+            except Exception as e:
+                if attempt == self.max_attempts or not _retryable(e):
+                    self._counters["failed"] += 1
+                    logger.error("outbound to %s dropped after %d attempts: %s", to, attempt, e)
+                    return False
+                self._counters["retries"] += 1
+                delay = self.backoff_seconds * 2 ** (attempt - 1) * (1 + random.random() * 0.2)
+                logger.warning("outbound to %s failed (attempt %d), retrying in %.1fs: %s", to, attempt, delay, e)
+                await asyncio.sleep(delay)
+        return False
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """Wait for queued messages to go out (used on shutdown)."""
+        tasks = list(self._drainers.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def pct(p: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1) if latencies else 0.0
+
+        return {
+            **self._counters,
+            "queued": sum(len(q) for q in self._queues.values()),
+            "recipients_active": len(self._drainers),
+            "latency_ms_p50": pct(0.5),
+            "latency_ms_p95": pct(0.95),
+            "rate_limit_wait_s": round(self.limiter.waited_seconds, 2),
+        }
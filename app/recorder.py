@@ -0,0 +1,121 @@
+"""Conversation recorder: one JSON line per chat turn, for replaying production traffic.
+
+Each record has what _chat received (message, prompt context, override), the agent
+config in effect, the raw LLM output (reply, token usage, RAG sources) and the final
+result. Files are data/recordings/<YYYY-MM-DD>.jsonl; system prompts are stored once
+under prompts/<sha>.txt and referenced by hash. With redact on, phone numbers and
+emails in message text are masked and the customer's phone is replaced by a hash.
+
+app.replay loads these files (and WhatsApp .chat.txt exports) to re-drive sessions.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger("app.recorder")
+
+PHONE_RE = re.compile(r"\+?\d[\d \-]{6,}\d")
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+
+
+def redact(text: str) -> str:
+    """Mask phone numbers and emails (prices like $1.290 are left alone)."""
+    if not text:
+        return text
+    text = EMAIL_RE.sub("<email>", text)
+    return PHONE_RE.sub(lambda m: "<tel>" if sum(c.isdigit() for c in m.group()) >= 8 else m.group(), text)
+
+
+def prompt_sha(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class ConversationRecorder:
+    def __init__(self, dir: str = "data/recordings", enabled: bool = True, redact: bool = True):
+        self.dir = Path(dir)
+        self.enabled = enabled
+        self.redact = redact
+        self._lock = threading.Lock()
+        self._prompts_saved: set[str] = set()
+        self.recorded = 0
+
+    def _text(self, text: str | None) -> str | None:
+        return redact(text) if self.redact and text else text
+
+    def save_prompt(self, text: str) -> str:
+        """Store a system prompt once; returns its hash."""
+        sha = prompt_sha(text)
+        if sha not in self._prompts_saved:
+            path = self.dir / "prompts" / f"{sha}.txt"
+            if not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(text, encoding="utf-8")
+            self._prompts_saved.add(sha)
+        return sha
+
+    def load_prompt(self, sha: str) -> str | None:
+        path = self.dir / "prompts" / f"{sha}.txt"
+        return path.read_text(encoding="utf-8") if path.exists() else None
+
+    def record(
+        self,
+        session,
+        agent,
+        message: str,
+        prompt_context: str,
+        system_prompt_override: str | None,
+        path: str,
+        result: dict,
+        latency_ms: float,
+        llm: dict | None = None,
+        experiment: dict | None = None,
+    ) -> None:
+        """Append one turn. path: "llm" | "greeting" | "human" (bot paused, no reply)."""
+        if not self.enabled:
+            return
+        try:
+            phone = session.phone_number or ""
+            record = {
+                "ts": datetime.now().isoformat(),
+                "tenant": session.tenant,
+                "session_id": session.id,
+                "channel": session.channel,
+                "phone": prompt_sha(phone)[:12] if self.redact and phone else phone,
+                "path": path,
+                "message": self._text(message),
+                "prompt_context": self._text(prompt_context),
+                "system_prompt_override": self.save_prompt(system_prompt_override) if system_prompt_override else None,
+                "config": {
+                    "model": (experiment or {}).get("model") or agent.model,
+                    "temperature": agent.temperature,
+                    "max_tokens": agent.max_tokens,
+                    "system_prompt": self.save_prompt(agent.system_prompt),
+                },
+                "llm": None,
+                "reply": self._text(result.get("reply")),
+                "handoff": bool(result.get("handoff")),
+                "images": len(result.get("images", [])),
+                "latency_ms": round(latency_ms, 1),
+                "experiment": experiment,
+            }
+            if llm is not None:
+                record["llm"] = {
+                    "reply": self._text(llm.get("reply")),
+                    "response_time_ms": llm.get("response_time_ms"),
+                    "token_usage": llm.get("token_usage"),
+                    "rag_sources": llm.get("rag_sources", []),
+                }
+            line = json.dumps(record, ensure_ascii=False)
+            with self._lock:
+                self.dir.mkdir(parents=True, exist_ok=True)
+                with open(self.dir / f"{datetime.now():%Y-%m-%d}.jsonl", "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+                self.recorded += 1
+        except Exception as e:
+            # Recording must never break a chat turn
+            logger.warning("recording failed for session %s: %s", getattr(session, "id", "?"), e)
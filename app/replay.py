@@ -0,0 +1,244 @@
+"""Replay recorded conversations against a (new) prompt / model / retrieval config.
+
+Input: data/recordings/*.jsonl from ConversationRecorder, or WhatsApp exports
+(.chat.txt, e.g. training/chats-reales) where the customer's messages are re-driven
+and the human replies are the baseline. Each session is replayed turn by turn with
+the replayed replies as history, through the same RAG + LLM + image/handoff steps
+as _chat. The LLM output can be:
+
+    recorded  the recorded reply for that turn (no network; measures retrieval and
+              prompt building, tokens are estimated from the request size)
+    mock      a fixed reply (no network)
+    live      the real model (OPENROUTER_API_KEY)
+
+Report: per-turn latency, tokens, handoff and reply similarity vs the recording,
+plus totals (handoff rate before/after, changed replies, RAG sources changed).
+CLI: python -m benchmarks.replay
+"""
+
+import difflib
+import json
+import re
+import statistics
+import time
+from pathlib import Path
+
+from app.agent import WhatsAppAgent
+from app.image_processor import process_reply
+from app.models import Message
+
+# 12/3/24, 14:05 - Nombre: texto   (Android)   [12/3/24, 14:05:33] Nombre: texto   (iOS)
+EXPORT_LINE_RE = re.compile(
+    r"^\[?(\d{1,2}/\d{1,2}/\d{2,4}),? (\d{1,2}:\d{2}(?::\d{2})?)(?:\s?[apAP]\.?\s?[mM]\.?)?\]?(?: -)? ([^:]{1,60}): (.*)$"
+)
+MEDIA_RE = re.compile(r"<(multimedia omitido|media omitted)>|(imagen|audio|video|sticker) omitid[oa]", re.IGNORECASE)
+MOCK_REPLY = "Dale, te cuento: [mock]"
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+# --- Loading ---
+
+def load_recordings(path: Path) -> list[dict]:
+    """Group recorder lines into sessions: [{"id", "source", "turns": [...]}] in time order."""
+    sessions: dict[tuple, dict] = {}
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        key = (rec.get("tenant", "default"), rec["session_id"])
+        session = sessions.setdefault(key, {"id": f"{key[0]}/{key[1]}", "source": path.name, "turns": []})
+        llm = rec.get("llm") or {}
+        session["turns"].append({
+            "message": rec["message"],
+            "path": rec.get("path", "llm"),
+            "prompt_context": rec.get("prompt_context") or "",
+            "recorded_reply": rec.get("reply"),
+            "recorded_llm_reply": llm.get("reply"),
+            "recorded_handoff": rec.get("handoff", False),
+            "recorded_latency_ms": rec.get("latency_ms"),
+            "recorded_tokens": (llm.get("token_usage") or {}).get("total_tokens"),
+            "recorded_sources": llm.get("rag_sources", []),
+        })
+    return list(sessions.values())
+
+
+def load_chat_export(path: Path, agent_names: list[str] | None = None) -> dict:
+    """A WhatsApp export as one session: each customer message is a turn, the business's
+    following messages (joined) are the recorded reply.
+
+    The business side is whoever matches agent_names; if none given, the author of the
+    first message is taken as the customer.
+    """
+    messages = []  # [author, text]
+    for line in path.read_text(encoding="utf-8", errors="ignore").splitlines():
+        m = EXPORT_LINE_RE.match(line.strip("‎"))
+        if m:
+            messages.append([m.group(3).strip(), m.group(4)])
+        elif messages and line.strip():
+            messages[-1][1] += "\n" + line  # continuation of a multi-line message
+
+    names = {n.lower() for n in agent_names or []}
+    customer = next((a for a, _ in messages if a.lower() not in names), None) if names else (
+        messages[0][0] if messages else None
+    )
+
+    turns = []
+    for author, text in messages:
+        if MEDIA_RE.search(text) or not text.strip():
+            continue
+        if author == customer:
+            if turns and turns[-1]["recorded_reply"] is None:
+                turns[-1]["message"] += "\n" + text  # consecutive customer messages = one turn
+            else:
+                turns.append({
+                    "message": text, "path": "llm", "prompt_context": "",
+                    "recorded_reply": None, "recorded_llm_reply": None, "recorded_handoff": False,
+                    "recorded_latency_ms": None, "recorded_tokens": None, "recorded_sources": [],
+                })
+        elif turns:
+            prev = turns[-1]["recorded_reply"]
+            turns[-1]["recorded_reply"] = f"{prev}\n{text}" if prev else text
+    return {"id": path.name, "source": path.name, "turns": turns}
+
+
+def load_sessions(path: str, agent_names: list[str] | None = None) -> list[dict]:
+    """Sessions from a recording (.jsonl), an export (.txt) or a directory of either."""
+    p = Path(path)
+    files = sorted(f for f in p.rglob("*") if f.suffix in (".jsonl", ".txt")) if p.is_dir() else [p]
+    sessions = []
+    for f in files:
+        if f.suffix == ".jsonl":
+            sessions += load_recordings(f)
+        elif f.parent.name != "prompts":
+            session = load_chat_export(f, agent_names)
+            if session["turns"]:
+                sessions.append(session)
+    return sessions
+
+
+# --- Replay ---
+
+class ReplayAgent(WhatsAppAgent):
+    """WhatsAppAgent whose completion comes from the recording, a mock or the real API."""
+
+    def __init__(self, api_key: str, config: dict, llm: str = "recorded"):
+        super().__init__(api_key=api_key, config=config)
+        self.llm = llm
+        self.next_reply: str | None = None
+
+    async def _post(self, request_body: dict) -> dict:
+        if self.llm == "live":
+            return await super()._post(request_body)
+        reply = self.next_reply if self.llm == "recorded" and self.next_reply is not None else MOCK_REPLY
+        prompt_tokens = sum(_estimate_tokens(m["content"]) for m in request_body["messages"])
+        completion_tokens = _estimate_tokens(reply)
+        return {
+            "choices": [{"message": {"content": reply}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "estimated": True,
+            },
+        }
+
+
+class Replayer:
+    def __init__(self, agent: ReplayAgent, knowledge_base=None, images=None):
+        self.agent = agent
+        self.kb = knowledge_base
+        self.images = images
+
+    async def replay_session(self, session: dict) -> list[dict]:
+        history: list[Message] = []
+        results = []
+        for n, turn in enumerate(session["turns"]):
+            if turn["path"] != "llm":
+                # Greeting / human-mode turns: kept as context, not re-driven
+                history.append(Message("user", turn["message"]))
+                if turn["recorded_reply"]:
+                    history.append(Message("assistant", turn["recorded_reply"]))
+                continue
+
+            self.agent.next_reply = turn["recorded_llm_reply"] or turn["recorded_reply"]
+            t_start = time.perf_counter()
+            try:
+                result = await self.agent.chat(
+                    history, turn["message"], knowledge_base=self.kb, prompt_context=turn["prompt_context"],
+                    session_id=session["id"],
+                )
+                raw, debug = result["reply"], result["debug"]
+            except Exception as e:
+                raw, debug = f"[Error del agente: {e}]", None
+            processed = process_reply(raw, self.images)
+            reply = processed["text"]
+            handoff = "[HANDOFF]" in reply
+            reply = reply.replace("[HANDOFF]", "").strip()
+            latency_ms = (time.perf_counter() - t_start) * 1000
+
+            recorded = turn["recorded_reply"] or ""
+            usage = (debug or {}).get("token_usage", {})
+            sources = (debug or {}).get("rag", {}).get("sources", [])
+            results.append({
+                "session": session["id"],
+                "turn": n,
+                "message": turn["message"],
+                "reply": reply,
+                "recorded_reply": recorded,
+                "similarity": round(difflib.SequenceMatcher(None, recorded, reply).ratio(), 3),
+                "diff": "\n".join(difflib.unified_diff(
+                    recorded.splitlines(), reply.splitlines(), "recorded", "replay", lineterm="",
+                )),
+                "latency_ms": round(latency_ms, 1),
+                "recorded_latency_ms": turn["recorded_latency_ms"],
+                "llm_ms": (debug or {}).get("response_time_ms"),
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "total_tokens": usage.get("total_tokens"),
+                "recorded_tokens": turn["recorded_tokens"],
+                "handoff": handoff,
+                "recorded_handoff": turn["recorded_handoff"],
+                "sources_changed": bool(turn["recorded_sources"]) and set(sources) != set(turn["recorded_sources"]),
+                "images": len(processed["images"]),
+                "retrieval": ((debug or {}).get("rag", {}).get("plan") or {}).get("action"),
+            })
+            history.append(Message("user", turn["message"]))
+            history.append(Message("assistant", reply))
+        return results
+
+    async def run(self, sessions: list[dict]) -> dict:
+        turns = []
+        for session in sessions:
+            turns += await self.replay_session(session)
+        return {"summary": summarize(turns, len(sessions)), "turns": turns}
+
+
+def summarize(turns: list[dict], session_count: int) -> dict:
+    if not turns:
+        return {"sessions": session_count, "turns": 0}
+    latencies = sorted(t["latency_ms"] for t in turns)
+    tokens = [t["total_tokens"] for t in turns if t["total_tokens"] is not None]
+    recorded_tokens = [t["recorded_tokens"] for t in turns if t["recorded_tokens"] is not None]
+
+    def pct(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    return {
+        "sessions": session_count,
+        "turns": len(turns),
+        "latency_ms_p50": pct(0.5),
+        "latency_ms_p95": pct(0.95),
+        "tokens_total": sum(tokens),
+        "tokens_per_turn": round(statistics.mean(tokens), 1) if tokens else None,
+        "recorded_tokens_per_turn": round(statistics.mean(recorded_tokens), 1) if recorded_tokens else None,
+        "handoff_rate": round(sum(t["handoff"] for t in turns) / len(turns), 3),
+        "recorded_handoff_rate": round(sum(t["recorded_handoff"] for t in turns) / len(turns), 3),
+        "replies_changed": sum(t["similarity"] < 1.0 for t in turns),
+        "similarity_mean": round(statistics.mean(t["similarity"] for t in turns), 3),
+        "sources_changed": sum(t["sources_changed"] for t in turns),
+        "retrieval_skipped": sum(t["retrieval"] == "skip" for t in turns),
+        "retrieval_reused": sum(t["retrieval"] == "reuse" for t in turns),
+    }
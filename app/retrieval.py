@@ -0,0 +1,170 @@
+"""Retrieval planner: decides per turn whether (and with what query) to search the KB.
+
+- Non-informational turns ("gracias", "dale", "ok", emojis) don't search; the
+  session's last retrieved chunks are passed along if there are any.
+- Follow-ups that add no new content words ("y cuánto sale?", "ese tenés?") reuse
+  the session's cached chunks, as long as the knowledge base hasn't changed.
+- Otherwise it searches. Short follow-ups ("y la oxandrolona?") are searched together
+  with the previous customer message(s) so the query keeps the conversation topic.
+
+The per-session cache lives in memory (LRU + TTL); stats() reports skip/reuse rates
+and the retrieval time saved (estimated from the running average search time).
+Searches go through `router` (app.category_router) when one is set.
+"""
+
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+
+EMPTY_RESULT = {"chunks": [], "debug": []}
+
+# Mensajes que no piden información
+ACK_WORDS = {
+    "gracias", "muchas", "mil", "dale", "ok", "oka", "okey", "okk", "joya", "genial", "perfecto", "perfecta",
+    "buenisimo", "buenisima", "barbaro", "listo", "si", "sip", "no", "bueno", "buena", "bien", "de", "una",
+    "ah", "aa", "ahh", "jaja", "jajaja", "jeje", "claro", "entendido", "re", "vale", "excelente",
+    "divino", "crack", "capo", "abrazo", "saludos", "chau", "nos", "vemos", "hablamos", "besos", "va",
+}
+
+# Palabras sin contenido para la búsqueda (incluye preguntas genéricas de compra)
+STOPWORDS = {
+    "el", "la", "los", "las", "un", "una", "unos", "unas", "lo", "le", "les", "de", "del", "al", "a", "en",
+    "y", "e", "o", "u", "que", "con", "por", "para", "sin", "me", "te", "se", "mi", "tu", "su", "es", "son",
+    "esta", "este", "ese", "esa", "eso", "esos", "esas", "esto", "aca", "ahi", "otro", "otra", "tambien",
+    "cuanto", "cuantos", "cuanta", "sale", "salen", "cuesta", "cuestan", "precio", "precios", "valor", "vale",
+    "tenes", "tienen", "tenemos", "hay", "tiene", "como", "cual", "cuales", "donde", "cuando", "que",
+    "hola", "buenas", "buen", "dia", "che", "pero", "mas", "muy", "ya", "si", "no", "porfa", "favor",
+    "quiero", "queria", "necesito", "podes", "puedo", "info", "sobre", "hace", "hacen",
+} | ACK_WORDS
+
+FOLLOWUP_CUES = {"y", "e", "ese", "esa", "eso", "esos", "esas", "el", "la", "tambien", "otro", "otra"}
+
+
+def _tokens(text: str) -> list[str]:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r"[a-z0-9]+", text)
+
+
+def content_terms(text: str) -> set[str]:
+    return {t for t in _tokens(text) if t not in STOPWORDS and len(t) > 1}
+
+
+def is_acknowledgement(text: str) -> bool:
+    tokens = _tokens(text)
+    return all(t in ACK_WORDS for t in tokens) and len(tokens) <= 6
+
+
+class _Entry:
+    __slots__ = ("terms", "result", "kb_version", "at")
+
+    def __init__(self, terms: set[str], result: dict, kb_version: int):
+        self.terms = terms
+        self.result = result
+        self.kb_version = kb_version
+        self.at = time.monotonic()
+
+
+class RetrievalPlanner:
+    def __init__(
+        self,
+        enabled: bool = True,
+        cache_ttl_minutes: float = 30,
+        context_turns: int = 2,
+        max_sessions: int = 5000,
+    ):
+        self.enabled = enabled
+        self.ttl = cache_ttl_minutes * 60
+        self.context_turns = context_turns
+        self.max_sessions = max_sessions
+        self._cache: OrderedDict[str, _Entry] = OrderedDict()
+        self._counts = {"search": 0, "reuse": 0, "skip": 0}
+        self._search_ms_avg = 0.0
+        self._saved_ms = 0.0
+        self._filtered = 0
+        self.router = None  # CategoryRouter, set by the agent
+
+    def _cached(self, session_id: str, kb) -> _Entry | None:
+        entry = self._cache.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.at > self.ttl or entry.kb_version != getattr(kb, "version", 0):
+            del self._cache[session_id]
+            return None
+        self._cache.move_to_end(session_id)
+        return entry
+
+    def _query(self, history: list, user_message: str, terms: set[str]) -> str:
+        """The message itself, or the previous customer message(s) + it for short follow-ups."""
+        tokens = _tokens(user_message)
+        followup = not terms or (len(terms) <= 2 and tokens and tokens[0] in FOLLOWUP_CUES)
+        if not followup:
+            return user_message
+        previous = [
+            m.content for m in history if m.role == "user" and not is_acknowledgement(m.content)
+        ][-self.context_turns:]
+        return " ".join(previous + [user_message])
+
+    def _search(self, kb, query: str, search_params: dict) -> dict:
+        if self.router is not None:
+            search_params = {**search_params, **self.router.search_params(query)}
+        result = kb.search_with_debug(query, **search_params)
+        if result.get("categories"):
+            self._filtered += 1
+        return result
+
+    def retrieve(self, kb, session_id: str, history: list, user_message: str, **search_params) -> tuple[dict, dict]:
+        """Returns (search_with_debug-style result, plan {"action", "query", "categories", "search_ms", "saved_ms"})."""
+        if not self.enabled or not session_id:
+            t_start = time.perf_counter()
+            result = self._search(kb, user_message, search_params)
+            return result, {"action": "search", "query": user_message, "categories": result.get("categories", []),
+                            "search_ms": round((time.perf_counter() - t_start) * 1000, 1), "saved_ms": 0}
+
+        entry = self._cached(session_id, kb)
+        if is_acknowledgement(user_message):
+            action, query = "skip", ""
+        else:
+            terms = content_terms(user_message)
+            if entry is not None and terms <= entry.terms:
+                action, query = "reuse", ""
+            else:
+                action, query = "search", self._query(history, user_message, terms)
+
+        self._counts[action] += 1
+        if action != "search":
+            self._saved_ms += self._search_ms_avg
+            return (entry.result if entry else EMPTY_RESULT), {
+                "action": action, "query": "", "categories": [], "search_ms": 0,
+                "saved_ms": round(self._search_ms_avg, 1),
+            }
+
+        t_start = time.perf_counter()
+        result = self._search(kb, query, search_params)
+        search_ms = (time.perf_counter() - t_start) * 1000
+        self._search_ms_avg = search_ms if self._counts["search"] == 1 else 0.9 * self._search_ms_avg + 0.1 * search_ms
+
+        self._cache[session_id] = _Entry(content_terms(query), result, getattr(kb, "version", 0))
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self.max_sessions:
+            self._cache.popitem(last=False)
+        return result, {"action": "search", "query": query, "categories": result.get("categories", []),
+                        "search_ms": round(search_ms, 1), "saved_ms": 0}
+
+    def forget(self, session_id: str) -> None:
+        self._cache.pop(session_id, None)
+
+    def stats(self) -> dict:
+        total = sum(self._counts.values())
+        return {
+            **self._counts,
+            "turns": total,
+            "skip_rate": round(self._counts["skip"] / total, 3) if total else 0.0,
+            "reuse_rate": round(self._counts["reuse"] / total, 3) if total else 0.0,
+            "search_ms_avg": round(self._search_ms_avg, 1),
+            "saved_ms_total": round(self._saved_ms, 1),
+            "saved_ms_per_turn": round(self._saved_ms / total, 1) if total else 0.0,
+            "sessions_cached": len(self._cache),
+            "searches_filtered": self._filtered,
+        }
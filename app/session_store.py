@@ -0,0 +1,314 @@
+"""In-memory session storage with secondary indexes for the operator inbox.
+
+Sessions are grouped by (tenant, mode, is_simulation); each group keeps its ids sorted by
+last activity (newest first), so filtered listings and cursor pagination touch only
+the rows they return instead of scanning every session. The summary row shown in
+lists is cached per session and rebuilt by touch() when the session changes.
+
+Idle sessions can be archived to <archive_dir>/<id>.json.gz and evicted from
+memory; get() reloads them transparently. The phone -> WhatsApp session map is
+persisted in <archive_dir>/phones.db, so a customer returning after a restart
+finds their archived session.
+"""
+
+import gzip
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import sys
+from bisect import bisect_right, insort
+from collections import Counter
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+
+from app.models import ChatSession
+
+
+logger = logging.getLogger("app.session_store")
+
+PREVIEW_CHARS = 50
+
+
+def _activity_ts(session: ChatSession) -> float:
+    try:
+        return datetime.fromisoformat(session.last_activity).timestamp()
+    except (ValueError, TypeError):
+        return 0.0
+
+
+def encode_cursor(key: tuple[float, str]) -> str:
+    return f"{-key[0]:.6f}:{key[1]}"
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    ts, _, session_id = cursor.partition(":")
+    return (-float(ts), session_id)
+
+
+def _from(keys: list, start: int):
+    # islice() would walk the skipped prefix; index directly instead
+    return (keys[i] for i in range(start, len(keys)))
+
+
+def _approx_bytes(session: ChatSession) -> int:
+    """Rough resident size: the model objects plus their string fields."""
+    size = sys.getsizeof(session) + sys.getsizeof(session.__dict__) + sys.getsizeof(session.messages)
+    size += sum(sys.getsizeof(v) for v in session.__dict__.values() if isinstance(v, str))
+    for m in session.messages:
+        # role/source are interned (shared), so only the record, content and ts count
+        size += sys.getsizeof(m) + sys.getsizeof(m.content) + sys.getsizeof(m.ts)
+    return size
+
+
+class SessionStore:
+    def __init__(self, archive_dir: str | None = None):
+        self.archive_dir = Path(archive_dir) if archive_dir else None
+        self._sessions: dict[str, ChatSession] = {}
+        self._summaries: dict[str, dict] = {}
+        # id -> (group, sort key); group = (tenant, mode, is_simulation),
+        # sort key = (-last_activity_ts, id)
+        self._index: dict[str, tuple[tuple[str, str, bool], tuple[float, str]]] = {}
+        self._groups: dict[tuple[str, str, bool], list[tuple[float, str]]] = {}
+        self._mode_counts: Counter = Counter()  # (tenant, mode) -> sessions
+        # (tenant, phone) -> id of its live WhatsApp session; survives eviction (and restarts,
+        # via phones.db) so get() can restore it
+        self._by_phone: dict[tuple[str, str], str] = {}
+        self._phones_db = None
+        if self.archive_dir is not None:
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            self._phones_db = sqlite3.connect(self.archive_dir / "phones.db", isolation_level=None,
+                                              check_same_thread=False)
+            self._phones_db.execute("PRAGMA journal_mode=WAL")
+            self._phones_db.execute(
+                "CREATE TABLE IF NOT EXISTS phones (tenant TEXT NOT NULL, phone TEXT NOT NULL, "
+                "session_id TEXT NOT NULL, PRIMARY KEY (tenant, phone))"
+            )
+            for tenant, phone, session_id in self._phones_db.execute("SELECT tenant, phone, session_id FROM phones"):
+                self._by_phone[(tenant, phone)] = session_id
+
+    # --- dict-like API (main.py treats this as the sessions dict) ---
+
+    def get(self, session_id: str) -> ChatSession | None:
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._restore(session_id)
+        return session
+
+    def __getitem__(self, session_id: str) -> ChatSession:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __setitem__(self, session_id: str, session: ChatSession) -> None:
+        if session_id in self._sessions:
+            self._unindex(session_id)
+        self._sessions[session_id] = session
+        if session.channel == "whatsapp" and self._by_phone.get((session.tenant, session.phone_number)) != session_id:
+            self._by_phone[(session.tenant, session.phone_number)] = session_id
+            if self._phones_db is not None:
+                self._phones_db.execute(
+                    "INSERT OR REPLACE INTO phones (tenant, phone, session_id) VALUES (?, ?, ?)",
+                    (session.tenant, session.phone_number, session_id),
+                )
+        self.touch(session)
+
+    def __delitem__(self, session_id: str) -> None:
+        if session_id not in self._sessions:
+            path = self._archive_path(session_id)
+            if path is None or not path.exists():
+                raise KeyError(session_id)
+            path.unlink()
+            self._forget_phone(session_id)
+            return
+        self.evict(session_id)
+        # A stale archive (written by a sweep that then skipped eviction) would bring it back
+        self.delete_archive(session_id)
+        self._forget_phone(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        if session_id in self._sessions:
+            return True
+        path = self._archive_path(session_id)
+        return path is not None and path.exists()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def values(self):
+        return self._sessions.values()
+
+    def find_by_phone(self, phone: str, tenant: str = "default") -> ChatSession | None:
+        """The tenant's WhatsApp session for a phone number (restored from archive if evicted)."""
+        session_id = self._by_phone.get((tenant, phone))
+        return self.get(session_id) if session_id else None
+
+    # --- indexes ---
+
+    def touch(self, session: ChatSession) -> None:
+        """Re-index a session and rebuild its summary row after any change."""
+        group = (session.tenant, session.mode, session.is_simulation)
+        key = (-_activity_ts(session), session.id)
+        current = self._index.get(session.id)
+        if current != (group, key):
+            if current is not None:
+                self._unindex(session.id)
+            insort(self._groups.setdefault(group, []), key)
+            self._index[session.id] = (group, key)
+            self._mode_counts[(session.tenant, session.mode)] += 1
+
+        last = session.messages[-1].content[:PREVIEW_CHARS] if session.messages else ""
+        self._summaries[session.id] = {
+            "id": session.id,
+            "phone_number": session.phone_number,
+            "last_message": last,
+            "message_count": len(session.messages),
+            "mode": session.mode,
+            "handoff_reason": session.handoff_reason,
+            "handoff_at": session.handoff_at,
+            "last_activity": session.last_activity,
+            "is_simulation": session.is_simulation,
+            "channel": session.channel,
+            "tenant": session.tenant,
+        }
+
+    def summary(self, session_id: str) -> dict:
+        return self._summaries[session_id]
+
+    def count(self, modes: tuple[str, ...] | None = None, tenant: str | None = None) -> int:
+        if modes is None and tenant is None:
+            return len(self._sessions)
+        return sum(
+            n for (t, m), n in self._mode_counts.items()
+            if (modes is None or m in modes) and (tenant is None or t == tenant)
+        )
+
+    def page(
+        self,
+        modes: tuple[str, ...] | None = None,
+        is_simulation: bool | None = None,
+        limit: int | None = None,
+        cursor: str | None = None,
+        tenant: str | None = None,
+    ) -> tuple[list[dict], str | None]:
+        """Summary rows newest-activity first, plus the cursor for the next page."""
+        groups = [
+            keys for (t, mode, sim), keys in self._groups.items()
+            if (modes is None or mode in modes)
+            and (is_simulation is None or sim == is_simulation)
+            and (tenant is None or t == tenant)
+        ]
+        after = decode_cursor(cursor) if cursor else None
+        streams = [_from(keys, bisect_right(keys, after) if after else 0) for keys in groups]
+        merged = heapq.merge(*streams)
+
+        keys = list(islice(merged, limit + 1 if limit else None))
+        next_cursor = None
+        if limit and len(keys) > limit:
+            keys = keys[:limit]
+            next_cursor = encode_cursor(keys[-1])
+        return [self._summaries[k[1]] for k in keys], next_cursor
+
+    def tenant_ids(self) -> set[str]:
+        """Tenants with at least one resident session."""
+        return {t for (t, _, _), keys in self._groups.items() if keys}
+
+    # --- expiry / archive ---
+
+    def expired(
+        self,
+        cutoff_ts: float,
+        is_simulation: bool,
+        modes: tuple[str, ...] | None = None,
+        tenant: str | None = None,
+    ) -> list[ChatSession]:
+        """Sessions whose last activity is older than cutoff_ts (oldest first per group)."""
+        result = []
+        for (t, mode, sim), keys in self._groups.items():
+            if sim != is_simulation or (modes is not None and mode not in modes):
+                continue
+            if tenant is not None and t != tenant:
+                continue
+            # keys are (-ts, id) ascending, so the oldest sessions sit at the end
+            for neg_ts, session_id in reversed(keys):
+                if -neg_ts >= cutoff_ts:
+                    break
+                result.append(self._sessions[session_id])
+        return result
+
+    def write_archive(self, session_id: str, data: dict) -> None:
+        """Write a gzip'd JSON snapshot (blocking — run it off the event loop)."""
+        path = self._archive_path(session_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def is_resident(self, session_id: str) -> bool:
+        return session_id in self._sessions
+
+    def delete_archive(self, session_id: str) -> None:
+        path = self._archive_path(session_id)
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+    def evict(self, session_id: str) -> None:
+        """Drop a session from memory (its archive, if any, stays on disk)."""
+        self._unindex(session_id)
+        del self._sessions[session_id]
+        self._summaries.pop(session_id, None)
+
+    def stats(self) -> dict:
+        archived = len(list(self.archive_dir.glob("*.json.gz"))) if self.archive_dir and self.archive_dir.exists() else 0
+        by_mode: Counter = Counter()
+        for (_, mode), n in self._mode_counts.items():
+            by_mode[mode] += n
+        return {
+            "resident": len(self._sessions),
+            "resident_simulation": sum(len(keys) for (_, _, sim), keys in self._groups.items() if sim),
+            "archived": archived,
+            "approx_bytes": sum(_approx_bytes(s) for s in self._sessions.values()),
+            "by_mode": {m: n for m, n in by_mode.items() if n},
+        }
+
+    def _archive_path(self, session_id: str) -> Path | None:
+        if self.archive_dir is None or not session_id.replace("-", "").isalnum():
+            return None
+        return self.archive_dir / f"{session_id}.json.gz"
+
+    def _restore(self, session_id: str) -> ChatSession | None:
+        path = self._archive_path(session_id)
+        if path is None or not path.exists():
+            return None
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                session = ChatSession(**json.load(f))
+        except (OSError, ValueError) as e:
+            logger.warning("could not restore archived session %s: %s", session_id, e)
+            return None
+        self[session_id] = session
+        path.unlink()
+        logger.info("session %s restored from archive", session_id)
+        return session
+
+    def _forget_phone(self, session_id: str) -> None:
+        for phone, sid in list(self._by_phone.items()):
+            if sid == session_id:
+                del self._by_phone[phone]
+        if self._phones_db is not None:
+            self._phones_db.execute("DELETE FROM phones WHERE session_id = ?", (session_id,))
+
+    def _unindex(self, session_id: str) -> None:
+        group, key = self._index.pop(session_id)
+        keys = self._groups[group]
+        pos = bisect_right(keys, key) - 1
+        if pos >= 0 and keys[pos] == key:
+            del keys[pos]
+        self._mode_counts[group[:2]] -= 1
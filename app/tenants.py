@@ -0,0 +1,305 @@
+"""Tenants: several businesses served by one process.
+
+Each tenant has its own config.yaml, runtime config + prompt history, agent,
+Chroma collection and image registry. "default" is the original single-tenant
+layout (config/config.yaml, data/runtime_config.yaml, collection "knowledge",
+data/images). Other tenants live in:
+
+    config/tenants/<id>/config.yaml (+ catalogo.txt)
+    data/tenants/<id>/               runtime_config.yaml, prompt_versions/
+    data/images/tenants/<id>/        served at /images/tenants/<id>/
+    Chroma collection knowledge_<id> (same data/chroma store)
+
+Tenants are loaded on first use and kept in an LRU; idle ones beyond max_active
+are flushed and dropped, so memory follows the active tenants, not the total.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from app.agent import WhatsAppAgent
+from app.config import load_client_config
+from app.config_store import ConfigStore
+from app.experiments import Experiment
+from app.images import ImageRegistry, IMAGES_DIR, default_registry
+
+
+logger = logging.getLogger("app.tenants")
+
+DEFAULT_TENANT = "default"
+TENANTS_CONFIG_DIR = Path("config/tenants")
+TENANTS_DATA_DIR = Path("data/tenants")
+TENANT_ID_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+
+class TenantNotFound(KeyError):
+    pass
+
+
+class Tenant:
+    def __init__(
+        self,
+        tenant_id: str,
+        config: dict,
+        config_store: ConfigStore,
+        images: ImageRegistry,
+        collection_name: str,
+        training_dir: Path,
+        api_key: str,
+        embedders: "_EmbedderCache",
+        ledger=None,
+    ):
+        self.id = tenant_id
+        self.config = config
+        self.config_store = config_store
+        self.images = images
+        self.collection_name = collection_name
+        self.training_dir = training_dir
+        self.last_used = time.monotonic()
+        self._embedders = embedders
+
+        runtime = config_store.load()
+        self.agent = WhatsAppAgent(api_key=api_key, config=config, ledger=ledger, tenant=tenant_id)
+        self.agent.system_prompt = runtime.get("system_prompt", self.agent.system_prompt)
+        self.agent.update_params(
+            model=runtime.get("model", self.agent.model),
+            temperature=runtime.get("temperature", self.agent.temperature),
+            max_tokens=runtime.get("max_tokens", self.agent.max_tokens),
+        )
+        # Default prompt context, inactivity timeout and fixed greeting (persisted)
+        self.default_prompt_context: str = runtime.get("prompt_context_default", "")
+        self.session_timeout_minutes: int = runtime.get("session_timeout_minutes", 120)
+        self.greeting_config = {
+            "enabled": runtime.get("greeting_enabled", True),
+            "text": runtime.get("greeting_text", ""),
+            "patterns": runtime.get("greeting_patterns", []),
+        }
+
+        # Active prompt/model A/B experiment (app.experiments), persisted in the runtime config
+        self.experiment = Experiment.from_dict(runtime["experiment"]) if runtime.get("experiment") else None
+
+        self._kb = None
+        self._kb_lock = threading.Lock()
+        # Built on first use by main.get_evaluator() / get_introspector()
+        self.evaluator = None
+        self.introspector = None
+
+    @property
+    def kb_loaded(self) -> bool:
+        return self._kb is not None
+
+    def get_kb(self):
+        """Open this tenant's knowledge collection on first use (thread-safe, blocking)."""
+        if self._kb is None:
+            with self._kb_lock:
+                if self._kb is None:
+                    from app.knowledge import KnowledgeBase
+                    embedding = self.config.get("knowledge", {}).get("embedding")
+                    kb = KnowledgeBase(
+                        persist_dir="data/chroma",
+                        embedding=embedding,
+                        collection_name=self.collection_name,
+                        embedder=self._embedders.get(embedding),
+                        hnsw=self.config.get("knowledge", {}).get("hnsw"),
+                    )
+                    self._restore_snapshot(kb)
+                    self._kb = kb
+        return self._kb
+
+    def _restore_snapshot(self, kb) -> None:
+        """Fresh node (the collection was just created): load the newest snapshot instead
+        of re-importing. An existing collection emptied on purpose stays empty."""
+        snapshot_config = self.config.get("knowledge", {}).get("snapshot", {})
+        if not snapshot_config.get("restore_on_empty", True) or not kb.created or kb.collection.count():
+            return
+        from app.knowledge import list_snapshots, SNAPSHOT_DIR
+        for snapshot in list_snapshots(self.collection_name, snapshot_config.get("dir", SNAPSHOT_DIR)):
+            try:
+                kb.import_snapshot(snapshot["path"])
+                return
+            except ValueError as e:
+                logger.warning("tenant %s: snapshot %s not restored: %s", self.id, snapshot["path"], e)
+
+    async def knowledge(self):
+        """Knowledge base for request handlers; opens it off the event loop if needed."""
+        if self._kb is not None:
+            return self._kb
+        return await asyncio.to_thread(self.get_kb)
+
+    def close(self) -> None:
+        self.config_store.flush()
+        atexit.unregister(self.config_store.flush)
+        self._kb = None
+        self.evaluator = None
+        self.introspector = None
+
+
+class _EmbedderCache:
+    """One embedder (ONNX model in memory) per distinct embedding config."""
+
+    def __init__(self):
+        self._embedders: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def get(self, embedding: dict | None):
+        key = json.dumps(embedding or {}, sort_keys=True)
+        with self._lock:
+            if key not in self._embedders:
+                from app.embeddings import build_embedder
+                self._embedders[key] = build_embedder(embedding)
+            return self._embedders[key]
+
+
+class TenantRegistry:
+    def __init__(self, api_key: str, default_config: dict, max_active: int = 8, ledger=None):
+        self.api_key = api_key
+        self.ledger = ledger
+        self.default_config = default_config
+        self.max_active = max(1, max_active)
+        self._active: OrderedDict[str, Tenant] = OrderedDict()
+        # _lock serializes loads/evictions (slow: Chroma, embedders); _active_lock only
+        # guards the OrderedDict, so peek() from the event loop never waits on a load
+        self._lock = threading.RLock()
+        self._active_lock = threading.Lock()
+        self._embedders = _EmbedderCache()
+        # One ImageRegistry per tenant for the process lifetime (shared write lock across reloads)
+        self._images: dict[str, ImageRegistry] = {DEFAULT_TENANT: default_registry}
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, tenant_id: str | None = None) -> Tenant:
+        """Return a tenant, loading it if needed (blocking). Raises TenantNotFound."""
+        tenant_id = tenant_id or DEFAULT_TENANT
+        tenant = self._touch(tenant_id)
+        if tenant is not None:
+            return tenant
+        with self._lock:
+            tenant = self._touch(tenant_id)  # loaded by another thread meanwhile
+            if tenant is None:
+                tenant = self._load(tenant_id)
+                tenant.last_used = time.monotonic()
+                with self._active_lock:
+                    self._active[tenant_id] = tenant
+                    self.loads += 1
+                self._evict_over_capacity(keep=tenant_id)
+            return tenant
+
+    def peek(self, tenant_id: str) -> Tenant | None:
+        """The tenant if it's currently loaded (never loads, doesn't touch the LRU)."""
+        with self._active_lock:
+            return self._active.get(tenant_id)
+
+    def active(self) -> list[Tenant]:
+        with self._active_lock:
+            return list(self._active.values())
+
+    def images_for(self, tenant_id: str) -> ImageRegistry:
+        """The tenant's image registry, whether or not the tenant is loaded."""
+        with self._lock:
+            if tenant_id not in self._images:
+                self._images[tenant_id] = ImageRegistry(
+                    IMAGES_DIR / "tenants" / tenant_id, url_prefix=f"/images/tenants/{tenant_id}",
+                )
+            return self._images[tenant_id]
+
+    def exists(self, tenant_id: str) -> bool:
+        return tenant_id == DEFAULT_TENANT or (
+            bool(TENANT_ID_RE.match(tenant_id)) and (TENANTS_CONFIG_DIR / tenant_id / "config.yaml").exists()
+        )
+
+    def list_ids(self) -> list[str]:
+        ids = [DEFAULT_TENANT]
+        if TENANTS_CONFIG_DIR.exists():
+            ids += sorted(p.parent.name for p in TENANTS_CONFIG_DIR.glob("*/config.yaml") if self.exists(p.parent.name))
+        return ids
+
+    def evict_idle(self, idle_seconds: float) -> int:
+        """Unload tenants unused for idle_seconds (the default tenant stays)."""
+        cutoff = time.monotonic() - idle_seconds
+        with self._lock:
+            idle = [t for t in self.active() if t.id != DEFAULT_TENANT and t.last_used < cutoff]
+            for tenant in idle:
+                self._evict(tenant.id)
+        return len(idle)
+
+    def flush(self) -> None:
+        for tenant in self.active():
+            tenant.config_store.flush()
+
+    def stats(self) -> dict:
+        return {
+            "active": [
+                {"id": t.id, "idle_s": round(time.monotonic() - t.last_used, 1), "knowledge_loaded": t.kb_loaded}
+                for t in self.active()
+            ],
+            "max_active": self.max_active,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+    def _load(self, tenant_id: str) -> Tenant:
+        if not self.exists(tenant_id):
+            raise TenantNotFound(tenant_id)
+
+        if tenant_id == DEFAULT_TENANT:
+            tenant = Tenant(
+                tenant_id,
+                config=self.default_config,
+                config_store=ConfigStore(runtime_path="data/runtime_config.yaml", defaults=self.default_config),
+                images=self.images_for(tenant_id),
+                collection_name="knowledge",
+                training_dir=Path("training"),
+                api_key=self.api_key,
+                embedders=self._embedders,
+                ledger=self.ledger,
+            )
+        else:
+            config = load_client_config(str(TENANTS_CONFIG_DIR / tenant_id / "config.yaml"))
+            data_dir = TENANTS_DATA_DIR / tenant_id
+            tenant = Tenant(
+                tenant_id,
+                config=config,
+                config_store=ConfigStore(runtime_path=str(data_dir / "runtime_config.yaml"), defaults=config),
+                images=self.images_for(tenant_id),
+                collection_name=f"knowledge_{tenant_id}",
+                training_dir=Path("training") / "tenants" / tenant_id,
+                api_key=self.api_key,
+                embedders=self._embedders,
+                ledger=self.ledger,
+            )
+        logger.info("tenant %s loaded", tenant_id)
+        return tenant
+
+    def _touch(self, tenant_id: str) -> Tenant | None:
+        with self._active_lock:
+            tenant = self._active.get(tenant_id)
+            if tenant is not None:
+                self._active.move_to_end(tenant_id)
+                tenant.last_used = time.monotonic()
+            return tenant
+
+    def _evict_over_capacity(self, keep: str) -> None:
+        # Least recently used first; never the default tenant or the one just loaded
+        with self._active_lock:
+            ids = list(self._active)
+        for tenant_id in ids:
+            if len(self._active) <= self.max_active:
+                return
+            if tenant_id not in (DEFAULT_TENANT, keep):
+                self._evict(tenant_id)
+
+    def _evict(self, tenant_id: str) -> None:
+        with self._active_lock:
+            tenant = self._active.pop(tenant_id, None)
+            if tenant is None:
+                return
+            self.evictions += 1
+        tenant.close()
+        logger.info("tenant %s unloaded", tenant_id)
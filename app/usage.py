@@ -0,0 +1,280 @@
+"""Usage ledger: every OpenRouter call (chat, LLM judge, introspection) in SQLite.
+
+record() only appends to an in-memory buffer and updates the budget counters; a
+background task (main._flush_usage_forever) writes the buffer with one executemany
+per batch. Aggregates (by session, model, caller, hour, day) are SQL over the table.
+
+Budgets (config.yaml usage.budgets) are checked before each call:
+- daily tokens / cost for the whole process (one OpenRouter key). Over budget,
+  non-critical callers (judge, introspect) are throttled (BudgetExceeded) or moved
+  to the downgrade model; chat, which customers wait on, is only downgraded.
+- tokens per session: over budget, that session's chat uses the downgrade model.
+"""
+
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+
+SESSION_CACHE_SIZE = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    tenant TEXT NOT NULL DEFAULT '',
+    session_id TEXT NOT NULL DEFAULT '',
+    caller TEXT NOT NULL,  -- chat | judge | introspect
+    model TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    latency_ms REAL NOT NULL DEFAULT 0,
+    ok INTEGER NOT NULL DEFAULT 1,
+    downgraded INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_llm_calls_day ON llm_calls (day);
+CREATE INDEX IF NOT EXISTS idx_llm_calls_session ON llm_calls (session_id);
+"""
+
+GROUP_BY = {
+    "day": "day",
+    "hour": "strftime('%Y-%m-%d %H:00', ts, 'unixepoch', 'localtime')",
+    "model": "model",
+    "caller": "caller",
+    "session": "session_id",
+    "tenant": "tenant",
+}
+
+COLUMNS = (
+    "ts", "day", "tenant", "session_id", "caller", "model", "prompt_tokens", "completion_tokens",
+    "cached_tokens", "total_tokens", "cost", "latency_ms", "ok", "downgraded",
+)
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+class UsageLedger:
+    def __init__(
+        self,
+        db_path: str = "data/usage.db",
+        budgets: dict | None = None,
+        critical_callers: tuple[str, ...] = ("chat",),
+        prices: dict | None = None,
+    ):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()  # connection
+        self._buffer_lock = threading.Lock()
+        self._buffer: list[tuple] = []
+
+        budgets = budgets or {}
+        self.daily_tokens = budgets.get("daily_tokens", 0)  # 0 = no limit
+        self.daily_cost = budgets.get("daily_cost", 0)
+        self.session_tokens = budgets.get("session_tokens", 0)
+        self.on_exceeded = budgets.get("on_exceeded", "throttle")  # throttle | downgrade (non-critical)
+        self.downgrade_model = budgets.get("downgrade_model", "")
+        self.critical_callers = tuple(critical_callers)
+        # USD per million tokens, for providers/models that don't report cost
+        self.prices = prices or {}
+
+        # Budget counters in memory; today's totals come from the table at startup
+        self._day = _today()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COALESCE(SUM(total_tokens), 0), COALESCE(SUM(cost), 0) FROM llm_calls WHERE day = ?",
+                (self._day,),
+            ).fetchone()
+        self._day_tokens, self._day_cost = row[0], row[1]
+        self._session_totals: dict[str, int] = {}
+        self.throttled = 0
+        self.downgraded = 0
+
+    # --- Budgets ---
+
+    def _roll_day(self) -> None:
+        today = _today()
+        if today != self._day:
+            self._day, self._day_tokens, self._day_cost = today, 0, 0.0
+
+    def needs_prime(self, caller: str, session_id: str) -> bool:
+        """Whether check() will need this session's total, not loaded yet (see prime_session)."""
+        return bool(
+            session_id and self.session_tokens and caller in self.critical_callers
+            and session_id not in self._session_totals
+        )
+
+    def prime_session(self, session_id: str) -> None:
+        """Load a session's token total from the table (blocking: run it off the event loop)."""
+        if session_id in self._session_totals:
+            return
+        self.flush()
+        with self._lock:
+            used = self._conn.execute(
+                "SELECT COALESCE(SUM(total_tokens), 0) FROM llm_calls WHERE session_id = ?", (session_id,),
+            ).fetchone()[0]
+        if len(self._session_totals) >= SESSION_CACHE_SIZE:
+            del self._session_totals[next(iter(self._session_totals))]  # oldest first
+        self._session_totals.setdefault(session_id, used)
+
+    def day_exceeded(self) -> bool:
+        self._roll_day()
+        return bool(
+            (self.daily_tokens and self._day_tokens >= self.daily_tokens)
+            or (self.daily_cost and self._day_cost >= self.daily_cost)
+        )
+
+    def check(self, caller: str, model: str, session_id: str = "") -> str:
+        """Model to use for this call. Raises BudgetExceeded when a non-critical caller is throttled.
+
+        Never blocks: a session not primed yet (prime_session) counts as unused.
+        """
+        critical = caller in self.critical_callers
+        over = self.day_exceeded()
+        if not over and session_id and self.session_tokens and critical:
+            over = self._session_totals.get(session_id, 0) >= self.session_tokens
+        if not over:
+            return model
+        if not critical and (self.on_exceeded == "throttle" or not self.downgrade_model):
+            self.throttled += 1
+            raise BudgetExceeded(f"presupuesto de tokens agotado ({caller})")
+        if self.downgrade_model and self.downgrade_model != model:
+            self.downgraded += 1
+            return self.downgrade_model
+        return model
+
+    # --- Recording ---
+
+    def _cost(self, model: str, usage: dict) -> float:
+        if usage.get("cost") is not None:
+            return float(usage["cost"])  # OpenRouter, with usage.include
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        return (
+            (usage.get("prompt_tokens") or 0) * price.get("prompt", 0)
+            + (usage.get("completion_tokens") or 0) * price.get("completion", 0)
+        ) / 1_000_000
+
+    def record(
+        self,
+        caller: str,
+        model: str,
+        usage: dict | None,
+        latency_ms: float,
+        tenant: str = "",
+        session_id: str = "",
+        ok: bool = True,
+        downgraded: bool = False,
+    ) -> None:
+        usage = usage or {}
+        prompt = usage.get("prompt_tokens") or 0
+        completion = usage.get("completion_tokens") or 0
+        total = usage.get("total_tokens") or prompt + completion
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        cost = self._cost(model, usage)
+
+        self._roll_day()
+        self._day_tokens += total
+        self._day_cost += cost
+        if session_id in self._session_totals:
+            self._session_totals[session_id] += total
+
+        with self._buffer_lock:
+            self._buffer.append((
+                time.time(), self._day, tenant, session_id, caller, model, prompt, completion,
+                cached, total, cost, round(latency_ms, 1), int(ok), int(downgraded),
+            ))
+
+    def flush(self) -> int:
+        """Write buffered calls in one transaction (blocking)."""
+        with self._buffer_lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                f"INSERT INTO llm_calls ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows,
+            )
+            self._conn.execute("COMMIT")
+        return len(rows)
+
+    # --- Queries ---
+
+    def aggregate(
+        self,
+        group_by: str = "day",
+        since: float | None = None,
+        tenant: str | None = None,
+        session_id: str | None = None,
+        limit: int = 100,
+    ) -> list[dict]:
+        """Totals grouped by day | hour | model | caller | session | tenant (newest/largest first)."""
+        key = GROUP_BY[group_by]
+        where, params = [], []
+        if since is not None:
+            where.append("ts >= ?")
+            params.append(since)
+        if tenant is not None:
+            where.append("tenant = ?")
+            params.append(tenant)
+        if session_id is not None:
+            where.append("session_id = ?")
+            params.append(session_id)
+        order = "key DESC" if group_by in ("day", "hour") else "total_tokens DESC"
+        sql = (
+            f"SELECT {key} AS key, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), "
+            f"SUM(total_tokens) AS total_tokens, SUM(cost), AVG(latency_ms), SUM(1 - ok), SUM(downgraded) "
+            f"FROM llm_calls {'WHERE ' + ' AND '.join(where) if where else ''} "
+            f"GROUP BY key ORDER BY {order} LIMIT ?"
+        )
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(sql, (*params, limit)).fetchall()
+        return [
+            {
+                group_by: r[0],
+                "calls": r[1],
+                "prompt_tokens": r[2],
+                "completion_tokens": r[3],
+                "cached_tokens": r[4],
+                "total_tokens": r[5],
+                "cost": round(r[6], 6),
+                "latency_ms_avg": round(r[7], 1),
+                "errors": r[8],
+                "downgraded": r[9],
+            }
+            for r in rows
+        ]
+
+    def budget_status(self) -> dict:
+        self._roll_day()
+        return {
+            "day": self._day,
+            "tokens_today": self._day_tokens,
+            "cost_today": round(self._day_cost, 6),
+            "daily_tokens": self.daily_tokens,
+            "daily_cost": self.daily_cost,
+            "session_tokens": self.session_tokens,
+            "exceeded": self.day_exceeded(),
+            "on_exceeded": self.on_exceeded,
+            "downgrade_model": self.downgrade_model,
+            "throttled": self.throttled,
+            "downgraded": self.downgraded,
+            "buffered": len(self._buffer),
+        }
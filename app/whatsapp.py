@@ -0,0 +1,126 @@
+"""WhatsApp Cloud API: webhook parsing/verification and outbound senders.
+
+The sender is pluggable: WhatsAppCloudSender talks to the Graph API when
+WHATSAPP_TOKEN and WHATSAPP_PHONE_NUMBER_ID are set; otherwise FakeSender just
+records what would have been sent (local testing).
+"""
+
+import hashlib
+import hmac
+import logging
+from datetime import datetime
+
+import httpx
+
+logger = logging.getLogger("app.whatsapp")
+
+GRAPH_URL = "https://graph.facebook.com/v20.0"
+
+
+def verify_signature(app_secret: str, body: bytes, header: str) -> bool:
+    """Check X-Hub-Signature-256 ("sha256=<hex>") against the raw request body."""
+    if not header.startswith("sha256="):
+        return False
+    expected = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len("sha256="):])
+
+
+def parse_webhook(payload: dict) -> list[dict]:
+    """Extract inbound customer messages from a Cloud API webhook payload.
+
+    Returns [{"id", "phone", "text", "type", "timestamp"}]. Status updates (sent,
+    delivered, read) and unsupported message types without text are skipped.
+    """
+    messages = []
+    for entry in payload.get("entry", []):
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            for msg in value.get("messages", []):
+                msg_type = msg.get("type", "")
+                if msg_type == "text":
+                    text = msg.get("text", {}).get("body", "")
+                elif msg_type == "button":
+                    text = msg.get("button", {}).get("text", "")
+                elif msg_type == "interactive":
+                    reply = msg.get("interactive", {})
+                    text = (reply.get("button_reply") or reply.get("list_reply") or {}).get("title", "")
+                else:
+                    text = ""
+                if not msg.get("id") or not msg.get("from") or not text.strip():
+                    logger.debug("webhook: skipping message type=%s id=%s", msg_type, msg.get("id"))
+                    continue
+                messages.append({
+                    "id": msg["id"],
+                    "phone": msg["from"],
+                    "text": text,
+                    "type": msg_type,
+                    "timestamp": msg.get("timestamp", ""),
+                })
+    return messages
+
+
+class FakeSender:
+    """Records outbound messages in memory instead of sending them.
+
+    Set fail_next = N to make the next N sends raise (exercises retries).
+    """
+
+    def __init__(self, max_kept: int = 500):
+        self.sent: list[dict] = []
+        self.max_kept = max_kept
+        self.fail_next = 0
+
+    async def send_text(self, to: str, text: str) -> dict:
+        return self._record({"to": to, "type": "text", "text": text})
+
+    async def send_image(self, to: str, url: str, caption: str = "") -> dict:
+        return self._record({"to": to, "type": "image", "url": url, "caption": caption})
+
+    def _record(self, message: dict) -> dict:
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise ConnectionError("fake sender: simulated failure")
+        message["sent_at"] = datetime.now().isoformat()
+        self.sent.append(message)
+        del self.sent[:-self.max_kept]
+        return {"id": f"fake-{len(self.sent)}"}
+
+
+class WhatsAppCloudSender:
+    def __init__(self, token: str, phone_number_id: str, public_base_url: str = ""):
+        self.url = f"{GRAPH_URL}/{phone_number_id}/messages"
+        self.token = token
+        self.public_base_url = public_base_url.rstrip("/")
+        self._client = httpx.AsyncClient(timeout=15.0)
+
+    async def send_text(self, to: str, text: str) -> dict:
+        return await self._post({"to": to, "type": "text", "text": {"body": text}})
+
+    async def send_image(self, to: str, url: str, caption: str = "") -> dict:
+        # Image URLs from process_reply are relative (/images/...)
+        if url.startswith("/"):
+            url = self.public_base_url + url
+        image = {"link": url}
+        if caption:
+            image["caption"] = caption
+        return await self._post({"to": to, "type": "image", "image": image})
+
+    async def _post(self, body: dict) -> dict:
+        response = await self._client.post(
+            self.url,
+            headers={"Authorization": f"Bearer {self.token}"},
+            json={"messaging_product": "whatsapp", "recipient_type": "individual", **body},
+        )
+        response.raise_for_status()
+        data = response.json()
+        return {"id": (data.get("messages") or [{}])[0].get("id", "")}
+
+
+def build_sender(token: str, phone_number_id: str, public_base_url: str = "", app_secret: str = ""):
+    if token and phone_number_id:
+        # With real delivery, an unsigned webhook would let anyone drive the LLM and message any number
+        if not app_secret:
+            raise RuntimeError("WHATSAPP_APP_SECRET is required when WHATSAPP_TOKEN/WHATSAPP_PHONE_NUMBER_ID are set")
+        return WhatsAppCloudSender(token, phone_number_id, public_base_url)
+    logger.info("WHATSAPP_TOKEN/WHATSAPP_PHONE_NUMBER_ID not set: using FakeSender")
+    return FakeSender()
@@ -0,0 +1,89 @@
+"""Benchmark embedding options: query latency and recall@5 on the eval test cases.
+
+Indexes training/catalogo/*.txt into a throwaway Chroma dir per option and runs every
+test case's user_message through search_with_debug. A chunk counts as relevant for a
+case when it contains one of the case's `must_contain` needles.
+
+Uso: python -m benchmarks.embedding_options [--precision float32 int8 ...]
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+from app.knowledge import KnowledgeBase
+
+CATALOG_DIR = Path("training/catalogo")
+TEST_CASES_PATH = Path("training/evaluaciones/test-cases.yaml")
+K = 5
+
+
+def _needles(test_case: dict) -> list[str]:
+    return [
+        b.split(":", 1)[1].strip().lower()
+        for b in test_case.get("expected_behaviors", [])
+        if b.strip().startswith("must_contain:")
+    ]
+
+
+def run_option(embedding: dict, test_cases: list[dict]) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        kb = KnowledgeBase(persist_dir=tmp, embedding=embedding)
+        warmup_ms = kb.warmup()
+
+        t_start = time.monotonic()
+        for path in sorted(CATALOG_DIR.glob("*.txt")):
+            kb.add_text(path.read_text(encoding="utf-8"), f"catalogo/{path.name}", "training")
+        index_ms = round((time.monotonic() - t_start) * 1000)
+
+        corpus = kb.collection.get(include=["documents"])["documents"]
+        latencies = []
+        recalls = []
+        for tc in test_cases:
+            needles = _needles(tc)
+            relevant = {doc for doc in corpus if any(n in doc.lower() for n in needles)}
+            t_start = time.monotonic()
+            result = kb.search_with_debug(tc["user_message"], n_results=K)
+            latencies.append((time.monotonic() - t_start) * 1000)
+            if not relevant:
+                continue
+            found = relevant & set(result["chunks"])
+            recalls.append(len(found) / min(len(relevant), K))
+
+        return {
+            "warmup_ms": warmup_ms,
+            "index_ms": index_ms,
+            "chunks": len(corpus),
+            "query_p50_ms": round(statistics.median(latencies), 2),
+            "query_max_ms": round(max(latencies), 2),
+            f"recall@{K}": round(statistics.mean(recalls), 3) if recalls else None,
+            "cases_scored": len(recalls),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--precision", nargs="+", default=["float32", "float16", "int8"])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--model-dir", default="")
+    args = parser.parse_args()
+
+    with open(TEST_CASES_PATH, "r", encoding="utf-8") as f:
+        test_cases = (yaml.safe_load(f) or {}).get("test_cases", [])
+
+    print(f"{'precision':<10} {'warmup':>8} {'index':>8} {'p50':>8} {'max':>8} {'recall@5':>9}")
+    for precision in args.precision:
+        r = run_option(
+            {"model_dir": args.model_dir, "batch_size": args.batch_size, "precision": precision},
+            test_cases,
+        )
+        print(f"{precision:<10} {r['warmup_ms']:>6}ms {r['index_ms']:>6}ms "
+              f"{r['query_p50_ms']:>6}ms {r['query_max_ms']:>6}ms {r[f'recall@{K}']!s:>9}")
+
+
+if __name__ == "__main__":
+    main()
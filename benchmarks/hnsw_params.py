@@ -0,0 +1,139 @@
+"""HNSW parameters: build time, query latency and recall vs exact search per setting.
+
+The catalog (training/catalogo/*.txt) is chunked and embedded once; every combination
+of --M, --construction-ef and --search-ef then gets its own Chroma collection built
+from those embeddings (these params are fixed at creation, see KnowledgeBase.rebuild).
+Queries are the test cases' user messages plus perturbed chunk embeddings; recall@k
+is measured against brute-force cosine top-k over the same vectors, so it isolates
+the approximation of the index (not retrieval quality, see benchmarks.retrieval_eval).
+
+The catalog alone is small enough for HNSW to be near-exact; --synthetic N adds N
+noisy copies of the chunks to see how the settings behave as the corpus grows.
+
+Uso: python -m benchmarks.hnsw_params [--M 8 16 32] [--construction-ef 100 200]
+         [--search-ef 10 50 100] [--synthetic 20000] [--k 5] [--hash-embeddings]
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from benchmarks.pipeline import HashEmbedder
+
+CATALOG_DIR = Path("training/catalogo")
+TEST_CASES_PATH = Path("training/evaluaciones/test-cases.yaml")
+RESULTS_DIR = Path(__file__).parent / "results"
+BATCH = 1000
+
+
+def _corpus(tmp: str, args) -> tuple[np.ndarray, np.ndarray]:
+    """(chunk embeddings, query embeddings), both L2-normalized."""
+    from app.knowledge import KnowledgeBase
+
+    embedding = {"model_dir": args.model_dir, "precision": args.precision}
+    kb = KnowledgeBase(persist_dir=tmp, embedding=embedding, collection_name="corpus",
+                       embedder=HashEmbedder() if args.hash_embeddings else None)
+    for path in sorted(CATALOG_DIR.glob("*.txt")):
+        kb.add_text(path.read_text(encoding="utf-8"), f"catalogo/{path.name}", "training")
+    chunks = np.asarray(kb.collection.get(include=["embeddings"])["embeddings"], dtype=np.float32)
+
+    cases = yaml.safe_load(TEST_CASES_PATH.read_text(encoding="utf-8"))["test_cases"]
+    messages = [tc["user_message"] for tc in cases if tc.get("user_message")]
+    queries = [np.asarray(kb.embedder(messages), dtype=np.float32)]
+
+    rng = np.random.default_rng(args.seed)
+    if args.synthetic:
+        base = chunks[rng.integers(0, len(chunks), args.synthetic)]
+        chunks = np.vstack([chunks, base + rng.normal(0, args.noise, base.shape).astype(np.float32)])
+    picks = chunks[rng.integers(0, len(chunks), args.queries)]
+    queries.append(picks + rng.normal(0, args.noise, picks.shape).astype(np.float32))
+
+    def normalize(m):
+        return m / np.linalg.norm(m, axis=1, keepdims=True)
+
+    return normalize(chunks), normalize(np.vstack(queries))
+
+
+def _exact_top_k(chunks: np.ndarray, queries: np.ndarray, k: int) -> list[set[int]]:
+    scores = queries @ chunks.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row.tolist()) for row in top]
+
+
+def _run(client, chunks, queries, exact, k, M, construction_ef, search_ef) -> dict:
+    name = f"hnsw-{M}-{construction_ef}-{search_ef}"
+    collection = client.create_collection(name=name, metadata={
+        "hnsw:space": "cosine", "hnsw:M": M, "hnsw:construction_ef": construction_ef, "hnsw:search_ef": search_ef,
+    })
+    t_start = time.perf_counter()
+    for start in range(0, len(chunks), BATCH):
+        batch = chunks[start:start + BATCH]
+        collection.add(ids=[str(i) for i in range(start, start + len(batch))], embeddings=batch.tolist())
+    build_s = time.perf_counter() - t_start
+
+    latencies, recalls = [], []
+    for q, expected in zip(queries, exact):
+        t_start = time.perf_counter()
+        found = collection.query(query_embeddings=[q.tolist()], n_results=k, include=[])["ids"][0]
+        latencies.append((time.perf_counter() - t_start) * 1000)
+        recalls.append(len(expected & {int(i) for i in found}) / k)
+    client.delete_collection(name)
+
+    latencies.sort()
+    return {
+        "M": M, "construction_ef": construction_ef, "search_ef": search_ef,
+        "build_s": round(build_s, 2),
+        "recall": round(statistics.mean(recalls), 4),
+        "latency_ms_p50": round(latencies[len(latencies) // 2], 2),
+        "latency_ms_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--M", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--synthetic", type=int, default=0, help="extra noisy chunk copies")
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--queries", type=int, default=200, help="perturbed-chunk queries (plus the test cases)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hash-embeddings", action="store_true", help="offline: hash-based vectors")
+    parser.add_argument("--precision", default="float32")
+    parser.add_argument("--model-dir", default="")
+    args = parser.parse_args()
+
+    from app.knowledge import _client_for
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        chunks, queries = _corpus(tmp, args)
+        k = min(args.k, len(chunks))
+        exact = _exact_top_k(chunks, queries, k)
+        client = _client_for(tmp)
+        print(f"{len(chunks)} chunks, {len(queries)} queries, k={k}\n")
+        print(f"{'M':>4} {'c_ef':>5} {'s_ef':>5} {'build':>8} {'recall':>7} {'p50':>9} {'p95':>9}")
+        for M, construction_ef, search_ef in itertools.product(args.M, args.construction_ef, args.search_ef):
+            r = _run(client, chunks, queries, exact, k, M, construction_ef, search_ef)
+            results.append(r)
+            print(f"{M:>4} {construction_ef:>5} {search_ef:>5} {r['build_s']:>7}s {r['recall']:>7} "
+                  f"{r['latency_ms_p50']:>7}ms {r['latency_ms_p95']:>7}ms")
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    out = RESULTS_DIR / f"hnsw-{datetime.now():%Y%m%d-%H%M%S}.json"
+    report = {"params": vars(args), "chunks": len(chunks), "queries": len(queries), "results": results}
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"\nreport: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Memory and serialization cost of chat messages: Pydantic ChatMessage vs compact Message.
+
+Uso: python -m benchmarks.message_log [--messages 1000]
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from app.models import ChatMessage, ChatSession, Message
+
+SAMPLE = "Buenas! La creatina monohidratada de 300g sale $790. ¿Te la separo?"
+
+
+def _alloc_bytes(build) -> tuple[int, object]:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    obj = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size, obj
+
+
+def _time_ms(fn, repeat: int = 20) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t_start)
+    return round(best * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    args = parser.parse_args()
+    n = args.messages
+    roles = [("user", ""), ("assistant", "bot")]
+
+    old_bytes, old = _alloc_bytes(lambda: [
+        ChatMessage(role=roles[i % 2][0], content=f"{SAMPLE} {i}", source=roles[i % 2][1]) for i in range(n)
+    ])
+    new_bytes, new = _alloc_bytes(lambda: [
+        Message(roles[i % 2][0], f"{SAMPLE} {i}", source=roles[i % 2][1]) for i in range(n)
+    ])
+    session = ChatSession(id="bench", phone_number="+598", messages=new)
+
+    print(f"memory per {n} messages: ChatMessage {old_bytes / 1024:.1f} KiB | Message {new_bytes / 1024:.1f} KiB")
+    print(f"serialize all (Pydantic):   {_time_ms(lambda: json.dumps([m.model_dump() for m in old]))} ms")
+    print(f"serialize all (Message):    {_time_ms(lambda: json.dumps([m.to_dict() for m in new]))} ms")
+    print(f"serialize session:          {_time_ms(lambda: session.model_dump_json())} ms")
+    print(f"ranged fetch (last 50):     {_time_ms(lambda: json.dumps([m.to_dict() for m in new[-50:]]))} ms")
+
+
+if __name__ == "__main__":
+    main()
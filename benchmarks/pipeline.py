@@ -0,0 +1,360 @@
+"""Regression benchmarks for the request pipeline.
+
+Cases:
+  chunk_text            KnowledgeBase._chunk_text on a ~90 KB document
+  search_<n>            search_with_debug on a synthetic corpus of n chunks
+  process_reply         a reply with 40 [IMAGEN: ...] markers against 500 images
+  image_lookup          200 distinct get_image_by_title queries on 10k images
+  list_sessions         SessionStore listing with 10k sessions (full list + first page)
+  chat_roundtrip        POST /api/chat through the app, LLM mocked at the HTTP layer
+
+The synthetic corpus uses random unit vectors, so building 100k chunks doesn't need
+the embedding model; queries still go through the configured embedder unless
+--hash-embeddings is given (offline: hash-based vectors, measures Chroma + ranking).
+
+Each run is written to benchmarks/results/<timestamp>.json and compared with the
+baseline (benchmarks/baseline.json): a case whose median is more than --threshold
+slower is reported as a regression and the exit code is 1.
+
+Uso:
+  python -m benchmarks.pipeline                          # run all, compare with baseline
+  python -m benchmarks.pipeline --save-baseline          # run all, store as the new baseline
+  python -m benchmarks.pipeline --only search chat --sizes 1000 10000
+  python -m benchmarks.pipeline --hash-embeddings
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+BASELINE_PATH = REPO_ROOT / "benchmarks" / "baseline.json"
+DIM = 384  # all-MiniLM-L6-v2
+# Absolute slack (ms): sub-millisecond cases jitter more than any relative threshold
+NOISE_FLOOR_MS = 0.05
+
+WORDS = (
+    "creatina proteina whey inyectable testosterona enantato cipionato precio envio "
+    "montevideo stock dosis ciclo caja ampolla frasco capsulas gramos descuento pago "
+    "transferencia mercadopago retiro local horario consulta mayorista combo oferta"
+).split()
+
+QUERIES = [
+    "cuanto sale la creatina de 300g",
+    "hacen envios al interior",
+    "que precio tiene el enantato",
+    "tienen combos para volumen",
+    "como pago con mercadopago",
+]
+
+
+# --- harness ---
+
+def measure(fn, repeat: int = 20, warmup: int = 2) -> dict:
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t_start) * 1000)
+    times.sort()
+    return {
+        "median_ms": round(statistics.median(times), 4),
+        "min_ms": round(times[0], 4),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 4),
+        "runs": repeat,
+    }
+
+
+def _sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+class HashEmbedder:
+    """Deterministic pseudo-embeddings (offline runs): same text -> same unit vector."""
+
+    def __call__(self, input):
+        out = []
+        for text in input:
+            rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+            v = rng.standard_normal(DIM).astype(np.float32)
+            out.append(v / np.linalg.norm(v))
+        return out
+
+    def warmup(self) -> float:
+        return 0.0
+
+    def name(self) -> str:
+        return "hash"
+
+
+def _knowledge_base(persist_dir: str, hash_embeddings: bool):
+    from app.knowledge import KnowledgeBase
+    return KnowledgeBase(persist_dir=persist_dir, embedder=HashEmbedder() if hash_embeddings else None)
+
+
+# --- cases ---
+
+def bench_chunk_text(args) -> dict:
+    rng = random.Random(1)
+    paragraphs = []
+    for i in range(200):
+        # Mostly short paragraphs, some oversized ones that force the sentence split
+        n = rng.choice([8, 15, 30, 60]) if i % 10 else 150
+        paragraphs.append(" ".join(_sentence(rng, rng.randint(6, 14)) for _ in range(n // 8 + 1)))
+    text = "\n\n".join(paragraphs)
+    with tempfile.TemporaryDirectory() as tmp:
+        kb = _knowledge_base(tmp, hash_embeddings=True)
+        result = measure(lambda: kb._chunk_text(text), repeat=50)
+    result["input_chars"] = len(text)
+    return {"chunk_text": result}
+
+
+def bench_search(args) -> dict:
+    results = {}
+    for size in args.sizes:
+        rng = random.Random(size)
+        vectors = np.random.default_rng(size).standard_normal((size, DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        with tempfile.TemporaryDirectory() as tmp:
+            kb = _knowledge_base(tmp, args.hash_embeddings)
+            t_start = time.perf_counter()
+            batch = 5000  # below Chroma's max batch size
+            for start in range(0, size, batch):
+                end = min(size, start + batch)
+                kb.collection.add(
+                    ids=[f"doc{i // 50}_chunk_{i}" for i in range(start, end)],
+                    embeddings=vectors[start:end].tolist(),
+                    documents=[_sentence(rng, 40) for _ in range(start, end)],
+                    metadatas=[
+                        {"doc_id": f"doc{i // 50}", "source": f"doc{i // 50}.txt", "type": "note",
+                         "chunk_index": i % 50, "category": "note", "priority": 1 + i % 5}
+                        for i in range(start, end)
+                    ],
+                )
+            build_s = time.perf_counter() - t_start
+            queries = iter(QUERIES * 1000)
+            result = measure(lambda: kb.search_with_debug(next(queries), n_results=5), repeat=30)
+        result["build_s"] = round(build_s, 1)
+        results[f"search_{size}"] = result
+        print(f"  search_{size}: corpus built in {build_s:.1f}s", file=sys.stderr)
+    return results
+
+
+def _synthetic_registry(root: Path, n: int) -> list[dict]:
+    rng = random.Random(n)
+    entries = []
+    for i in range(n):
+        title = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}"
+        slug = title.replace(" ", "-")
+        entries.append({
+            "id": f"{i:08x}", "title": title, "slug": slug, "description": "", "tags": "",
+            "filename": f"{slug}.jpg", "variants": {}, "created_at": "2026-01-01T00:00:00",
+        })
+    root.mkdir(parents=True, exist_ok=True)
+    (root / "registry.json").write_text(json.dumps(entries), encoding="utf-8")
+    return entries
+
+
+def bench_process_reply(args) -> dict:
+    from app.image_processor import process_reply
+    from app.images import ImageRegistry
+
+    with tempfile.TemporaryDirectory() as tmp:
+        entries = _synthetic_registry(Path(tmp), 500)
+        registry = ImageRegistry(Path(tmp))
+        rng = random.Random(2)
+        parts = []
+        for i in range(40):
+            parts.append(_sentence(rng, 12))
+            # Two thirds exact titles, one third misses (full-scan fallback)
+            title = entries[rng.randrange(len(entries))]["title"] if i % 3 else f"{rng.choice(WORDS)} inexistente"
+            parts.append(f"[IMAGEN: {title}]")
+        reply = "\n".join(parts)
+        return {"process_reply": measure(lambda: process_reply(reply, registry), repeat=50)}
+
+
+def bench_image_lookup(args) -> dict:
+    from app.images import ImageRegistry
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _synthetic_registry(Path(tmp), 10_000)
+        registry = ImageRegistry(Path(tmp))
+        registry.list_images()  # load + index once; the lookups are what's measured
+        rng = random.Random(3)
+        rounds = iter(range(10_000))
+
+        def lookup_batch():
+            # Distinct queries every round, so memoized lookups never hit
+            n = next(rounds)
+            for i in range(200):
+                registry.get_image_by_title(f"{rng.choice(WORDS)} {rng.choice(WORDS)} {n * 200 + i}")
+
+        return {"image_lookup": measure(lookup_batch, repeat=10, warmup=1)}
+
+
+def bench_list_sessions(args) -> dict:
+    from app.models import ChatSession, Message
+    from app.session_store import SessionStore
+
+    store = SessionStore()
+    modes = ["bot"] * 8 + ["handoff_pending", "human"]
+    for i in range(10_000):
+        session = ChatSession(
+            id=f"s{i:05d}", phone_number=f"+598 9{i:07d}", mode=modes[i % len(modes)],
+            last_activity=datetime.fromtimestamp(1_700_000_000 + i * 7).isoformat(),
+        )
+        session.messages = [Message("user", "hola"), Message("assistant", "Buenas! En que te ayudo?", source="bot")]
+        store[session.id] = session
+    return {
+        "list_sessions_all": measure(lambda: store.page(), repeat=20),
+        "list_sessions_page": measure(lambda: store.page(limit=100), repeat=50),
+        "list_sessions_handoffs": measure(lambda: store.page(modes=("handoff_pending", "human")), repeat=20),
+    }
+
+
+def bench_chat(args) -> dict:
+    """Full /api/chat round-trips in a scratch data/ dir (config, app and training linked in)."""
+    import httpx
+
+    workdir = Path(tempfile.mkdtemp(prefix="bench-chat-"))
+    for name in ("app", "config", "training"):
+        (workdir / name).symlink_to(REPO_ROOT / name)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    original_post = httpx.AsyncClient.post
+
+    async def fake_post(self, url, *a, **kw):
+        if "openrouter" in str(url):
+            await asyncio.sleep(0)
+            body = {"choices": [{"message": {"content": "Dale! La creatina sale $790. [IMAGEN: creatina]"}}],
+                    "usage": {"prompt_tokens": 900, "completion_tokens": 40, "total_tokens": 940}}
+            return httpx.Response(200, json=body, request=httpx.Request("POST", url))
+        return await original_post(self, url, *a, **kw)
+
+    httpx.AsyncClient.post = fake_post
+    if args.hash_embeddings:
+        import app.embeddings
+        app.embeddings.build_embedder = lambda config: HashEmbedder()
+    try:
+        from fastapi.testclient import TestClient
+        from app import main
+
+        main.default_tenant.greeting_config["enabled"] = False
+        kb = main.default_tenant.get_kb()
+        for path in sorted((REPO_ROOT / "training" / "catalogo").glob("*.txt")):
+            kb.add_text(path.read_text(encoding="utf-8"), f"catalogo/{path.name}", "training")
+
+        with TestClient(main.app) as client:
+            session_id = client.post("/api/sessions", json={}).json()["id"]
+            queries = iter(QUERIES * 1000)
+
+            def roundtrip():
+                r = client.post("/api/chat", json={"session_id": session_id, "message": next(queries)})
+                r.raise_for_status()
+
+            result = measure(roundtrip, repeat=40, warmup=3)
+        result["kb_chunks"] = kb.collection.count()
+        return {"chat_roundtrip": result}
+    finally:
+        httpx.AsyncClient.post = original_post
+        os.chdir(cwd)
+
+
+CASES = {
+    "chunk": bench_chunk_text,
+    "search": bench_search,
+    "reply": bench_process_reply,
+    "images": bench_image_lookup,
+    "sessions": bench_list_sessions,
+    "chat": bench_chat,
+}
+
+
+# --- baseline comparison ---
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Names of cases whose median got slower than baseline * (1 + threshold)."""
+    regressions = []
+    print(f"\n{'case':<28}{'baseline ms':>14}{'now ms':>12}{'change':>10}")
+    for name, result in current.items():
+        base = baseline.get(name)
+        now = result["median_ms"]
+        if base is None:
+            print(f"{name:<28}{'-':>14}{now:>12.3f}{'new':>10}")
+            continue
+        before = base["median_ms"]
+        change = (now - before) / before if before else 0.0
+        slower = now > before * (1 + threshold) and now - before > NOISE_FLOOR_MS
+        flag = "  REGRESSION" if slower else ""
+        print(f"{name:<28}{before:>14.3f}{now:>12.3f}{change:>+10.1%}{flag}")
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=sorted(CASES), help="cases to run (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1_000, 10_000, 100_000],
+                        help="corpus sizes for the search case")
+    parser.add_argument("--hash-embeddings", action="store_true",
+                        help="hash-based query vectors instead of the ONNX model (offline)")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative slowdown that counts as a regression (default 0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = {}
+    for key in args.only or CASES:
+        print(f"running {key}...", file=sys.stderr)
+        results.update(CASES[key](args))
+
+    run = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "hash_embeddings": args.hash_embeddings,
+        "results": results,
+    }
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    out_path = RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    out_path.write_text(json.dumps(run, indent=2), encoding="utf-8")
+    print(f"results: {out_path.relative_to(REPO_ROOT)}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(run, indent=2), encoding="utf-8")
+        print(f"baseline saved: {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print("no baseline yet (run with --save-baseline)")
+        return
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    if baseline.get("hash_embeddings") != args.hash_embeddings:
+        print("warning: baseline was recorded with a different --hash-embeddings setting")
+    regressions = compare(results, baseline["results"], args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\nno regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Replay recorded conversations with a different prompt / model / retrieval config.
+
+Reads data/recordings/*.jsonl (the recorder's output) or WhatsApp exports such as
+training/chats-reales/*.chat.txt and re-drives every session through RAG + LLM
+(see app.replay). Prints per-turn latency/tokens/handoff/similarity and a summary;
+the full report (with reply diffs) goes to benchmarks/results/replay-<ts>.json.
+
+Uso: python -m benchmarks.replay [data/recordings] [--llm recorded|mock|live]
+         [--prompt-file nuevo.txt] [--model x] [--k 5] [--fetch-factor 2] [--priority-weight 0.1]
+         [--token-budget 600] [--mmr-lambda 0.7] [--no-planner] [--no-router]
+"""
+
+import argparse
+import asyncio
+import json
+from datetime import datetime
+from pathlib import Path
+
+from app.config import load_client_config, OPENROUTER_API_KEY
+from app.replay import ReplayAgent, Replayer, load_sessions
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", nargs="?", default="data/recordings", help=".jsonl, .chat.txt or a directory")
+    parser.add_argument("--llm", choices=["recorded", "mock", "live"], default="recorded")
+    parser.add_argument("--prompt-file", default="", help="system prompt to try (default: config.yaml)")
+    parser.add_argument("--model", default="")
+    parser.add_argument("--temperature", type=float)
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--k", type=int, default=5, help="RAG chunks per turn")
+    parser.add_argument("--fetch-factor", type=int, default=2)
+    parser.add_argument("--priority-weight", type=float, default=0.1)
+    parser.add_argument("--token-budget", type=int, help="RAG context budget (0 = top k; default: config.yaml)")
+    parser.add_argument("--mmr-lambda", type=float)
+    parser.add_argument("--no-planner", action="store_true", help="search on every turn (no skip/reuse)")
+    parser.add_argument("--no-router", action="store_true", help="search all categories")
+    parser.add_argument("--persist-dir", default="data/chroma", help="knowledge store to search ('' = no RAG)")
+    parser.add_argument("--agent-name", nargs="*", default=[], help="business-side names in chat exports")
+    parser.add_argument("--show-diffs", action="store_true")
+    args = parser.parse_args()
+
+    config = load_client_config()
+    sessions = load_sessions(args.input, args.agent_name or [config["business"].get("owner", "")])
+    if not sessions:
+        raise SystemExit(f"no sessions found in {args.input}")
+
+    agent = ReplayAgent(api_key=OPENROUTER_API_KEY, config=config, llm=args.llm)
+    if args.prompt_file:
+        agent.system_prompt = Path(args.prompt_file).read_text(encoding="utf-8")
+    agent.update_params(
+        model=args.model or agent.model,
+        temperature=agent.temperature if args.temperature is None else args.temperature,
+        max_tokens=args.max_tokens or agent.max_tokens,
+    )
+    agent.rag_params.update(n_results=args.k, fetch_factor=args.fetch_factor, priority_weight=args.priority_weight)
+    if args.token_budget is not None:
+        agent.rag_params["token_budget"] = args.token_budget
+    if args.mmr_lambda is not None:
+        agent.rag_params["mmr_lambda"] = args.mmr_lambda
+    agent.planner.enabled = not args.no_planner
+    agent.planner.router.enabled = agent.planner.router.enabled and not args.no_router
+
+    kb = None
+    if args.persist_dir:
+        from app.knowledge import KnowledgeBase
+        kb = KnowledgeBase(persist_dir=args.persist_dir, embedding=config.get("knowledge", {}).get("embedding"))
+        kb.warmup()
+
+    from app.images import default_registry
+    report = asyncio.run(Replayer(agent, knowledge_base=kb, images=default_registry).run(sessions))
+
+    print(f"{'session':<28} {'turn':>4} {'ms':>8} {'tokens':>7} {'handoff':>8} {'sim':>6}")
+    for t in report["turns"]:
+        handoff = f"{t['recorded_handoff']:d}->{t['handoff']:d}"
+        print(f"{t['session'][:28]:<28} {t['turn']:>4} {t['latency_ms']:>8} {t['total_tokens']!s:>7} "
+              f"{handoff:>8} {t['similarity']:>6}")
+        if args.show_diffs and t["diff"]:
+            print("    " + t["diff"].replace("\n", "\n    "))
+    print()
+    for key, value in report["summary"].items():
+        print(f"{key:<26} {value}")
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    out = RESULTS_DIR / f"replay-{datetime.now():%Y%m%d-%H%M%S}.json"
+    report["params"] = {
+        "input": args.input, "llm": args.llm, "model": agent.model, "prompt_file": args.prompt_file,
+        **agent.rag_params, "planner": agent.planner.enabled, "router": agent.planner.router.enabled,
+    }
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\nreport: {out}")
+
+
+if __name__ == "__main__":
+    main()
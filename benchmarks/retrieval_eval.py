@@ -0,0 +1,90 @@
+"""Retrieval evaluation: recall, MRR, context tokens and query latency for search settings.
+
+Scores the test cases that declare expected_sources / expected_chunks (see
+Evaluator.run_retrieval) for every combination of --fetch-factor, --priority-weight
+and --token-budget (0 = top k; > 0 = MMR packing, see app.context_packer). No LLM
+calls: only the embedding model and Chroma are used.
+
+By default training/catalogo/*.txt is indexed into a throwaway Chroma dir (category =
+file name, as scripts/import-catalogo-rag.sh sets it), so the result doesn't depend on
+what's loaded in data/chroma; --persist-dir evaluates an existing store instead.
+--route off on runs each setting without and with the category router
+(config.yaml knowledge.router, see app.category_router).
+
+Uso: python -m benchmarks.retrieval_eval [--k 5] [--fetch-factor 1 2 4] [--priority-weight 0 0.1 0.2]
+         [--token-budget 0 400 600] [--mmr-lambda 0.7] [--route off on] [--router-mode filter boost]
+"""
+
+import argparse
+import itertools
+import tempfile
+from pathlib import Path
+
+from app.category_router import CategoryRouter
+from app.config import load_client_config
+from app.evaluator import Evaluator
+from app.knowledge import KnowledgeBase
+
+CATALOG_DIR = Path("training/catalogo")
+TEST_CASES_PATH = "training/evaluaciones/test-cases.yaml"
+
+
+def _open_kb(persist_dir: str, embedding: dict) -> KnowledgeBase:
+    kb = KnowledgeBase(persist_dir=persist_dir, embedding=embedding)
+    if kb.collection.count() == 0:
+        for path in sorted(CATALOG_DIR.glob("*.txt")):
+            doc = kb.add_text(path.read_text(encoding="utf-8"), f"catalogo/{path.name}", "training")
+            kb.update_document_metadata(doc["id"], category=path.stem.replace("-", "_"))
+    kb.warmup()
+    return kb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--fetch-factor", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--priority-weight", type=float, nargs="+", default=[0.0, 0.1, 0.2])
+    parser.add_argument("--token-budget", type=int, nargs="+", default=[0])
+    parser.add_argument("--mmr-lambda", type=float, nargs="+", default=[0.7])
+    parser.add_argument("--candidates", type=int, default=20)
+    parser.add_argument("--route", choices=["off", "on"], nargs="+", default=["off"])
+    parser.add_argument("--router-mode", choices=["filter", "boost"], nargs="+", default=["filter"])
+    parser.add_argument("--category-weight", type=float, default=0.05, help="score boost in boost mode")
+    parser.add_argument("--persist-dir", default="", help="evaluate an existing Chroma store")
+    parser.add_argument("--precision", default="float32")
+    parser.add_argument("--model-dir", default="")
+    parser.add_argument("--verbose", action="store_true", help="per-query results")
+    args = parser.parse_args()
+
+    embedding = {"model_dir": args.model_dir, "precision": args.precision}
+    router_config = load_client_config().get("knowledge", {}).get("router", {})
+    routers = [None] if "off" in args.route else []
+    if "on" in args.route:
+        routers += [CategoryRouter(**{**router_config, "enabled": True, "mode": mode}) for mode in args.router_mode]
+    with tempfile.TemporaryDirectory() as tmp:
+        evaluator = Evaluator(agent=None, knowledge_base=_open_kb(args.persist_dir or tmp, embedding),
+                              test_cases_path=TEST_CASES_PATH)
+
+        print(f"{'fetch':>6} {'prio_w':>7} {'budget':>7} {'lambda':>7} {'router':>7} {'recall':>7} {'mrr':>6} "
+              f"{'ctx_tok':>8} {'p50':>8} {'p95':>8}  cases (filtered)")
+        grid = itertools.product(args.fetch_factor, args.priority_weight, args.token_budget, args.mmr_lambda, routers)
+        for fetch_factor, priority_weight, token_budget, mmr_lambda, router in grid:
+            if not token_budget and mmr_lambda != args.mmr_lambda[0]:
+                continue  # lambda only matters with packing
+            r = evaluator.run_retrieval(
+                k=args.k, fetch_factor=fetch_factor, priority_weight=priority_weight,
+                token_budget=token_budget, candidates=args.candidates, mmr_lambda=mmr_lambda,
+                category_weight=args.category_weight if router else 0.0, router=router,
+            )
+            print(f"{fetch_factor:>6} {priority_weight:>7} {token_budget:>7} {mmr_lambda if token_budget else '-':>7} "
+                  f"{router.mode if router else 'off':>7} {r['recall']!s:>7} {r['mrr']!s:>6} "
+                  f"{r['context_tokens_mean']!s:>8} {r['latency_ms_p50']:>6}ms {r['latency_ms_p95']:>6}ms  "
+                  f"{r['total']} ({r['filtered']})")
+            if args.verbose:
+                for q in r["results"]:
+                    print(f"    {q['test_id']}  recall={q['recall']}  rr={q['reciprocal_rank']}  "
+                          f"{q['latency_ms']}ms  missing={q['missing']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Measure time-to-first-request and time-to-ready of the server.
+
+Starts uvicorn in a subprocess and polls until `/api/config` answers (first request
+served) and until `/api/health/ready` returns 200 (knowledge base warm). Older
+builds without the readiness endpoint only report the first number.
+
+Uso: python -m benchmarks.startup_time [--port 7071] [--runs 3]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def _wait_for(url: str, deadline: float, ok_status: int = 200) -> float | None:
+    while time.monotonic() < deadline:
+        try:
+            r = httpx.get(url, timeout=1.0)
+            if r.status_code == ok_status:
+                return time.monotonic()
+            if r.status_code == 404:
+                return None
+        except httpx.TransportError:
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def measure(port: int, timeout: float) -> dict:
+    t_start = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = t_start + timeout
+        base = f"http://127.0.0.1:{port}"
+        first = _wait_for(f"{base}/api/config", deadline)
+        ready = _wait_for(f"{base}/api/health/ready", deadline)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {
+        "first_request_ms": round((first - t_start) * 1000) if first else None,
+        "ready_ms": round((ready - t_start) * 1000) if ready else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=7071)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    runs = [measure(args.port, args.timeout) for _ in range(args.runs)]
+    for key in ("first_request_ms", "ready_ms"):
+        values = [r[key] for r in runs if r[key] is not None]
+        print(f"{key:<18} {statistics.median(values) if values else 'n/a'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,19 @@ cd "$(dirname "$0")"
 echo "Parando containers..."
 docker compose down -v 2>/dev/null || true
 
-echo "Borrando datos (ChromaDB, sessions, runtime config, imagenes)..."
+echo "Borrando datos (ChromaDB, snapshots, sessions, runtime config, imagenes)..."
 rm -rf data/chroma
+rm -rf data/snapshots
 rm -f  data/sessions.db data/sessions.db-shm data/sessions.db-wal
+rm -rf data/sessions
+rm -f  data/queue.db data/queue.db-shm data/queue.db-wal
+rm -f  data/usage.db data/usage.db-shm data/usage.db-wal
+rm -f  data/judge_cache.db data/judge_cache.db-shm data/judge_cache.db-wal
+rm -f  data/eval_history.db data/eval_history.db-shm data/eval_history.db-wal
+rm -f  data/experiments.db data/experiments.db-shm data/experiments.db-wal
+rm -rf data/recordings
 rm -f  data/runtime_config.yaml
+rm -rf data/prompt_versions
 rm -rf data/images
 
 echo "Recreando carpetas..."
@@ -0,0 +1,31 @@
+"""JobQueue: dedup, per-phone ordering and replies that survive a restart."""
+
+from app.job_queue import JobQueue
+
+
+def test_duplicates_are_dropped_and_a_phone_is_claimed_one_job_at_a_time(tmp_path):
+    queue = JobQueue(str(tmp_path / "queue.db"))
+    assert queue.enqueue("m1", "111", {"text": "a"})
+    assert not queue.enqueue("m1", "111", {"text": "a"})
+    assert queue.enqueue("m2", "111", {"text": "b"})
+
+    first = queue.claim()
+    assert first["provider_msg_id"] == "m1"
+    assert queue.claim() is None  # m2 waits for m1
+    queue.complete(first["id"])
+    assert queue.claim()["provider_msg_id"] == "m2"
+
+
+def test_stored_reply_is_returned_after_a_restart(tmp_path):
+    db = str(tmp_path / "queue.db")
+    queue = JobQueue(db)
+    queue.enqueue("m1", "111", {"text": "a"})
+    job = queue.claim()
+    assert job["reply"] is None
+    parts = [{"type": "text", "text": "hola"}]
+    queue.save_reply(job["id"], parts)
+
+    # Crash before delivery: the job is back to pending, with its reply
+    job = JobQueue(db).claim()
+    assert job["provider_msg_id"] == "m1"
+    assert job["reply"] == parts
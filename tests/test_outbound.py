@@ -0,0 +1,119 @@
+"""OutboundDispatcher against the local fake transport (whatsapp.FakeSender)."""
+
+import asyncio
+import time
+
+import httpx
+
+from app.outbound import CAPTION_LIMIT, OutboundDispatcher, coalesce
+from app.whatsapp import FakeSender
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_messages_to_one_recipient_keep_their_order():
+    async def scenario():
+        sender = FakeSender()
+        dispatcher = OutboundDispatcher(sender, rate_per_second=1000)
+        futures = [dispatcher.send_text("111", f"msg {i}") for i in range(10)]
+        futures.append(dispatcher.send_text("222", "other customer"))
+        assert await asyncio.gather(*futures) == [True] * 11
+        return sender.sent
+
+    sent = run(scenario())
+    assert [m["text"] for m in sent if m["to"] == "111"] == [f"msg {i}" for i in range(10)]
+    assert [m["text"] for m in sent if m["to"] == "222"] == ["other customer"]
+
+
+def test_text_is_folded_into_the_following_image_caption():
+    parts = [{"type": "text", "text": "Mirá este"}, {"type": "image", "url": "/images/a.jpg", "caption": ""}]
+    assert coalesce(parts) == [{"type": "image", "url": "/images/a.jpg", "caption": "Mirá este"}]
+
+    long_text = "x" * (CAPTION_LIMIT + 1)
+    parts = [{"type": "text", "text": long_text}, {"type": "image", "url": "/images/a.jpg", "caption": ""}]
+    assert [p["type"] for p in coalesce(parts)] == ["text", "image"]
+
+
+def test_coalesced_reply_costs_one_send():
+    async def scenario():
+        sender = FakeSender()
+        dispatcher = OutboundDispatcher(sender, rate_per_second=1000)
+        await dispatcher.send("111", [
+            {"type": "text", "text": "Te paso la foto"},
+            {"type": "image", "url": "/images/a.jpg", "caption": ""},
+        ])
+        return sender.sent, dispatcher.stats()
+
+    sent, stats = run(scenario())
+    assert len(sent) == 1 and sent[0]["caption"] == "Te paso la foto"
+    assert stats["coalesced"] == 1 and stats["sent"] == 1
+
+
+def test_failed_sends_are_retried_with_backoff():
+    async def scenario():
+        sender = FakeSender()
+        sender.fail_next = 2
+        dispatcher = OutboundDispatcher(sender, rate_per_second=1000, max_attempts=4, backoff_seconds=0.05)
+        t_start = time.monotonic()
+        delivered = await dispatcher.send_text("111", "hola")
+        return delivered, time.monotonic() - t_start, sender.sent, dispatcher.stats()
+
+    delivered, elapsed, sent, stats = run(scenario())
+    assert delivered is True
+    assert [m["text"] for m in sent] == ["hola"]
+    assert stats["retries"] == 2 and stats["failed"] == 0
+    assert elapsed >= 0.05 + 0.1  # 0.05 * 2**0 + 0.05 * 2**1
+
+
+def test_reply_is_dropped_after_max_attempts_and_the_queue_moves_on():
+    async def scenario():
+        sender = FakeSender()
+        sender.fail_next = 2
+        dispatcher = OutboundDispatcher(sender, rate_per_second=1000, max_attempts=2, backoff_seconds=0.01)
+        first = dispatcher.send_text("111", "lost")
+        second = dispatcher.send_text("111", "next")
+        return await first, await second, sender.sent, dispatcher.stats()
+
+    first, second, sent, stats = run(scenario())
+    assert (first, second) == (False, True)
+    assert [m["text"] for m in sent] == ["next"]
+    assert stats["failed"] == 1
+
+
+def test_client_errors_other_than_429_are_not_retried():
+    class RejectingSender(FakeSender):
+        async def send_text(self, to, text):
+            self.attempts = getattr(self, "attempts", 0) + 1
+            request = httpx.Request("POST", "https://graph.facebook.com")
+            raise httpx.HTTPStatusError("bad request", request=request, response=httpx.Response(400, request=request))
+
+    async def scenario():
+        sender = RejectingSender()
+        dispatcher = OutboundDispatcher(sender, rate_per_second=1000, max_attempts=4, backoff_seconds=0.01)
+        return await dispatcher.send_text("111", "hola"), sender.attempts
+
+    assert run(scenario()) == (False, 1)
+
+
+def test_rate_limit_caps_sends_per_second():
+    async def scenario():
+        sender = FakeSender()
+        dispatcher = OutboundDispatcher(sender, rate_per_second=20)  # burst of 20
+        t_start = time.monotonic()
+        await asyncio.gather(*(dispatcher.send_text(f"phone-{i}", "hola") for i in range(30)))
+        return time.monotonic() - t_start, len(sender.sent), dispatcher.stats()
+
+    elapsed, sent, stats = run(scenario())
+    assert sent == 30
+    assert elapsed >= 10 / 20 * 0.9  # the 10 sends past the burst wait for tokens
+    assert stats["rate_limit_wait_s"] > 0
+
+
+def test_empty_reply_resolves_immediately():
+    async def scenario():
+        dispatcher = OutboundDispatcher(FakeSender())
+        return await dispatcher.send("111", [{"type": "text", "text": ""}])
+
+    assert run(scenario()) is True